@@ -3,6 +3,12 @@ from . import dataone
 from . import util
 from . import validator
 from . import metadata
+from . import export
+from . import cache
+from . import formats
+from . import resilience
+from . import timing
+from . import metrics
 from .graph import Graph
 from .interface import Interface
 
@@ -0,0 +1,521 @@
+""" cache.py
+
+    Caches used while building the graph:
+
+    DocumentCache
+        An on-disk cache for documents retrieved from the DataOne CN (system
+        metadata, science metadata, and resource maps).
+
+    DocumentWriter
+        A document being written to a DocumentCache, e.g. while it's being
+        streamed from the CN.
+
+    LRUCache
+        A small in-memory cache, e.g., of person and organization URIs.
+
+    DocumentCache stores documents under `root` by kind (e.g. 'meta', 'object') at a
+    path derived from the SHA-1 of their identifier:
+
+        {root}/{kind}/{sha1[:2]}/{sha1}
+
+    Writes go to a temporary file which is then renamed into place so readers
+    (possibly in other worker processes) never see partial documents.
+
+    A DocumentCache may be used from several threads at once (e.g., by
+    dataone.getSystemMetadataConcurrently) so its counters are only updated
+    while holding its lock.
+
+    Each file's modification time records when it was written and is used for
+    TTL-based expiry. Its access time is bumped on every hit and is used to
+    evict the least recently used documents once the cache grows past
+    `max_bytes`.
+
+    The DocumentCache directory may be shared by several processes (e.g., every
+    worker on a host, which never see each other's writes) so the in-memory
+    size is only an estimate. It is re-read from disk on a
+    random SIZE_CHECK_PROBABILITY of writes and before every eviction.
+"""
+
+import os
+import time
+import random
+import threading
+import hashlib
+import tempfile
+import logging
+import collections
+
+import metrics
+
+# Default upper bound on the size of the cache
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# Fraction of max_bytes to shrink the cache to when evicting
+EVICTION_TARGET = 0.9
+
+# Default number of entries held by an LRUCache
+DEFAULT_LRU_SIZE = 10000
+
+# Chance that a write re-reads the size of the cache from disk
+SIZE_CHECK_PROBABILITY = 0.01
+
+
+class DocumentCache:
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES, ttl=None):
+        """Initialize a cache rooted at the directory `root`.
+
+        Arguments:
+        ----------
+
+        root : str
+            Directory to store documents under. Created if it doesn't exist.
+
+        max_bytes : int
+            Size the cache is allowed to grow to before documents are evicted
+
+        ttl : Dict
+            (optional) Maximum age (in seconds) of documents, indexed by
+            kind. Kinds without a TTL never expire.
+        """
+
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl = ttl if ttl is not None else {}
+
+        # Hit/miss counts, indexed by kind
+        self.hits = {}
+        self.misses = {}
+
+        # Guards hits, misses, and size. Eviction has its own lock so only
+        # one thread walks the cache directory at a time.
+        self.lock = threading.Lock()
+        self.eviction_lock = threading.Lock()
+
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+        self.size = self.calculateSize()
+
+
+    def __str__(self):
+        return "DocumentCache: '%s'" % self.root
+
+
+    def path(self, kind, key):
+        """Get the path a document of kind `kind` with identifier `key` is
+        stored at."""
+
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+
+        digest = hashlib.sha1(key).hexdigest()
+
+        return os.path.join(self.root, kind, digest[:2], digest)
+
+
+    def get(self, kind, key, newer_than=None):
+        """Get the content of a cached document.
+
+        Arguments:
+        ----------
+
+        kind : str
+            Kind of document
+
+        key : str
+            Identifier of the document
+
+        newer_than : float
+            (optional) Seconds since the epoch. Copies stored before this
+            time are treated as expired.
+
+        Returns:
+            str | None: The document's content or None if it wasn't cached
+            or had expired.
+        """
+
+        f = self.open(kind, key, newer_than)
+
+        if f is None:
+            return None
+
+        with f:
+            return f.read()
+
+
+    def open(self, kind, key, newer_than=None):
+        """Open a cached document for reading, e.g. to parse it without
+        reading all of it into memory. Takes the same arguments as get.
+
+        Returns:
+            file | None: The open document, which the caller closes, or None
+            if it wasn't cached or had expired.
+        """
+
+        path = self.path(kind, key)
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.miss(kind)
+            return None
+
+        if kind in self.ttl and time.time() - stat.st_mtime > self.ttl[kind]:
+            self.miss(kind)
+            return None
+
+        if newer_than is not None and stat.st_mtime < newer_than:
+            self.miss(kind)
+            return None
+
+        try:
+            f = open(path, 'rb')
+
+            # Record the access for LRU eviction, leaving mtime alone
+            os.utime(path, (time.time(), stat.st_mtime))
+        except (IOError, OSError):
+            # Evicted by another process between stat() and open()
+            self.miss(kind)
+            return None
+
+        with self.lock:
+            self.hits[kind] = self.hits.get(kind, 0) + 1
+
+        metrics.increment('d1lod_document_cache_requests_total', {'kind': kind, 'result': 'hit'})
+
+        return f
+
+
+    def put(self, kind, key, content):
+        """Store `content` as the document of kind `kind` with identifier
+        `key`, replacing any existing copy.
+
+        Returns: None
+        """
+
+        if content is None:
+            return
+
+        writer = self.writer(kind, key)
+
+        try:
+            writer.write(content)
+        except:
+            writer.abort()
+            raise
+
+        writer.commit()
+
+
+    def writer(self, kind, key):
+        """Start writing the document of kind `kind` with identifier `key`.
+        Nothing replaces the existing copy (if any) until the writer is
+        committed.
+
+        Returns: DocumentWriter
+        """
+
+        return DocumentWriter(self, self.path(kind, key))
+
+
+    def added(self, num_bytes):
+        """Account for a document of `num_bytes` bytes having been written,
+        evicting documents if the cache has grown too large.
+
+        Returns: None
+        """
+
+        with self.lock:
+            self.size += num_bytes
+            size = self.size
+
+        if size <= self.max_bytes and random.random() < SIZE_CHECK_PROBABILITY:
+            size = self.calculateSize()
+
+            with self.lock:
+                self.size = size
+
+        if size > self.max_bytes:
+            self.evict()
+
+
+    def delete(self, kind, key):
+        """Remove a document from the cache if it's present.
+
+        Returns: None
+        """
+
+        path = self.path(kind, key)
+
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+
+        with self.lock:
+            self.size -= size
+
+
+    def miss(self, kind):
+        with self.lock:
+            self.misses[kind] = self.misses.get(kind, 0) + 1
+
+        metrics.increment('d1lod_document_cache_requests_total', {'kind': kind, 'result': 'miss'})
+
+
+    def stats(self):
+        """Summarize cache usage.
+
+        Returns:
+            A Dict with the cache's 'size' in bytes and its 'hits' and
+            'misses' by kind.
+        """
+
+        with self.lock:
+            return {
+                'size': self.size,
+                'hits': dict(self.hits),
+                'misses': dict(self.misses)
+            }
+
+
+    def entries(self):
+        """List every document in the cache.
+
+        Returns:
+            List of (path, size, atime) tuples.
+        """
+
+        entries = []
+
+        for directory, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+
+                path = os.path.join(directory, filename)
+
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                entries.append((path, stat.st_size, stat.st_atime))
+
+        return entries
+
+
+    def calculateSize(self):
+        """Calculate the total size of the cached documents on disk."""
+
+        return sum([entry[1] for entry in self.entries()])
+
+
+    def evict(self):
+        """Delete the least recently used documents until the cache is
+        EVICTION_TARGET of max_bytes.
+
+        Other processes may share the cache directory so the size is
+        recalculated from disk first.
+
+        Returns:
+            The number of documents deleted.
+        """
+
+        with self.eviction_lock:
+            entries = self.entries()
+            total = sum([entry[1] for entry in entries])
+            target = self.max_bytes * EVICTION_TARGET
+
+            num_evicted = 0
+
+            for path, size, atime in sorted(entries, key=lambda entry: entry[2]):
+                if total <= target:
+                    break
+
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+
+                total -= size
+                num_evicted += 1
+
+            with self.lock:
+                self.size = total
+
+        logging.info("Evicted %d document(s) from %s.", num_evicted, self)
+
+        return num_evicted
+
+
+class DocumentWriter:
+    def __init__(self, document_cache, path):
+        """Initialize a writer for the document at `path` in
+        `document_cache`. Content is written to a temporary file alongside
+        it, which commit renames into place.
+
+        Arguments:
+        ----------
+
+        document_cache : DocumentCache
+            The cache the document is written to
+
+        path : str
+            Path the document is stored at (see DocumentCache.path)
+        """
+
+        self.document_cache = document_cache
+        self.path = path
+        self.size = 0
+
+        directory = os.path.dirname(path)
+
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created concurrently by another process
+                if not os.path.isdir(directory):
+                    raise
+
+        fd, self.temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        self.file = os.fdopen(fd, 'wb')
+
+
+    def write(self, content):
+        self.file.write(content)
+        self.size += len(content)
+
+
+    def commit(self):
+        """Move the written document into place.
+
+        Returns: None
+        """
+
+        try:
+            self.file.close()
+            os.rename(self.temp_path, self.path)
+        except:
+            self.abort()
+            raise
+
+        self.document_cache.added(self.size)
+
+
+    def abort(self):
+        """Discard the written content, e.g. because the document was only
+        partially read.
+
+        Returns: None
+        """
+
+        self.file.close()
+
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class LRUCache:
+    def __init__(self, max_size=DEFAULT_LRU_SIZE):
+        """Initialize an in-memory cache holding at most `max_size` entries,
+        discarding the least recently used entry when full.
+
+        Arguments:
+        ----------
+
+        max_size : int
+            Maximum number of entries
+        """
+
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
+    def get(self, key):
+        """Get the value stored under `key`, marking it as recently used.
+
+        Returns:
+            The value or None if `key` isn't in the cache.
+        """
+
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        self.hits += 1
+
+        return value
+
+
+    def put(self, key, value):
+        """Store `value` under `key`, evicting the least recently used entry
+        if the cache is full.
+
+        Returns: None
+        """
+
+        if key in self.entries:
+            del self.entries[key]
+        elif len(self.entries) >= self.max_size:
+            self.entries.popitem(last=False)
+
+        self.entries[key] = value
+
+
+    def discard(self, key):
+        """Remove `key` from the cache if it's present.
+
+        Returns: None
+        """
+
+        self.entries.pop(key, None)
+
+
+    def discardValues(self, values):
+        """Remove every entry whose value (compared as a string) is one of
+        `values`.
+
+        Returns:
+            The number of entries removed.
+        """
+
+        values = set([str(value) for value in values])
+        stale = [key for key, value in self.entries.iteritems() if str(value) in values]
+
+        for key in stale:
+            del self.entries[key]
+
+        return len(stale)
+
+
+    def clear(self):
+        self.entries.clear()
+
+
+    def stats(self):
+        """Summarize cache usage.
+
+        Returns:
+            A Dict with the cache's 'size' in entries, 'hits', and 'misses'.
+        """
+
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses
+        }
@@ -4,36 +4,94 @@ dataone.py
 Functions related to querying the DataOne v1 API.
 """
 
-import os
 import urllib
-import base64
+import calendar
 import re
 import xml.etree.ElementTree as ET
 import RDF
+import time
 import datetime
+import logging
+import collections
+from multiprocessing.pool import ThreadPool
 from dateutil.parser import parse
 
 from d1lod import util
+from d1lod.metadata import xpath
+from d1lod.metadata import registry
+from d1lod import timing
+from d1lod import resilience
+
+# Number of system metadata documents fetched in parallel
+SYSTEM_METADATA_THREADS = 8
+
+# Number of documents looked up per Solr query by getSystemMetadataModified
+SYSTEM_METADATA_LOOKUP_SIZE = 100
+
+# (bytes) Size of the reads made while streaming a document
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Number of times a document is downloaded again after its stream failed
+STREAM_RETRIES = 2
+
+# Optional d1lod.cache.DocumentCache. See setDocumentCache.
+DOCUMENT_CACHE = None
+
+# The Solr fields datasets are added from, as stored in a SolrRecord. See
+# docToRecord.
+SolrRecord = collections.namedtuple('SolrRecord', ['identifier',
+                                                   'title',
+                                                   'abstract',
+                                                   'obsoletes',
+                                                   'north_bound',
+                                                   'east_bound',
+                                                   'south_bound',
+                                                   'west_bound',
+                                                   'begin_date',
+                                                   'end_date',
+                                                   'date_modified',
+                                                   'resource_maps',
+                                                   'data_url',
+                                                   'format_id'])
+
+# SolrRecord attributes, indexed by the name of the Solr field they hold
+SOLR_RECORD_FIELDS = {
+    'identifier': 'identifier',
+    'title': 'title',
+    'abstract': 'abstract',
+    'obsoletes': 'obsoletes',
+    'northBoundCoord': 'north_bound',
+    'eastBoundCoord': 'east_bound',
+    'southBoundCoord': 'south_bound',
+    'westBoundCoord': 'west_bound',
+    'beginDate': 'begin_date',
+    'endDate': 'end_date',
+    'dateModified': 'date_modified',
+    'resourceMap': 'resource_maps',
+    'dataUrl': 'data_url',
+    'formatId': 'format_id'
+}
 
 
 def getNumResults(query):
     """Performs a query and extracts just the number of results in the query."""
 
-    num_results = -1
-
     xmldoc = util.getXML(query)
-    result_node = xmldoc.findall(".//result")
+    result_node = xmldoc.find(".//result")
 
-    if result_node is not None:
-        num_results = result_node[0].get('numFound')
+    if result_node is None or result_node.get('numFound') is None:
+        raise Exception("Solr response for %s had no numFound." % query)
 
-    return int(num_results)
+    return int(result_node.get('numFound'))
 
 
-def createSinceQueryURL(from_string, to_string, fields=None, start=0, page_size=1000):
+def createSinceQueryURL(from_string, to_string, fields=None, start=0, page_size=1000, cursor_mark=None):
     """Creates a query string to get documents uploaded since `from_string` up
     to `to_string`.
 
+    Results are sorted by dateModified and then by id so the order is stable
+    even when many documents share a dateModified.
+
     Parameters:
 
         from_string|to_string:
@@ -46,6 +104,10 @@ def createSinceQueryURL(from_string, to_string, fields=None, start=0, page_size=
 
         start|page_size: optional
             Solr query parameters
+
+        cursor_mark: optional
+            Solr cursorMark to page with instead of `start`. Use '*' for the
+            first page.
     """
 
     # Create the URL
@@ -67,10 +129,15 @@ def createSinceQueryURL(from_string, to_string, fields=None, start=0, page_size=
     rows = page_size
     start = start
 
-    query_string = "%s?q=%s&rows=%s&start=%s&sort=dateModified+asc" % (base_url,
-                                                                       query_params,
-                                                                       rows,
-                                                                       start)
+    query_string = "%s?q=%s&rows=%s&sort=dateModified+asc,id+asc" % (base_url,
+                                                                     query_params,
+                                                                     rows)
+
+    # Solr doesn't allow a start offset when paging with a cursor
+    if cursor_mark is not None:
+        query_string += "&cursorMark=%s" % urllib.quote_plus(cursor_mark)
+    else:
+        query_string += "&start=%s" % start
 
     # Optional step: Add the fields query part
     if fields is not None:
@@ -132,28 +199,70 @@ def getDocumentIdentifiersSince(from_string, to_string=None, fields=None, page_s
         except:
             raise Exception("Failed to parse to_string of %s." % to_string)
 
-    # Get the number of pages we need
-    query_string = createSinceQueryURL(from_string, to_string, fields=[], start=0, page_size=0)
-    num_results = getNumResults(query_string)
-
-    # Calculate the number of pages we need to get to get all results
-    num_pages = num_results / page_size
-    if num_results % page_size > 0:
-        num_pages += 1
-
-    print 'Found %d documents over %d pages' % (num_results, num_pages)
-    # util.continue_or_quit()
-
     # Collect the identifiers
     identifiers = []
 
-    for page in range(1, num_pages + 1):
-        page_identifiers = getIdentifiersSince(from_string, to_string, page=page)
-        identifiers += page_identifiers
+    for doc in iterSinceDocuments(from_string, to_string, fields=['identifier'], page_size=page_size):
+        identifier = doc.find("./str[@name='identifier']")
+
+        if identifier is not None and identifier.text is not None:
+            identifiers.append(identifier.text)
+
+    print 'Found %d documents' % len(identifiers)
 
     return identifiers
 
 
+def iterSinceDocuments(from_string, to_string, fields=None, page_size=1000):
+    """Iterate over every document modified between `from_string` and
+    `to_string`, in order of dateModified.
+
+    Pages through the Solr index with cursorMark rather than a start offset
+    so each page costs the same to fetch no matter how deep into the results
+    it is, and documents whose dateModified changes mid-scan aren't skipped
+    or repeated because of shifting offsets.
+
+    Parameters:
+
+        from_string|to_string:
+            String of form '2015-05-30T23:21:15.567Z'
+
+        fields: optional
+            See createSinceQueryURL
+
+        page_size : int
+            Solr page size parameter
+
+    Returns:
+        A generator of Solr <doc> elements.
+    """
+
+    cursor_mark = '*'
+
+    while True:
+        query_string = createSinceQueryURL(from_string,
+                                           to_string,
+                                           fields=fields,
+                                           page_size=page_size,
+                                           cursor_mark=cursor_mark)
+        query_xml = util.getXML(query_string)
+        docs = query_xml.findall(".//doc")
+
+        for doc in docs:
+            yield doc
+
+        next_cursor_mark = query_xml.find("./str[@name='nextCursorMark']")
+
+        if next_cursor_mark is None or next_cursor_mark.text is None:
+            raise Exception("Solr response did not contain a nextCursorMark.")
+
+        # Solr returns the same cursorMark once the results are exhausted
+        if len(docs) == 0 or next_cursor_mark.text == cursor_mark:
+            break
+
+        cursor_mark = next_cursor_mark.text
+
+
 def getSincePage(from_string, to_string, page=1, page_size=1000, fields=None):
     """Get a page off the Solr index for a query between two time periods."""
 
@@ -164,124 +273,343 @@ def getSincePage(from_string, to_string, page=1, page_size=1000, fields=None):
     return query_xml
 
 
-def getSystemMetadata(identifier, cache=False):
+def setDocumentCache(document_cache):
+    """Set the d1lod.cache.DocumentCache that system metadata, science
+    metadata, and resource maps are cached in. Pass None to disable caching.
+    """
+
+    global DOCUMENT_CACHE
+    DOCUMENT_CACHE = document_cache
+
+
+def getDocument(kind, url, identifier, cache=True, modified=None):
+    """Get the content of the document at `url`, going through the document
+    cache (if one is set).
+
+    Arguments:
+        kind: str
+            Kind of document, i.e. the CN endpoint ('meta' or 'object')
+        url: str
+            URL of the document
+        identifier: str
+            PID of the document
+        cache: bool
+            Whether to use the document cache
+        modified: str
+            (optional) Datetime string of form '2015-05-30T23:21:15.567Z'.
+            Cached copies stored before this time are re-downloaded.
+
+    Returns:
+        The document's content or None if it couldn't be retrieved.
+    """
+
+    use_cache = cache is True and DOCUMENT_CACHE is not None
+
+    if use_cache:
+        newer_than = None
+
+        if modified is not None:
+            newer_than = calendar.timegm(parse(modified).utctimetuple())
+
+        content = DOCUMENT_CACHE.get(kind, identifier, newer_than=newer_than)
+
+        if content is not None:
+            return content
+
+    content = util.getContent(url)
+
+    if content is not None and use_cache:
+        DOCUMENT_CACHE.put(kind, identifier, content)
+
+    return content
+
+
+def parseDocument(content, fromstring=ET.fromstring):
+    """Parse the content of an XML document, returning None if it can't be
+    parsed. `fromstring` is the parser to use, e.g. xpath.fromstring."""
+
+    if content is None:
+        return None
+
+    try:
+        return fromstring(content)
+    except xpath.PARSE_ERRORS, e:
+        print "Failed to parse XML document: %s" % e
+        return None
+
+
+def getSystemMetadata(identifier, cache=True, modified=None):
     """Gets the system metadata for an identifier.
 
-    In development, I'm keeping a cache of documents in the root of the
-    d1lod folder at ./cache. This will need to be removed in
-    production. This is toggled with the argument `cache`.
+    System metadata can change (e.g., as replicas are made) so cached copies
+    expire according to the document cache's TTL for 'meta' documents or
+    when they're older than `modified`.
 
     Arguments:
         identifier: str
             PID of the document
         cache: bool
-            Whether to cache files in the current working directory
+            Whether to use the document cache
+        modified: str
+            (optional) Datetime string. Cached copies stored before this time
+            are re-downloaded.
 
     Returns:
         An XML document
     """
 
-    sysmeta = None
-    cache_filename = None
-    cache_filepath = None
+    query_string = "https://cn.dataone.org/cn/v1/meta/%s" % urllib.quote_plus(identifier)
+    content = getDocument('meta', query_string, identifier, cache, modified)
 
-    # Try from cache first
-    if cache is True:
-        if not os.path.exists("./cache"):
-            os.mkdir("./cache")
+    return parseDocument(content)
 
-        if not os.path.exists("./cache/meta/"):
-            os.mkdir("./cache/meta/")
 
-        cache_filename = base64.urlsafe_b64encode(identifier)
-        cache_filepath = './cache/meta/' + cache_filename
+def createModifiedQueryURL(identifiers):
+    """Creates a query string to get when the system metadata of each of
+    `identifiers` was last modified."""
 
-        if os.path.isfile(cache_filepath):
-            print "Loading system metadata for %s from cache." % identifier
+    terms = ['"%s"' % identifier.replace('\\', '\\\\').replace('"', '\\"') for identifier in identifiers]
+    query = "id:(%s)" % " OR ".join(terms)
 
-            sysmeta = ET.parse(cache_filepath)
+    return "https://cn.dataone.org/cn/v1/query/solr/?fl=id,dateModified&q=%s&rows=%d&start=0" % (urllib.quote_plus(query), len(identifiers))
 
-            if sysmeta is not None:
-                sysmeta = sysmeta.getroot()
 
-    # Return cached copy if we successfully got it
-    if sysmeta is not None:
-        return sysmeta
+def getSystemMetadataModified(identifiers):
+    """Gets when the system metadata for each of `identifiers` was last
+    modified (its dateSysMetadataModified, which Solr indexes as
+    dateModified), SYSTEM_METADATA_LOOKUP_SIZE documents per Solr query.
 
-    query_string = "https://cn.dataone.org/cn/v1/meta/%s" % urllib.quote_plus(identifier)
-    sysmeta = util.getXML(query_string)
+    Arguments:
+        identifiers: List(str)
+            PIDs of the documents
+
+    Returns:
+        A Dict of datetime strings, e.g. '2015-05-30T23:21:15.567Z', indexed
+        by PID. Documents which couldn't be looked up are left out.
+    """
+
+    unique_identifiers = sorted(set(identifiers))
+    dates = {}
+
+    for start in range(0, len(unique_identifiers), SYSTEM_METADATA_LOOKUP_SIZE):
+        chunk = unique_identifiers[start:start + SYSTEM_METADATA_LOOKUP_SIZE]
+
+        try:
+            query_xml = util.getXML(createModifiedQueryURL(chunk))
+        except Exception, e:
+            logging.error("Failed to look up when the system metadata for %d document(s) was modified: %s", len(chunk), e)
+            continue
+
+        for doc in query_xml.iter('doc'):
+            identifier = doc.find("./str[@name='id']")
+            date_modified = doc.find("./date[@name='dateModified']")
+
+            if identifier is not None and date_modified is not None:
+                dates[identifier.text] = date_modified.text
+
+    return dates
+
+
+def getSystemMetadataConcurrently(identifiers, num_threads=SYSTEM_METADATA_THREADS, modified=None):
+    """Gets the system metadata for many identifiers at once, using a pool of
+    `num_threads` threads.
+
+    Arguments:
+        identifiers: List(str)
+            PIDs of the documents
 
-    # Cache what we found for next time
-    if sysmeta is not None and cache is True:
-        if cache_filepath is None:
-            if cache_filename is None:
-                cache_filename = base64.urlsafe_b64encode(identifier)
-            cache_filepath = './cache/meta/' + cache_filename
+        num_threads: int
+            Maximum number of requests in flight at a time
 
-        with open(cache_filepath, "wb") as f:
-            f.write(ET.tostring(sysmeta))
+        modified: Dict
+            (optional) Datetime strings, indexed by PID, of when each
+            document's system metadata was last modified (see
+            getSystemMetadataModified). Cached copies stored before then are
+            re-downloaded.
 
-    return sysmeta
+    Returns:
+        A Dict of XML documents (or None, when one couldn't be retrieved),
+        indexed by PID.
+    """
+
+    unique_identifiers = []
+
+    for identifier in identifiers:
+        if identifier not in unique_identifiers:
+            unique_identifiers.append(identifier)
+
+    if len(unique_identifiers) == 0:
+        return {}
+
+    if modified is None:
+        modified = {}
+
+    fetch = lambda identifier: fetchSystemMetadata(identifier, modified.get(identifier))
+
+    if len(unique_identifiers) == 1 or num_threads <= 1:
+        return dict(zip(unique_identifiers, map(fetch, unique_identifiers)))
+
+    pool = ThreadPool(min(num_threads, len(unique_identifiers)))
+
+    try:
+        sysmetas = pool.map(fetch, unique_identifiers)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict(zip(unique_identifiers, sysmetas))
+
+
+def fetchSystemMetadata(identifier, modified=None):
+    """Wraps getSystemMetadata so a failure to get one document is logged
+    and returned as None instead of being raised."""
+
+    try:
+        with timing.stage('sysmeta_object'):
+            return getSystemMetadata(identifier, modified=modified)
+    except Exception, e:
+        logging.error("Failed to get system metadata for %s: %s", identifier, e)
+        return None
 
 
-def getScientificMetadata(identifier, cache=False):
+def getScientificMetadata(identifier, cache=True):
     """Gets the scientific metadata for an identifier.
 
-    In development, I'm keeping a cache of documents in the root of the
-    d1lod folder at ./cache. This will need to be removed in
-    production. This is toggled with the argument `cache`.
+    Objects on the CN never change once uploaded so cached copies are
+    always used.
 
     Arguments:
         identifier: str
             PID of the document
 
         cache: bool
-            Whether to cache files in the current working directory
+            Whether to use the document cache
 
     Returns:
         An XML document
     """
 
-    scimeta = None
-    cache_filename = None
-    cache_filepath = None
+    query_string = "https://cn.dataone.org/cn/v1/object/%s" % urllib.quote_plus(identifier)
+    content = getDocument('object', query_string, identifier, cache)
+
+    # Parsed with lxml, when it's installed, for the precompiled paths the
+    # d1lod.metadata processors extract creators with
+    return parseDocument(content, xpath.fromstring)
 
-    # Try from cache first
-    if cache is True:
-        if not os.path.exists("./cache"):
-            os.mkdir("./cache")
 
-        if not os.path.exists("./cache/object/"):
-            os.mkdir("./cache/object")
+def streamScientificMetadata(identifier, format_id=None, cache=True):
+    """Gets the parts of the scientific metadata for an identifier that
+    creators are extracted from (see d1lod.metadata.registry.iterparse).
 
-        cache_filename = base64.urlsafe_b64encode(identifier)
-        cache_filepath = './cache/object/' + cache_filename
+    The document is parsed as it's downloaded (or read from the document
+    cache) and everything else in it is discarded as it's parsed, so large
+    documents are never held in memory in full. Downloaded documents are
+    written to the document cache as they're read.
 
-        if os.path.isfile(cache_filepath):
-            print "Loading scientific metadata for %s from cache." % identifier
+    A download that fails part-way through (see resilience.STREAM_ERRORS) is
+    started over from the beginning up to STREAM_RETRIES times.
 
-            scimeta = ET.parse(cache_filepath)
+    Arguments:
+        identifier: str
+            PID of the document
+
+        format_id: str
+            (optional) The document's formatId
+
+        cache: bool
+            Whether to use the document cache
+
+    Returns:
+        The document's pruned root element or None if it couldn't be
+        retrieved or parsed.
+    """
+
+    use_cache = cache is True and DOCUMENT_CACHE is not None
 
-            if scimeta is not None:
-                scimeta = scimeta.getroot()
+    if use_cache:
+        f = DOCUMENT_CACHE.open('object', identifier)
 
-    # Return cached copy if we successfully got it
-    if scimeta is not None:
-        return scimeta
+        if f is not None:
+            with f:
+                try:
+                    return registry.iterparse(f, format_id)
+                except xpath.PARSE_ERRORS, e:
+                    print "Failed to parse XML document: %s" % e
+                    return None
 
     query_string = "https://cn.dataone.org/cn/v1/object/%s" % urllib.quote_plus(identifier)
-    scimeta = util.getXML(query_string)
 
-    # Cache what we found for next time
-    if scimeta is not None and cache is True:
-        if cache_filepath is None:
-            if cache_filename is None:
-                cache_filename = base64.urlsafe_b64encode(identifier)
-            cache_filepath = './cache/meta/' + cache_filename
-        with open(cache_filepath, "wb") as f:
-            f.write(ET.tostring(scimeta))
+    for attempt in range(STREAM_RETRIES + 1):
+        try:
+            return parseStream(query_string, identifier, format_id, use_cache)
+        except resilience.STREAM_ERRORS, e:
+            if attempt >= STREAM_RETRIES:
+                raise
+
+            logging.warning("Stream of %s failed (%s), downloading it again.", identifier, e)
+            time.sleep(resilience.getBackoff(attempt))
+
+
+def parseStream(query_string, identifier, format_id=None, use_cache=True):
+    """Download and parse a document as in streamScientificMetadata, once.
+
+    Errors reading the stream (see resilience.STREAM_ERRORS) are raised,
+    after discarding whatever was written to the document cache.
+
+    Arguments:
+        query_string: str
+            URL of the document
+
+        identifier: str
+            PID of the document
+
+        format_id: str
+            (optional) The document's formatId
+
+        use_cache: bool
+            Whether to write the document to the document cache
+
+    Returns:
+        The document's pruned root element or None if it couldn't be
+        retrieved or parsed.
+    """
+
+    r = util.getStream(query_string)
+
+    if r is None:
+        return None
+
+    source = r.raw
+    writer = None
+
+    if use_cache:
+        writer = DOCUMENT_CACHE.writer('object', identifier)
+        source = util.TeeReader(r.raw, writer)
 
-    return scimeta
+    root = None
+
+    try:
+        root = registry.iterparse(source, format_id)
+
+        # Parsing stops at the root element of documents in unknown formats,
+        # which aren't worth caching. Otherwise whatever follows the root
+        # element is read too so the cached copy is complete.
+        if writer is not None and registry.getProcessor(registry.detectFormat(root, format_id)) is not None:
+            while len(source.read(STREAM_CHUNK_SIZE)) > 0:
+                pass
+
+            writer.commit()
+            writer = None
+    except xpath.PARSE_ERRORS, e:
+        print "Failed to parse XML document: %s" % e
+        root = None
+    finally:
+        if writer is not None:
+            writer.abort()
+
+        r.close()
+
+    return root
 
 
 def extractDocumentIdentifier(doc):
@@ -294,11 +622,13 @@ def extractDocumentIdentifier(doc):
     """
 
     identifier = None
+    identifier_element = doc.find(".//str[@name='identifier']")
+
+    if identifier_element is None:
+        identifier_element = doc.find(".//identifier")
 
-    if doc.find(".//str[@name='identifier']") is not None:
-        identifier = doc.find(".//str[@name='identifier']").text
-    elif doc.find(".//identifier") is not None:
-        identifier = doc.find(".//identifier").text
+    if identifier_element is not None:
+        identifier = identifier_element.text
 
     if identifier is None:
         raise Exception("Failed to add dataset because the identifier couldn't be processed.")
@@ -306,6 +636,55 @@ def extractDocumentIdentifier(doc):
     return identifier
 
 
+def docToRecord(doc):
+    """Convert a Solr result <doc> into a SolrRecord in one pass over its
+    fields.
+
+    Bounding coordinates are converted to floats and multi-valued fields
+    (resourceMap) to tuples. Dates are kept as text, e.g.
+    '2015-05-30T23:21:15.567Z'. Fields that aren't in the <doc> are None,
+    except resource_maps which is empty.
+
+    Records are what dataset jobs carry (they pickle to a fraction of the
+    size of an Element) and what Interface.addDataset works from.
+
+    Returns: SolrRecord
+    """
+
+    values = dict([(name, None) for name in SolrRecord._fields])
+    values['resource_maps'] = ()
+
+    for field in doc:
+        name = SOLR_RECORD_FIELDS.get(field.get('name'))
+
+        if name is None:
+            continue
+
+        if field.tag == 'arr':
+            values[name] = tuple([value.text for value in field])
+        elif field.tag == 'float':
+            values[name] = float(field.text)
+        else:
+            values[name] = field.text
+
+    return SolrRecord(**values)
+
+
+def formatFieldValue(value):
+    """Format a SolrRecord value as the text of a Solr result element."""
+
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+
+    if isinstance(value, float):
+        return repr(value)
+
+    if isinstance(value, (int, long)):
+        return str(value)
+
+    return value
+
+
 def getSolrIndexFields(identifier, fields=None):
     """Gets a single document off the Solr index by searching for its identifier."""
 
@@ -317,7 +696,9 @@ def getSolrIndexFields(identifier, fields=None):
         fields = getDefaultSolrIndexFields()
 
     query_string = "http://cn.dataone.org/cn/v1/query/solr/?fl=" + ",".join(fields) + "&q=id:" + identifier_esc + "&rows=1&start=0"
-    query_xml = util.getXML(query_string)
+
+    with timing.stage('solr'):
+        query_xml = util.getXML(query_string)
 
     return query_xml.find(".//doc")
 
@@ -338,8 +719,14 @@ def getAggregatedIdentifiers(identifier):
     base_url = "https://cn.dataone.org/cn/v1/object/"
     query_url = base_url + urllib.quote_plus(identifier)
 
+    content = getDocument('object', query_url, identifier)
+
+    if content is None:
+        print "Exception: Failed to get resource map at `%s`." % query_url
+        return []
+
     try:
-        parser.parse_into_model(model, query_url)
+        parser.parse_string_into_model(model, content, RDF.Uri(query_url))
     except RDF.RedlandError as e:
         print "Exception: Failed to parse RDF/XML at `%s`: %s" % (query_url, e)
 
@@ -397,4 +784,5 @@ def getDefaultSolrIndexFields():
             "authorLastName", "origin","submitter","rightsHolder","documents",
             "resourceMap", "authoritativeMN","obsoletes","northBoundCoord",
             "eastBoundCoord", "southBoundCoord", "westBoundCoord", "beginDate", "endDate",
-            "datasource", "replicaMN", "resourceMap", "dataUrl", "dateModified"]
+            "datasource", "replicaMN", "resourceMap", "dataUrl", "dateModified",
+            "formatId"]
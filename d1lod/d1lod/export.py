@@ -0,0 +1,431 @@
+""" export.py
+
+    Functions for exporting the contents of a Graph to disk.
+
+    Exports page through the graph by subject and stream each page straight
+    into the output file so memory use doesn't grow with the size of the
+    graph. Each page picks up from the last subject of the one before it
+    (keyset paging) rather than using OFFSET, which Virtuoso limits to
+    MaxSortedTopRows (10000 by default) and which re-sorts the whole graph
+    for every page. Subjects are compared as IRIs, not by their string
+    values, so the store can seek to the start of each page in its index.
+    Blank node subjects can't be named in a later query, so their triples
+    are exported after every page, in a single query. Output is written to a temporary file alongside the
+    destination and renamed into place once complete so readers never see a
+    partially-written dump.
+
+    Between full dumps, changes are published as changesets. Each changeset is
+    a pair of files named after its sequence number (counting up from 1) and
+    the time it was written:
+
+        {sequence}-{timestamp}.removed.txt.gz
+            One dataset IRI per line. Every triple about these datasets (the
+            dataset, its identifiers, its digital objects, and the
+            isCreatorOf/isContactOf statements that point at it) was removed.
+
+        {sequence}-{timestamp}.added.nt.gz
+            N-Triples to add after the removals above have been applied.
+
+    The VoID file gives the sequence number of the last changeset written
+    before the full dump was started. Applying the changesets after that one,
+    in sequence order, on top of the dump brings a mirror up to date.
+"""
+
+import os
+import re
+import gzip
+import datetime
+import tempfile
+import logging
+
+# Number of subjects (and so, all of their triples) requested per page
+EXPORT_PAGE_SIZE = 1000
+
+# Suffixes of the files making up a changeset
+CHANGESET_ADDED_SUFFIX = ".added.nt.gz"
+CHANGESET_REMOVED_SUFFIX = ".removed.txt.gz"
+
+# Changeset names, e.g. 00000042-20151210T010000Z
+CHANGESET_NAME = re.compile(r"^(\d{8})-\d{8}T\d{6}Z$")
+
+# Local names that are always safe to write as a Turtle prefixed name
+SAFE_LOCAL_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_\-]*$")
+
+# Characters which must be escaped inside an IRIREF
+IRI_ESCAPES = re.compile(u'[\u0000-\u0020<>"{}|^`\\\\]')
+
+
+def exportGraph(graph, filepath, format='turtle', compress=False, page_size=EXPORT_PAGE_SIZE):
+    """Export every triple in `graph` to the file at `filepath`.
+
+    Arguments:
+        graph: d1lod.graph.Graph
+            The graph to export
+
+        filepath: str
+            Destination path. '.gz' is appended if `compress` is set and the
+            path doesn't already end with it.
+
+        format: str
+            Either 'turtle' or 'ntriples'
+
+        compress: bool
+            Whether to gzip the output
+
+        page_size: int
+            Number of subjects to request the triples of at a time
+
+    Returns:
+        The number of triples exported.
+    """
+
+    if format not in ['turtle', 'ntriples']:
+        raise Exception("Unsupported export format '%s'." % format)
+
+    if compress and not filepath.endswith('.gz'):
+        filepath += '.gz'
+
+    ns = None
+
+    if format == 'turtle':
+        ns = graph.ns
+
+    directory = os.path.dirname(os.path.abspath(filepath))
+    fd, temp_filepath = tempfile.mkstemp(prefix='.' + os.path.basename(filepath),
+                                         suffix='.tmp',
+                                         dir=directory)
+
+    num_triples = 0
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if compress:
+                out = gzip.GzipFile(filename=os.path.basename(filepath)[:-3], mode='wb', fileobj=f)
+            else:
+                out = f
+
+            try:
+                if ns is not None:
+                    for prefix in sorted(ns):
+                        out.write((u"@prefix %s: <%s> .\n" % (prefix, ns[prefix])).encode('utf-8'))
+
+                    out.write("\n")
+
+                for s, p, o in iterTriples(graph, page_size):
+                    out.write(formatTriple(s, p, o, ns).encode('utf-8'))
+                    num_triples += 1
+            finally:
+                if compress:
+                    out.close()
+
+        # mkstemp creates files only readable by their owner
+        os.chmod(temp_filepath, 0644)
+        os.rename(temp_filepath, filepath)
+    except:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+
+        raise
+
+    logging.info("Exported %d triples to %s.", num_triples, filepath)
+
+    return num_triples
+
+
+def writeChangeset(changes, directory, timestamp=None):
+    """Write a changeset into `directory`, numbered one after the latest
+    changeset already there.
+
+    Arguments:
+        changes: iterable of Dicts
+            Change records: the 'dataset' IRI, whether its triples were
+            'removed', and the 'added' triples (as N-Triples lines). Each
+            dataset should appear at most once.
+
+        directory: str
+            Directory changesets are published in
+
+        timestamp: datetime.datetime
+            (optional) Time to name the changeset after. Defaults to now (UTC).
+
+    Returns:
+        List of the filenames written or an empty list if there were no
+        changes.
+    """
+
+    if timestamp is None:
+        timestamp = datetime.datetime.utcnow()
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    sequence = getLatestChangesetSequence(directory) + 1
+    name = "%08d-%s" % (sequence, timestamp.strftime("%Y%m%dT%H%M%SZ"))
+    added_filename = name + CHANGESET_ADDED_SUFFIX
+    removed_filename = name + CHANGESET_REMOVED_SUFFIX
+
+    added_fd, added_temp = tempfile.mkstemp(prefix='.' + added_filename, suffix='.tmp', dir=directory)
+    removed_fd, removed_temp = tempfile.mkstemp(prefix='.' + removed_filename, suffix='.tmp', dir=directory)
+
+    num_changes = 0
+
+    try:
+        with os.fdopen(added_fd, 'wb') as added_file, os.fdopen(removed_fd, 'wb') as removed_file:
+            added = gzip.GzipFile(filename=added_filename[:-3], mode='wb', fileobj=added_file)
+            removed = gzip.GzipFile(filename=removed_filename[:-3], mode='wb', fileobj=removed_file)
+
+            try:
+                for change in changes:
+                    num_changes += 1
+
+                    if change['removed']:
+                        removed.write(formatIRI(change['dataset']).encode('utf-8') + "\n")
+
+                    for line in change['added']:
+                        if isinstance(line, unicode):
+                            line = line.encode('utf-8')
+
+                        added.write(line + "\n")
+            finally:
+                added.close()
+                removed.close()
+
+        if num_changes == 0:
+            os.remove(added_temp)
+            os.remove(removed_temp)
+
+            return []
+
+        # Publish the removals last so a changeset is never listed without
+        # its additions
+        os.chmod(added_temp, 0644)
+        os.chmod(removed_temp, 0644)
+        os.rename(added_temp, os.path.join(directory, added_filename))
+        os.rename(removed_temp, os.path.join(directory, removed_filename))
+    except:
+        for temp_filepath in [added_temp, removed_temp]:
+            if os.path.exists(temp_filepath):
+                os.remove(temp_filepath)
+
+        raise
+
+    logging.info("Wrote changeset %s with %d change(s).", name, num_changes)
+
+    return [removed_filename, added_filename]
+
+
+def listChangesets(directory):
+    """List the names of the complete changesets in `directory`, oldest
+    first."""
+
+    if not os.path.isdir(directory):
+        return []
+
+    filenames = os.listdir(directory)
+    names = []
+
+    for filename in filenames:
+        if not filename.endswith(CHANGESET_REMOVED_SUFFIX):
+            continue
+
+        name = filename[:-len(CHANGESET_REMOVED_SUFFIX)]
+
+        if CHANGESET_NAME.match(name) and name + CHANGESET_ADDED_SUFFIX in filenames:
+            names.append(name)
+
+    return sorted(names)
+
+
+def getChangesetSequence(name):
+    """Get the sequence number of the changeset named `name`."""
+
+    return int(CHANGESET_NAME.match(name).group(1))
+
+
+def getLatestChangesetSequence(directory):
+    """Get the sequence number of the latest changeset in `directory` or 0
+    if there aren't any.
+
+    Old changesets are pruned oldest first, so the latest one is always
+    kept and numbering carries on from it."""
+
+    names = listChangesets(directory)
+
+    if len(names) == 0:
+        return 0
+
+    return getChangesetSequence(names[-1])
+
+
+def pruneChangesets(directory, keep):
+    """Delete all but the newest `keep` changesets in `directory`.
+
+    Returns:
+        The number of changesets deleted.
+    """
+
+    names = listChangesets(directory)
+
+    if len(names) <= keep:
+        return 0
+
+    stale = names[:len(names) - keep]
+
+    for name in stale:
+        os.remove(os.path.join(directory, name + CHANGESET_REMOVED_SUFFIX))
+        os.remove(os.path.join(directory, name + CHANGESET_ADDED_SUFFIX))
+
+    return len(stale)
+
+
+def iterTriples(graph, page_size=EXPORT_PAGE_SIZE):
+    """Page through every triple in `graph`, `page_size` subjects at a time,
+    in order of subject. Triples about blank nodes come last.
+
+    Returns:
+        A generator of (s, p, o) tuples of SPARQL JSON-style term dicts.
+    """
+
+    last_subject = None
+
+    while True:
+        subjects = getSubjectPage(graph, last_subject, page_size)
+
+        if len(subjects) == 0:
+            break
+
+        for triple in iterTriplesMatching(graph, formatSubjectRange(last_subject, subjects[-1])):
+            yield triple
+
+        if len(subjects) < page_size:
+            break
+
+        last_subject = subjects[-1]
+
+    for triple in iterTriplesMatching(graph, u"isBlank(?s)"):
+        yield triple
+
+
+def iterTriplesMatching(graph, subject_filter):
+    """Stream the triples in `graph` whose subjects match the SPARQL FILTER
+    expression `subject_filter`, in order.
+
+    Returns:
+        A generator of (s, p, o) tuples of SPARQL JSON-style term dicts.
+    """
+
+    query = u"""
+    SELECT ?s ?p ?o
+    WHERE {
+        GRAPH <%s> { ?s ?p ?o }
+        FILTER(%s)
+    }
+    ORDER BY ?s ?p ?o
+    """ % (graph.name, subject_filter)
+
+    for row in graph.iter_query(query, terms=True):
+        if 's' not in row or 'p' not in row or 'o' not in row:
+            continue
+
+        yield row['s'], row['p'], row['o']
+
+
+def getSubjectPage(graph, last_subject, page_size):
+    """Get the next `page_size` IRI subjects in `graph` after the IRI
+    `last_subject`, or the first ones if it's None.
+
+    Returns:
+        List of str, in order
+    """
+
+    query = u"""
+    SELECT DISTINCT ?s
+    WHERE {
+        GRAPH <%s> { ?s ?p ?o }
+        FILTER(%s)
+    }
+    ORDER BY ?s
+    LIMIT %d
+    """ % (graph.name, formatSubjectRange(last_subject), page_size)
+
+    return [row['s'] for row in graph.iter_query(query) if 's' in row]
+
+
+def formatSubjectRange(after, until=None):
+    """Format a SPARQL FILTER expression matching the IRI subjects after the
+    IRI `after` (if it isn't None) up to and including the IRI `until` (if it
+    isn't None)."""
+
+    conditions = [u"isIRI(?s)"]
+
+    if after is not None:
+        conditions.append(u"?s > %s" % formatIRI(after))
+
+    if until is not None:
+        conditions.append(u"?s <= %s" % formatIRI(until))
+
+    return u" && ".join(conditions)
+
+
+def formatTriple(s, p, o, ns=None):
+    """Format a triple of SPARQL JSON-style term dicts as a line of
+    N-Triples, or of Turtle if a dict of namespaces is given.
+    """
+
+    return u"%s %s %s .\n" % (formatTerm(s, ns), formatTerm(p, ns), formatTerm(o, ns))
+
+
+def formatTerm(term, ns=None):
+    """Format a SPARQL JSON-style term dict, i.e.
+
+        {'type': 'uri', 'value': 'http://example.org/'}
+
+    as an N-Triples term. IRIs under one of the namespaces in `ns` are
+    written as Turtle prefixed names where that's unambiguous.
+    """
+
+    term_type = term['type']
+    value = term['value']
+
+    if term_type == 'uri':
+        if ns is not None:
+            for prefix in ns:
+                if value.startswith(ns[prefix]) and SAFE_LOCAL_NAME.match(value[len(ns[prefix]):]):
+                    return u"%s:%s" % (prefix, value[len(ns[prefix]):])
+
+        return formatIRI(value)
+
+    if term_type == 'bnode':
+        return u"_:%s" % formatBlankNodeLabel(value)
+
+    literal = u'"%s"' % escapeLiteral(value)
+
+    if 'xml:lang' in term:
+        literal += u"@%s" % term['xml:lang']
+    elif 'datatype' in term:
+        literal += u"^^%s" % formatIRI(term['datatype'])
+
+    return literal
+
+
+def formatIRI(value):
+    """Format `value` as an IRIREF, escaping characters that aren't allowed."""
+
+    return u"<%s>" % IRI_ESCAPES.sub(lambda m: u"\\u%04X" % ord(m.group(0)), value)
+
+
+def formatBlankNodeLabel(value):
+    """Make a store-assigned blank node ID (e.g., nodeID://b10001) safe to
+    use as an N-Triples blank node label."""
+
+    return re.sub(r"[^A-Za-z0-9]", lambda m: "_%x_" % ord(m.group(0)), value)
+
+
+def escapeLiteral(value):
+    """Escape the characters that can't appear in a quoted N-Triples
+    literal."""
+
+    return value.replace(u'\\', u'\\\\')\
+                .replace(u'"', u'\\"')\
+                .replace(u'\n', u'\\n')\
+                .replace(u'\r', u'\\r')
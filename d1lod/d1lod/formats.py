@@ -0,0 +1,272 @@
+""" formats.py
+
+    A registry of the GeoLink URIs for the file formats DataOne knows about.
+
+    The registry is loaded from a CSV snapshot on disk, so creating one (and
+    so creating an Interface) or looking a format up never makes a network
+    request.
+
+    A snapshot is packaged with d1lod under data/ (see `make formats`) and is
+    never written at runtime. Instead, the scheduler keeps a second snapshot
+    at FORMATS_SNAPSHOT_PATH up to date by calling refreshSnapshot, which
+    fetches a fresh copy from FORMATS_URL once that snapshot is missing or
+    older than FORMATS_TTL. If the fetch fails (e.g., when running without
+    network access) the snapshot is left as it is. Registries read the
+    refreshed snapshot when there is one, fall back to the packaged copy
+    otherwise, and notice, by its modification time, when the refreshed
+    snapshot has been replaced.
+
+    FORMATS_SNAPSHOT_PATH should be writable by the scheduler and readable by
+    the workers (e.g., a shared data volume). It can be set with the
+    D1LOD_FORMATS_SNAPSHOT environment variable.
+"""
+
+import os
+import csv
+import time
+import tempfile
+import logging
+import requests
+
+FORMATS_URL = "https://raw.githubusercontent.com/ec-geolink/design/master/data/dataone/formats/formats.csv"
+FORMATS_SNAPSHOT_PATH = os.environ.get("D1LOD_FORMATS_SNAPSHOT", "/var/lib/d1lod/formats.csv")
+PACKAGED_SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data", "formats.csv")
+FORMATS_TTL = 24 * 60 * 60  # (seconds) Age after which the scheduler refreshes the snapshot
+FORMATS_TIMEOUT = 30  # (seconds)
+FORMATS_CHECK_INTERVAL = 60  # (seconds) Time between checks for a newer snapshot
+
+# The process-wide registry. See getFormatRegistry.
+REGISTRY = None
+
+
+def getFormatRegistry():
+    """Get the process-wide FormatRegistry, creating it on first use."""
+
+    global REGISTRY
+
+    if REGISTRY is None:
+        REGISTRY = FormatRegistry()
+
+    return REGISTRY
+
+
+def parseFormats(content):
+    """Parse the formats CSV.
+
+    Returns:
+        A Dict of formats, indexed by format ID.
+    """
+
+    reader = csv.DictReader(content.splitlines())
+
+    formats_map = {}
+
+    for row in reader:
+        formats_map[row['id']] = {
+            'type': row['type'],
+            'uri' : row['uri'],
+            'name': row['name']
+        }
+
+    return formats_map
+
+
+def getSnapshotAge(snapshot_path=FORMATS_SNAPSHOT_PATH):
+    """Get the age (in seconds) of the snapshot at `snapshot_path`, or None
+    if there isn't one."""
+
+    try:
+        return time.time() - os.path.getmtime(snapshot_path)
+    except (IOError, OSError):
+        return None
+
+
+def fetchFormats(url=FORMATS_URL):
+    """Fetch the formats CSV from `url`.
+
+    Returns:
+        The CSV's content, which has been checked to parse.
+    """
+
+    r = requests.get(url, timeout=FORMATS_TIMEOUT)
+
+    if r.status_code != 200:
+        raise Exception("Status was %d." % r.status_code)
+
+    formats_map = parseFormats(r.content)
+
+    if len(formats_map) == 0:
+        raise Exception("No formats were listed.")
+
+    return r.content
+
+
+def saveSnapshot(content, snapshot_path=FORMATS_SNAPSHOT_PATH):
+    """Atomically write `content` to `snapshot_path`.
+
+    Returns: None
+    """
+
+    directory = os.path.dirname(os.path.abspath(snapshot_path))
+
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, snapshot_path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        raise
+
+
+def refreshSnapshot(snapshot_path=FORMATS_SNAPSHOT_PATH, url=FORMATS_URL, ttl=FORMATS_TTL):
+    """Replace the snapshot with a fresh copy from `url` if it's missing or
+    older than `ttl`. Called periodically by the scheduler. Failures are
+    logged and the current snapshot is kept.
+
+    Returns:
+        Whether the snapshot was replaced.
+    """
+
+    age = getSnapshotAge(snapshot_path)
+
+    if age is not None and age < ttl:
+        return False
+
+    try:
+        content = fetchFormats(url)
+        saveSnapshot(content, snapshot_path)
+    except Exception, e:
+        logging.error("Failed to refresh formats snapshot %s from %s: %s", snapshot_path, url, e)
+        return False
+
+    logging.info("Refreshed formats snapshot %s from %s.", snapshot_path, url)
+
+    return True
+
+
+class FormatRegistry:
+    def __init__(self, snapshot_path=FORMATS_SNAPSHOT_PATH, fallback_path=PACKAGED_SNAPSHOT_PATH, check_interval=FORMATS_CHECK_INTERVAL):
+        """Initialize a registry from the snapshot at `snapshot_path`, or
+        from the one at `fallback_path` until there is one.
+
+        Arguments:
+        ----------
+
+        snapshot_path : str
+            Path to a CSV snapshot of the formats map, kept up to date by
+            refreshSnapshot
+
+        fallback_path : str
+            Path to a CSV snapshot of the formats map to use while there's
+            none at `snapshot_path`
+
+        check_interval : int
+            Time (in seconds) between checks for a newer snapshot
+        """
+
+        self.snapshot_path = snapshot_path
+        self.fallback_path = fallback_path
+        self.check_interval = check_interval
+
+        self.formats = {}
+        self.loaded_path = None  # Path of the loaded snapshot
+        self.modified = None  # Modification time of the loaded snapshot
+        self.checked_at = None
+
+        self.load()
+
+
+    def __str__(self):
+        return "FormatRegistry: '%s'" % self.snapshot_path
+
+
+    def __len__(self):
+        self.checkSnapshot()
+
+        return len(self.formats)
+
+
+    def __contains__(self, format_id):
+        self.checkSnapshot()
+
+        return format_id in self.formats
+
+
+    def __getitem__(self, format_id):
+        self.checkSnapshot()
+
+        return self.formats[format_id]
+
+
+    def get(self, format_id, default=None):
+        self.checkSnapshot()
+
+        return self.formats.get(format_id, default)
+
+
+    def load(self):
+        """Load the formats map from the snapshot, or from the fallback
+        snapshot if there isn't one.
+
+        Returns:
+            Whether a snapshot was loaded.
+        """
+
+        self.checked_at = time.time()
+
+        for path in [self.snapshot_path, self.fallback_path]:
+            if path is None:
+                continue
+
+            try:
+                modified = os.path.getmtime(path)
+
+                with open(path, 'rb') as f:
+                    content = f.read()
+            except (IOError, OSError):
+                continue
+
+            # Swap in the new map in one assignment so readers never see a
+            # partially built one
+            self.formats = parseFormats(content)
+            self.loaded_path = path
+            self.modified = modified
+
+            logging.info("Loaded %d formats from %s.", len(self.formats), path)
+
+            return True
+
+        if self.loaded_path is None:
+            logging.error("No formats snapshot found at %s or %s. Formats won't be recognized until the scheduler writes one (or run `make formats`).", self.snapshot_path, self.fallback_path)
+
+        return False
+
+
+    def checkSnapshot(self):
+        """Reload the snapshot if it's been written or replaced since it was
+        loaded, checking at most every `check_interval` seconds.
+
+        Returns: None
+        """
+
+        if self.checked_at is not None and time.time() - self.checked_at < self.check_interval:
+            return
+
+        self.checked_at = time.time()
+
+        try:
+            modified = os.path.getmtime(self.snapshot_path)
+        except (IOError, OSError):
+            return
+
+        if self.loaded_path != self.snapshot_path or modified != self.modified:
+            self.load()
@@ -21,12 +21,38 @@ to the Virtuoso graphs. It contains the following functionality:
 import requests
 import RDF
 import json
+import time
 import logging
+import io
 import xml.etree.ElementTree as ET
+from requests.adapters import HTTPAdapter
+
+from d1lod import metrics
+from d1lod import resilience
+from d1lod import timing
+
+# Maximum number of keep-alive connections held open to the SPARQL endpoint
+DEFAULT_POOL_SIZE = 10
+
+# Namespace of the SPARQL Query Results XML Format
+SPARQL_RESULTS_NS = '{http://www.w3.org/2005/sparql-results#}'
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+# (seconds) Timeouts for connecting to the SPARQL endpoint and for reading its
+# response. Large updates can take a while.
+SPARQL_TIMEOUT = (10, 300)
+
+# Statuses of SPARQL requests which are retried. Virtuoso also responds with a
+# 500 to malformed queries so those aren't.
+SPARQL_RETRY_STATUSES = (502, 503, 504)
+
+# Limits at which a BatchWriter sends its accumulated triples
+BATCH_MAX_BYTES = 1024 * 1024
+BATCH_MAX_TRIPLES = 10000
 
 
 class Graph:
-    def __init__(self, host, port, name, ns={}):
+    def __init__(self, host, port, name, ns={}, pool_size=DEFAULT_POOL_SIZE):
         self.name = name
         self.ns = ns
         self.host = host
@@ -37,9 +63,18 @@ class Graph:
 
         # Set aside a Session object
         # We use this when making HTTP requests to reduce overhead when making
-        # many requests during the lifetime of a Graph objects
+        # many requests during the lifetime of a Graph objects. Connections
+        # are kept alive and pooled so consecutive SPARQL requests re-use the
+        # same TCP connection to the store.
+        self.pool_size = pool_size
         self.session = requests.Session()
 
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', self.adapter)
+
+        # Number of HTTP requests sent to the SPARQL endpoint
+        self.requests_sent = 0
+
 
     def __str__(self):\
         return "Graph: '%s'" % self.name
@@ -69,7 +104,7 @@ class Graph:
                 create_query = "CREATE GRAPH <" + self.name + ">"
             else:
                 create_query = "CREATE SILENT GRAPH <" + self.name + ">"
-            sparqlResponse = self.query(query_string=create_query, accept='text/plain')
+            sparqlResponse = self.query(query_string=create_query, accept='text/plain', operation='update')
             logging.info(sparqlResponse)
         else:
             logging.info("Graph already exists!")
@@ -96,7 +131,7 @@ class Graph:
                 delete_query = "DROP GRAPH <" + self.name + ">"
             else:
                 delete_query = "DROP SILENT GRAPH <" + self.name + ">"
-            sparqlResponse = self.query(query_string=delete_query, accept='text/plain')
+            sparqlResponse = self.query(query_string=delete_query, accept='text/plain', operation='update')
             logging.info(sparqlResponse)
         else:
             logging.info("Graph does not exist!")
@@ -132,7 +167,7 @@ class Graph:
                 copy_query = u"""
                 COPY SILENT GRAPH <%s> TO GRAPH <%s>
                 """ % (self.name, target_graph_name)
-            sparqlResponse = self.query(query_string=copy_query, accept='text/plain')
+            sparqlResponse = self.query(query_string=copy_query, accept='text/plain', operation='update')
             logging.info(sparqlResponse)
         else:
             logging.info("Source Graph does not exists!")
@@ -167,7 +202,7 @@ class Graph:
                 move_query = u"""
                 MOVE SILENT GRAPH <%s> TO GRAPH <%s>
                 """ % (self.name, target_graph_name)
-            sparqlResponse = self.query(query_string=move_query, accept='text/plain')
+            sparqlResponse = self.query(query_string=move_query, accept='text/plain', operation='update')
             logging.info(sparqlResponse)
         else:
             logging.info("Source Graph does not exists!")
@@ -202,7 +237,7 @@ class Graph:
                 add_query = u"""
                 ADD SILENT GRAPH <%s> TO GRAPH <%s>
                 """ % (self.name, target_graph_name)
-            sparqlResponse = self.query(query_string=add_query, accept='text/plain')
+            sparqlResponse = self.query(query_string=add_query, accept='text/plain', operation='update')
             logging.info(sparqlResponse)
         else:
             logging.info("Source Graph does not exists!")
@@ -269,7 +304,26 @@ class Graph:
         }
         """ % (self.name, payload)
 
-        return (self.query(query_string=insert_query, blank_node=blank_node))
+        return (self.query(query_string=insert_query, blank_node=blank_node, operation='insert_data'))
+
+
+    def batch(self, max_bytes=BATCH_MAX_BYTES, max_triples=BATCH_MAX_TRIPLES):
+        """Create a BatchWriter which accumulates triples and inserts them
+        into this graph with a few large INSERT DATA requests.
+
+        Arguments:
+        ----------
+
+        max_bytes: int
+            Flush once the accumulated payload reaches this many bytes
+
+        max_triples: int
+            Flush once this many triples have accumulated
+
+        Returns: BatchWriter
+        """
+
+        return BatchWriter(self, max_bytes=max_bytes, max_triples=max_triples)
 
 
     def delete_data(self, payload='', prefix='', blank_node=False):
@@ -300,7 +354,7 @@ class Graph:
             }
         }
         """ % (self.name, payload)
-        sparqlResponse = self.query(query_string=delete_query, blank_node=blank_node)
+        sparqlResponse = self.query(query_string=delete_query, blank_node=blank_node, operation='delete_data')
         return (sparqlResponse)
 
 
@@ -327,7 +381,7 @@ class Graph:
         DROP SILENT GRAPH <%s>
         """ % (self.name)
         
-        sparqlResponse = self.query(query_string=delete_query, blank_node=blank_node)
+        sparqlResponse = self.query(query_string=delete_query, blank_node=blank_node, operation='update')
         return (sparqlResponse)
 
 
@@ -356,7 +410,7 @@ class Graph:
         return "\n".join(ns_strings)
 
 
-    def query(self, query_string, blank_node=False, accept='application/json'):
+    def query(self, query_string, blank_node=False, accept='application/json', operation='query'):
         """Execute a SPARQL QUERY against the Graph.
 
         Arguments:
@@ -368,6 +422,9 @@ class Graph:
         accept : str
             An appropriate HTTP Accept header value. Defaults to JSON.
 
+        operation : str
+            Kind of request, for metrics (e.g., 'query' or 'insert_data')
+
         formatResponse: boolean
             A boolean value indicating the formatting requirements of the results.
 
@@ -378,20 +435,22 @@ class Graph:
         prefix = self.namespacePrefixString()
 
         results = {}
-        endpoint = self.endpoints['sparql']
         params = {
             'query': prefix + "\n" + query_string
         }
 
-        r = self.session.post(endpoint, params=params, auth=('dba', 'dev.nceas'),headers={'Connection':'close'})
+        r = self.post(operation=operation, params=params, auth=('dba', 'dev.nceas'))
 
         logging.info(prefix + "\n" + query_string)
 
+        # Raise rather than return no results so callers can't mistake a
+        # failure for a negative answer (e.g., and mint a duplicate person)
         if r.status_code != 200:
             logging.error("SPARQL QUERY failed. Status was not 200 as expected.")
             logging.error(r.status_code)
             logging.error(r.text)
             logging.error(query_string)
+            raise Exception("SPARQL QUERY failed with status %d." % r.status_code)
 
         if r.headers['Content-Type'] == "application/sparql-results+xml; charset=UTF-8":
             response_type = "xml"
@@ -407,49 +466,226 @@ class Graph:
                 logging.error("Failed to convert response to JSON.")
                 logging.error(r.status_code)
                 logging.error(r.text)
-                results = {}
+                raise Exception("Failed to convert SPARQL response to JSON.")
 
         return results
 
 
-    def processResponse(self, response_var, response_type):
-        """Process a JSON response from the Graph and create a friendlier
-        format. The format is a list of Dicts, where the names in each dict
-        match the bindings of the query.
+    def post(self, operation='query', **kwargs):
+        """POST to the SPARQL endpoint over the Graph's pooled Session.
+        Queries are retried on connection errors, timeouts and
+        SPARQL_RETRY_STATUSES (see d1lod.resilience). Anything else (e.g., an
+        update) is only retried when it couldn't connect or got one of
+        SPARQL_RETRY_STATUSES. A long update that times out may still be
+        running, and updates with blank nodes would add them twice.
+
+        Arguments:
+        ----------
+
+        operation : str
+            Kind of request, for metrics (e.g., 'query' or 'update'). Only
+            'query' requests are treated as idempotent.
+
+        kwargs:
+            Keyword arguments passed through to requests.Session.post
+
+        Returns: The requests.Response
         """
-        results = []
 
-        if response_type == "xml":
-            response_content = ET.fromstring(response_var)
+        start = time.time()
+
+        try:
+            r = resilience.request('POST', self.endpoints['sparql'],
+                                   session=self.session,
+                                   timeout=SPARQL_TIMEOUT,
+                                   retry_statuses=SPARQL_RETRY_STATUSES,
+                                   idempotent=(operation == 'query'),
+                                   **kwargs)
+        except Exception:
+            metrics.increment('d1lod_sparql_requests_total', {'operation': operation, 'status': 'error'})
+            raise
+
+        self.requests_sent += 1
+
+        metrics.increment('d1lod_sparql_requests_total', {'operation': operation, 'status': r.status_code})
+        metrics.observe('d1lod_sparql_request_duration_seconds', time.time() - start, {'operation': operation})
+
+        return r
+
+
+    def connection_stats(self):
+        """Summarize how many TCP connections were opened for the requests
+        sent so far.
+
+        Returns: A dict with the number of 'requests' sent, the number of
+        'connections' opened, and the number of requests which 'reused' an
+        already-open connection.
+        """
+
+        num_requests = 0
+        num_connections = 0
+
+        pools = self.adapter.poolmanager.pools
+
+        for key in pools.keys():
+            pool = pools[key]
+
+            if pool is None:
+                continue
+
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+
+        return {
+            'requests': num_requests,
+            'connections': num_connections,
+            'reused': max(num_requests - num_connections, 0)
+        }
+
+
+    def iter_query(self, query_string, terms=False):
+        """Execute a SPARQL SELECT query against the Graph and lazily yield
+        its results as they are read off the response stream.
+
+        Unlike query(), the response is never held in memory as a whole so
+        this is suitable for queries with very large result sets.
+
+        Arguments:
+        ----------
+
+        query_string : str
+            SPARQL query string.
+
+        terms : boolean
+            Yield each binding as a dict with 'type', 'value', and (optionally)
+            'xml:lang' or 'datatype' keys rather than just its value.
+
+        Returns: A generator of result dicts, keyed by binding name."""
+
+        prefix = self.namespacePrefixString()
+        params = {
+            'query': prefix + "\n" + query_string
+        }
+        headers = {
+            'Accept': 'application/sparql-results+xml'
+        }
+
+        r = self.post(params=params, auth=('dba', 'dev.nceas'), headers=headers, stream=True)
+
+        try:
+            # Raise rather than yield nothing so callers paging through large
+            # result sets can't mistake a failure for the end of the results
+            if r.status_code != 200:
+                logging.error("SPARQL QUERY failed. Status was not 200 as expected.")
+                logging.error(r.text)
+                logging.error(query_string)
+                raise Exception("SPARQL QUERY failed with status %d." % r.status_code)
+
+            content_type = r.headers.get('Content-Type', '')
+
+            if content_type.startswith("application/sparql-results+xml"):
+                r.raw.decode_content = True
+
+                for row in self.iter_results(r.raw, terms=terms):
+                    yield row
+
+            elif content_type.startswith("application/sparql-results+json"):
+                # The json module can't parse incrementally so fall back to
+                # reading the whole response
+                response = r.json()
+
+                for binding in response['results']['bindings']:
+                    row = {}
+
+                    for name in binding:
+                        if terms:
+                            row[name] = binding[name]
+                        else:
+                            row[name] = binding[name]['value']
+
+                    yield row
+
+            else:
+                raise Exception("Unexpected Content-Type '%s' in SPARQL response." % content_type)
+        finally:
+            r.close()
+
+
+    def iter_results(self, source, terms=False):
+        """Incrementally parse a document in the SPARQL Query Results XML
+        Format, yielding a dict for each <result>. Each <result> is discarded
+        once it has been yielded so memory use stays constant.
+
+        Arguments:
+        ----------
+
+        source : file-like object
+            The XML document.
+
+        terms : boolean
+            See iter_query.
+
+        Returns: A generator of result dicts, keyed by binding name."""
+
+        results_element = None
 
-            xml_result_element = []
-            xml_results_element = None
-            xml_result = []
+        for event, element in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if element.tag == SPARQL_RESULTS_NS + 'results':
+                    results_element = element
 
-            for child in response_content:
-                if child.tag == '{http://www.w3.org/2005/sparql-results#}head':
-                    xml_head_element = child
-                elif child.tag == '{http://www.w3.org/2005/sparql-results#}results':
-                    xml_results_element = child
+                continue
+
+            if element.tag != SPARQL_RESULTS_NS + 'result':
+                continue
+
+            row = {}
+
+            for binding in element:
+                if len(binding) == 0:
+                    continue
+
+                term = binding[0]
+
+                if terms:
+                    row[binding.get('name')] = self.parseTerm(term)
                 else:
-                    pass
+                    row[binding.get('name')] = term.text
+
+            yield row
+
+            if results_element is not None:
+                results_element.clear()
+
+
+    def parseTerm(self, element):
+        """Convert a <uri>, <literal>, or <bnode> element from a SPARQL XML
+        result into a dict in the style of the SPARQL JSON results format.
+        """
+
+        term = {
+            'type': element.tag.replace(SPARQL_RESULTS_NS, ''),
+            'value': element.text if element.text is not None else ''
+        }
+
+        if element.get(XML_LANG) is not None:
+            term['xml:lang'] = element.get(XML_LANG)
+
+        if element.get('datatype') is not None:
+            term['datatype'] = element.get('datatype')
 
-            for child in xml_results_element:
-                if child.tag == '{http://www.w3.org/2005/sparql-results#}result':
-                    xml_result_element.append(child)
+        return term
 
-            xml_result = []
-            for result in xml_result_element:
-                for binding in result:
-                    xml_result_dict = {}
-                    binding_key = binding.attrib["name"]
-                    binding_val = None
-                    for uri in binding:
-                        binding_val = uri.text
-                    xml_result_dict[binding_key] = binding_val
-                    xml_result.append(xml_result_dict)
 
-            results = xml_result
+    def processResponse(self, response_var, response_type):
+        """Process a JSON response from the Graph and create a friendlier
+        format. The format is a list of Dicts, where the names in each dict
+        match the bindings of the query.
+        """
+        results = []
+
+        if response_type == "xml":
+            results = list(self.iter_results(io.BytesIO(response_var)))
 
         else:
             response = response_var
@@ -489,7 +725,7 @@ class Graph:
             return "<%s>" % str(term)
 
 
-    def update(self, query_string):
+    def update(self, query_string, operation='update'):
         """Execute a SPARQL UPDATE query against the graph.
 
         Arguments:
@@ -497,6 +733,9 @@ class Graph:
 
         query_string : str
             SPARQL query string.
+
+        operation : str
+            Kind of request, for metrics (e.g., 'update' or 'insert_data')
             
         Returns: HTTP response from the database
         """
@@ -508,7 +747,7 @@ class Graph:
 
         endpoint = self.endpoints['sparql']
 
-        r = self.session.post(endpoint, data={'update': query_string.strip()},headers={'Connection':'close'})
+        r = self.post(operation=operation, data={'update': query_string.strip()})
 
         if r.status_code != requests.codes.ok:
             logging.error("SPARQL UPDATE failed. Status was not 201 as expected.")
@@ -628,10 +867,172 @@ class Graph:
         """
         query_string = u"""ASK WHERE { GRAPH <%s> { } }""" % (self.name)
 
-        endpoint = self.endpoints['sparql']
         params = {
             'query': query_string
         }
 
-        sparqlResponse = self.session.post(endpoint, params=params, auth=('dba', 'dev.nceas'),headers={'Connection':'close'})
+        sparqlResponse = self.post(params=params, auth=('dba', 'dev.nceas'))
         return sparqlResponse.content
+
+
+
+class BatchWriter:
+    """Accumulates triples, possibly from many datasets, and writes them into
+    a Graph as INSERT DATA requests sent in the body of a POST.
+
+    Triples are added in groups (e.g., all of the triples for one dataset).
+    A group is never split across two requests because blank node labels are
+    only meaningful within a single request. A group may also carry triples
+    for other named graphs, which are written in the same request, and update
+    operations (e.g., deleting the previous version of a dataset) which are
+    run in the same request before anything is inserted.
+    """
+
+    def __init__(self, graph, max_bytes=BATCH_MAX_BYTES, max_triples=BATCH_MAX_TRIPLES):
+        self.graph = graph
+        self.max_bytes = max_bytes
+        self.max_triples = max_triples
+
+        self.triples = []
+        self.num_bytes = 0
+
+        # Triples for named graphs other than self.graph, indexed by name
+        self.other_triples = {}
+
+        # Update operations run before the INSERT DATA
+        self.deletes = []
+
+        # Number of INSERT DATA requests sent
+        self.flushes = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+
+    def __len__(self):
+        return len(self.triples) + sum([len(triples) for triples in self.other_triples.values()])
+
+
+    def add(self, triples, other_graphs=None, deletes=None):
+        """Add a group of triples to the batch, flushing first if the group
+        would push the batch over its limits.
+
+        Arguments:
+        ----------
+
+        triples: List(str)
+            Triples formatted for a SPARQL query (i.e., '<s> <p> "o"')
+
+        other_graphs: Dict
+            (optional) Lists of triples for other named graphs, indexed by
+            graph name
+
+        deletes: List(str)
+            (optional) SPARQL Update operations, e.g. DELETE WHERE { ... }
+
+        Returns: None
+        """
+
+        if triples is None:
+            triples = []
+
+        if other_graphs is None:
+            other_graphs = {}
+
+        if deletes is None:
+            deletes = []
+
+        group = [triples] + other_graphs.values()
+        group_triples = sum([len(group_part) for group_part in group])
+
+        if group_triples == 0 and len(deletes) == 0:
+            return
+
+        group_bytes = sum([len(operation) + 3 for operation in deletes])
+
+        for group_part in group:
+            for triple in group_part:
+                if isinstance(triple, unicode):
+                    group_bytes += len(triple.encode('utf-8'))
+                else:
+                    group_bytes += len(triple)
+
+                group_bytes += 3  # " .\n"
+
+        if (len(self) > 0 or len(self.deletes) > 0) and \
+                (self.num_bytes + group_bytes > self.max_bytes or
+                 len(self) + group_triples > self.max_triples):
+            self.flush()
+
+        self.deletes.extend(deletes)
+        self.triples.extend(triples)
+
+        for name, other_triples in other_graphs.iteritems():
+            if len(other_triples) > 0:
+                self.other_triples.setdefault(name, []).extend(other_triples)
+
+        self.num_bytes += group_bytes
+
+        if self.num_bytes >= self.max_bytes or len(self) >= self.max_triples:
+            self.flush()
+
+
+    def flush(self):
+        """Send all accumulated update operations and triples to the graph in
+        one request.
+
+        Returns: HTTP response from the database or None if there was nothing
+        to send.
+        """
+
+        num_triples = len(self)
+        deletes = self.deletes
+
+        if num_triples == 0 and len(deletes) == 0:
+            return None
+
+        graphs = [(self.graph.name, self.triples)] + sorted(self.other_triples.items())
+        blocks = []
+
+        for name, triples in graphs:
+            if len(triples) == 0:
+                continue
+
+            # Redland serializes statements as UTF-8 encoded strs
+            triples = [t.decode('utf-8') if isinstance(t, str) else t for t in triples]
+
+            blocks.append(u"""
+            GRAPH <%s>
+            {
+                %s
+            }""" % (name, " .\n ".join(triples)))
+
+        self.triples = []
+        self.other_triples = {}
+        self.deletes = []
+        self.num_bytes = 0
+
+        operations = list(deletes)
+
+        if len(blocks) > 0:
+            operations.append(u"""
+        INSERT DATA
+        {%s
+        }
+        """ % "".join(blocks))
+
+        logging.info("Flushing batch of %d update operation(s) and %d triples.", len(deletes), num_triples)
+        with timing.stage('write'):
+            r = self.graph.update(u" ;\n".join(operations), operation='insert_data')
+        self.flushes += 1
+
+        if r.status_code != requests.codes.ok:
+            raise Exception("Batch update of %d triples failed with status %d." % (num_triples, r.status_code))
+
+        return r
@@ -24,13 +24,51 @@ http://docs.s4.ontotext.com/display/S4docs/Fully+Managed+Database#FullyManagedDa
 
 import urllib
 import uuid
+import hashlib
 import re
+import time
+import decimal
 import RDF
 import logging
+from dateutil import parser, tz
 
-import dataone, validator, util
+import dataone, validator, util, cache, export, formats, timing
 from d1lod.people import processing
 
+# Number of person and organization URIs remembered between lookups
+URI_CACHE_SIZE = 10000
+
+# The match key index lives in a named graph alongside the main graph, e.g.
+# <geolink/matchkeys>, and holds one statement per person or organization:
+#
+#     <http://dataone.org/person/urn:uuid:...> d1lod:matchKey "person|Alpha|alpha@example.org"
+#
+# MATCH_KEY_INDEX_COMPLETE is asserted about the index graph once it has been
+# rebuilt from the main graph. Until then, lookups that miss the index fall
+# back to querying the main graph.
+MATCH_KEY_GRAPH_SUFFIX = "/matchkeys"
+MATCH_KEY_PREDICATE = "http://dataone.org/matchKey"
+MATCH_KEY_INDEX_COMPLETE = "http://dataone.org/matchKeyIndexComplete"
+MATCH_KEY_INDEX_CHECK_INTERVAL = 60  # (seconds) Time between checks while the index isn't complete
+
+# In diff mode, identifiers and digital objects get skolem IRIs under this
+# base instead of blank nodes. Their names are derived from the identifiers
+# they describe so re-adding an unchanged dataset produces the same triples.
+SKOLEM_BASE = "http://dataone.org/.well-known/genid/"
+
+# Graphs (by host, port, and name) this process has written the fixed
+# statements into. See writeTriples.
+FIXTURES_WRITTEN = set()
+
+# Typed literals whose values, rather than their lexical forms, are compared
+# when diffing a dataset (e.g., the graph may give back
+# "2015-05-30T23:21:15.567Z" as "2015-05-30T23:21:15.567+00:00"). See
+# normalizeTerm.
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+DATETIME_TYPES = [XSD + 'dateTime']
+DECIMAL_TYPES = [XSD + name for name in ['decimal', 'integer', 'int', 'long', 'short', 'nonNegativeInteger', 'positiveInteger']]
+FLOAT_TYPES = [XSD + 'double', XSD + 'float']
+
 # Default namespaces
 NAMESPACES = {
     'owl': 'http://www.w3.org/2002/07/owl#',
@@ -50,7 +88,7 @@ NAMESPACES = {
 
 
 class Interface:
-    def __init__(self, graph):
+    def __init__(self, graph, uri_cache_size=URI_CACHE_SIZE, diff=False):
         """Initialize a graph with the given name.
 
         Parameters:
@@ -58,30 +96,54 @@ class Interface:
 
         graph : str
             The name of the graph.
+
+        uri_cache_size : int
+            Number of person and organization URIs to remember between
+            lookups
+
+        diff : bool
+            Whether to update datasets that are already in the graph by
+            writing only the triples that changed (see insertModelDifference)
         """
 
         self.graph = graph
+        self.diff = diff
 
-        # Load the formats map
-        self.formats = util.loadFormatsMap()
+        # The formats map is shared by every Interface in the process
+        self.formats = formats.getFormatRegistry()
 
         # Set up the temporary model which accumulates triples when addDataset
         # is called
         self.model = None
 
-        # Synchronize the newly added namespaces to the Graph object
-        # for faster referencing
-        self.graph.ns = NAMESPACES
+        # Optional d1lod.graph.BatchWriter. When set, insertModel hands the
+        # model's triples to the writer instead of inserting them right away
+        self.writer = None
 
-        # Add fixed statements
-        #
-        # Note: These are inserted regardless of whether or not they already
-        # exist
+        # URIs minted for people and organizations whose triples have been
+        # handed to writeTriples but aren't in the graph yet (e.g., are
+        # sitting in the writer). Keyed by match key.
+        self.minted = {}
 
-        prov = self.graph.ns['prov']
-        owl = self.graph.ns['owl']
+        # Person and organization URIs known to be in the graph, keyed by
+        # match key (see personMatchKey and organizationMatchKey)
+        self.uri_cache = cache.LRUCache(uri_cache_size)
 
-        self.graph.insert(RDF.Uri(prov+'wasRevisionOf'), RDF.Uri(owl+'inverseOf'), RDF.Uri(prov+'hadRevision'))
+        # People and organizations linked to recently added datasets, indexed
+        # by dataset URI (see rememberDatasetAgents)
+        self.dataset_agents = cache.LRUCache(uri_cache_size)
+
+        # URIs minted for the dataset being added, whose triples (and match
+        # keys) haven't been handed to writeTriples yet. Discarded if the
+        # dataset fails. Keyed by match key.
+        self.unindexed = {}
+        self.match_key_graph = self.graph.name + MATCH_KEY_GRAPH_SUFFIX
+        self.match_key_index_complete = False
+        self.match_key_index_checked_at = None
+
+        # Synchronize the newly added namespaces to the Graph object
+        # for faster referencing
+        self.graph.ns = NAMESPACES
 
 
     def __str__(self):
@@ -160,10 +222,17 @@ class Interface:
         self.model = model
 
 
-    def insertModel(self):
+    def insertModel(self, deletes=None):
         """Inserts the current RDF Model (if it exists) into the graph and
         deletes it if successful.
-        
+
+        Arguments:
+        ----------
+
+        deletes : List(str)
+            (optional) SPARQL Update operations to run in the same request,
+            before the model is inserted (e.g., from deleteDatasetOperations)
+
         Returns: None
         """
 
@@ -171,24 +240,401 @@ class Interface:
             logging.info("Attempted to insert a model that was None.")
             return
 
-        # checking for all the statements in the current model
-        # if either subject / object / predicate is a blank node - then indicate that the payload contains a blank node
-        blank_node = False
-        for s in self.model:
-            blank_node = self.tripleHasBlankNode(s.subject, s.predicate, s.object)
-            if blank_node == True:
-                break
-
-        sparql_data = " .\n ".join([str(s) for s in self.model])
-
         # Log model size
         logging.info('Inserting model of size %d.', self.model.size())
 
-        self.graph.insert_data(payload=sparql_data, blank_node=blank_node)
-        
+        self.writeTriples([str(s) for s in self.model], deletes)
+
         return
 
 
+    def insertModelDifference(self, dataset, deletes):
+        """Update the graph's copy of `dataset` to match the current RDF
+        Model by deleting and inserting only the triples that differ.
+
+        The triples compared are the ones deleteDatasetOperations would
+        delete. The model's other triples (those describing its people and
+        organizations) are always inserted. If the graph's copy of the
+        dataset has blank nodes (i.e., it was added before skolem IRIs were
+        used) it can't be compared so it is replaced with `deletes` instead.
+
+        Arguments:
+        ----------
+
+        dataset : RDF.Uri
+            The dataset the model describes
+
+        deletes : List(str)
+            SPARQL Update operations which delete the dataset
+
+        Returns: None
+        """
+
+        if self.model is None:
+            logging.info("Attempted to insert a model that was None.")
+            return
+
+        # Triples as the graph has them, indexed by tripleKey
+        current = {}
+        has_blank_nodes = False
+
+        with timing.stage('diff'):
+            for s, p, o in self.iterDatasetTriples(dataset):
+                if s['type'] == 'bnode' or o['type'] == 'bnode':
+                    has_blank_nodes = True
+                    break
+
+                current[self.tripleKey(s, p, o)] = self.formatTriple(s, p, o)
+
+        if has_blank_nodes:
+            logging.info("Dataset %s has blank nodes. Replacing it instead of comparing.", dataset)
+            self.insertModel(deletes)
+            return
+
+        scoped, unscoped = self.splitDatasetTriples(dataset)
+
+        # Deletes use the graph's form of the triple so they match it
+        removed = [current[key] for key in current if key not in scoped]
+        added = [scoped[key] for key in scoped if key not in current]
+
+        logging.info("Updating dataset %s: %d triple(s) removed, %d added, %d unchanged.", dataset, len(removed), len(added), len(scoped) - len(added))
+
+        operations = []
+
+        if len(removed) > 0:
+            operations.append(u"DELETE DATA { GRAPH <%s> { %s } }" % (self.graph.name, u" .\n".join(sorted(removed))))
+
+        self.writeTriples(added + unscoped, operations)
+
+
+    def writeTriples(self, triples, deletes=None):
+        """Write triples into the graph (or the current batch) along with the
+        match keys of newly minted people and organizations, which go in the
+        same request so the index can't miss them.
+
+        Returns: None
+        """
+
+        other_graphs = {self.match_key_graph: self.matchKeyIndexTriples(self.unindexed)}
+
+        # The fixed statements go along with the first triples this process
+        # writes into the graph rather than costing a request of their own
+        fixtures_key = (self.graph.host, self.graph.port, self.graph.name)
+
+        if fixtures_key not in FIXTURES_WRITTEN:
+            triples = self.fixtureTriples() + triples
+
+        if self.writer is not None:
+            self.writer.add(triples, other_graphs, deletes)
+        else:
+            writer = self.graph.batch()
+            writer.add(triples, other_graphs, deletes)
+            writer.flush()
+
+        FIXTURES_WRITTEN.add(fixtures_key)
+
+        # Only now can later datasets (e.g., in the same batch) link to them
+        self.minted.update(self.unindexed)
+        self.unindexed = {}
+
+
+    def fixtureTriples(self):
+        """Statements that should always be in the graph, regardless of which
+        datasets are.
+
+        Returns:
+            List of triples formatted for a SPARQL query
+        """
+
+        prov = self.graph.ns['prov']
+        owl = self.graph.ns['owl']
+
+        return [u"<%swasRevisionOf> <%sinverseOf> <%shadRevision>" % (prov, owl, prov)]
+
+
+    def iterDatasetTriples(self, dataset):
+        """Get the dataset's triples currently in the graph. These are the
+        triples deleteDatasetOperations would delete.
+
+        Returns:
+            A generator of (s, p, o) tuples of SPARQL JSON-style term dicts.
+        """
+
+        query = u"""
+        SELECT ?s ?p ?o
+        WHERE {
+            GRAPH <%(graph)s>
+            {
+                { <%(dataset)s> ?p ?o . BIND(<%(dataset)s> AS ?s) }
+                UNION
+                { <%(dataset)s> geolink:hasIdentifier ?s . ?s ?p ?o }
+                UNION
+                { <%(dataset)s> geolink:hasPart ?s . ?s ?p ?o }
+                UNION
+                { ?digital_object geolink:isPartOf <%(dataset)s> .
+                  ?digital_object geolink:hasIdentifier ?s .
+                  ?s ?p ?o }
+                UNION
+                { ?s geolink:isCreatorOf <%(dataset)s> .
+                  BIND(geolink:isCreatorOf AS ?p) BIND(<%(dataset)s> AS ?o) }
+                UNION
+                { ?s geolink:isContactOf <%(dataset)s> .
+                  BIND(geolink:isContactOf AS ?p) BIND(<%(dataset)s> AS ?o) }
+            }
+        }
+        """ % {'graph': self.graph.name, 'dataset': dataset}
+
+        for row in self.graph.iter_query(query, terms=True):
+            if 's' in row and 'p' in row and 'o' in row:
+                yield row['s'], row['p'], row['o']
+
+
+    def iterChangeTriples(self, dataset):
+        """Get the triples a changeset publishes for the dataset: the
+        dataset's own (see iterDatasetTriples) followed by those describing
+        its creators and contacts and the organizations they're affiliated
+        with. The agents' links to other datasets are left out.
+
+        Returns:
+            A generator of (s, p, o) tuples of SPARQL JSON-style term dicts.
+        """
+
+        for triple in self.iterDatasetTriples(dataset):
+            yield triple
+
+        query = u"""
+        SELECT DISTINCT ?s ?p ?o
+        WHERE {
+            GRAPH <%(graph)s>
+            {
+                {
+                    { ?s geolink:isCreatorOf <%(dataset)s> }
+                    UNION
+                    { ?s geolink:isContactOf <%(dataset)s> }
+                }
+                UNION
+                {
+                    { ?agent geolink:isCreatorOf <%(dataset)s> }
+                    UNION
+                    { ?agent geolink:isContactOf <%(dataset)s> }
+                    ?agent geolink:hasAffiliation ?s
+                }
+                ?s ?p ?o .
+                FILTER(?p != geolink:isCreatorOf && ?p != geolink:isContactOf)
+            }
+        }
+        """ % {'graph': self.graph.name, 'dataset': dataset}
+
+        for row in self.graph.iter_query(query, terms=True):
+            if 's' in row and 'p' in row and 'o' in row:
+                yield row['s'], row['p'], row['o']
+
+
+    def splitDatasetTriples(self, dataset):
+        """Split the current model's triples into those about the dataset
+        (see iterDatasetTriples) and the rest.
+
+        Returns:
+            (Dict, List) of triples formatted for a SPARQL query, the former
+            indexed by tripleKey
+        """
+
+        dataset = str(dataset)
+        has_identifier = self.graph.ns['geolink'] + 'hasIdentifier'
+        has_part = self.graph.ns['geolink'] + 'hasPart'
+        agent_predicates = [self.graph.ns['geolink'] + 'isCreatorOf',
+                            self.graph.ns['geolink'] + 'isContactOf']
+
+        triples = [(self.termDict(st.subject), self.termDict(st.predicate), self.termDict(st.object)) for st in self.model]
+
+        # The dataset, its identifier and digital objects, and their identifiers
+        subjects = set([dataset])
+
+        for s, p, o in triples:
+            if s['value'] == dataset and p['value'] in [has_identifier, has_part]:
+                subjects.add(o['value'])
+
+        for s, p, o in triples:
+            if s['value'] in subjects and p['value'] == has_identifier:
+                subjects.add(o['value'])
+
+        scoped = {}
+        unscoped = []
+
+        for s, p, o in triples:
+            triple = self.formatTriple(s, p, o)
+
+            if s['value'] in subjects or (p['value'] in agent_predicates and o['value'] == dataset):
+                scoped[self.tripleKey(s, p, o)] = triple
+            else:
+                unscoped.append(triple)
+
+        return scoped, unscoped
+
+
+    def termDict(self, node):
+        """Convert an RDF.Node into a SPARQL JSON-style term dict so it can
+        be compared with query results."""
+
+        if node.is_resource():
+            return {'type': 'uri', 'value': str(node.uri).decode('utf-8')}
+
+        if node.is_blank():
+            return {'type': 'bnode', 'value': node.blank_identifier}
+
+        literal = node.literal_value
+        value = literal['string']
+
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+
+        term = {'type': 'literal', 'value': value}
+
+        if literal['language']:
+            term['xml:lang'] = literal['language']
+        elif literal['datatype'] is not None:
+            term['datatype'] = str(literal['datatype']).decode('utf-8')
+
+        return term
+
+
+    def formatTriple(self, s, p, o):
+        """Format a triple of term dicts in the canonical form used to
+        compare triples."""
+
+        return u"%s %s %s" % (export.formatTerm(s), export.formatTerm(p), export.formatTerm(o))
+
+
+    def tripleKey(self, s, p, o):
+        """Format a triple of term dicts for comparison, i.e. with its typed
+        literals in a canonical form (see normalizeTerm) so two triples with
+        the same value compare equal however the value was written."""
+
+        return self.formatTriple(s, p, self.normalizeTerm(o))
+
+
+    def normalizeTerm(self, term):
+        """Rewrite a typed literal term dict's value in a canonical form:
+        xsd:dateTimes in UTC (those without a timezone are taken to be in
+        UTC) and numbers as their value. Other terms, and literals which
+        don't parse as their datatype, are returned as they are.
+
+        Returns:
+            A term dict
+        """
+
+        datatype = term.get('datatype')
+
+        if term['type'] == 'uri' or datatype is None:
+            return term
+
+        value = term['value']
+
+        try:
+            if datatype in DATETIME_TYPES:
+                parsed = parser.parse(value)
+
+                if parsed.tzinfo is not None:
+                    parsed = parsed.astimezone(tz.tzutc()).replace(tzinfo=None)
+
+                value = parsed.isoformat() + 'Z'
+            elif datatype in DECIMAL_TYPES:
+                value = unicode(decimal.Decimal(value.strip()).normalize())
+            elif datatype in FLOAT_TYPES:
+                value = repr(float(value))
+            else:
+                return term
+        except (ValueError, TypeError, OverflowError, decimal.InvalidOperation):
+            return term
+
+        normalized = dict(term)
+        normalized['value'] = value
+
+        return normalized
+
+
+    def skolemize(self, *parts):
+        """Create a skolem IRI named after `parts`, e.g. the identifier of the
+        digital object it stands for.
+
+        Returns: RDF.Uri
+        """
+
+        name = u"|".join([part.decode('utf-8') if isinstance(part, str) else unicode(part) for part in parts])
+
+        return RDF.Uri(SKOLEM_BASE + hashlib.sha1(name.encode('utf-8')).hexdigest())
+
+
+    def beginBatch(self, max_bytes=None, max_triples=None):
+        """Start accumulating the triples of subsequently added datasets into
+        a BatchWriter rather than inserting each dataset on its own.
+
+        Returns: d1lod.graph.BatchWriter
+        """
+
+        if self.writer is not None:
+            raise Exception("beginBatch was called while a batch was already in progress.")
+
+        kwargs = {}
+
+        if max_bytes is not None:
+            kwargs['max_bytes'] = max_bytes
+
+        if max_triples is not None:
+            kwargs['max_triples'] = max_triples
+
+        self.writer = self.graph.batch(**kwargs)
+        self.minted = {}
+
+        return self.writer
+
+
+    def endBatch(self):
+        """Flush and detach the current BatchWriter.
+
+        Returns: None
+        """
+
+        if self.writer is None:
+            return
+
+        try:
+            self.writer.flush()
+            self.cacheMintedURIs()
+        finally:
+            self.writer = None
+            self.minted = {}
+
+        return
+
+
+    def rememberMintedURI(self, key, uri):
+        """Remember a newly minted person or organization URI so its match
+        key gets indexed and later lookups find it before its triples are in
+        the graph. Until the current dataset's triples are written (see
+        writeTriples) only lookups for that dataset do.
+
+        Returns: None
+        """
+
+        uri = self.prepareTerm(uri)
+
+        self.unindexed[key] = uri
+
+
+    def cacheMintedURIs(self):
+        """Move the URIs minted since the last insert into the URI cache now
+        that their triples are in the graph.
+
+        Returns: None
+        """
+
+        for key, uri in self.minted.iteritems():
+            self.uri_cache.put(key, uri)
+
+        self.minted = {}
+
+
     def add(self, s, p, o):
         """Adds a triple to the current model.
 
@@ -402,43 +848,73 @@ class Interface:
         identifier : str
             Non-urlencoded DataOne identifier
 
-        doc : XML Element
-            An XML element containing a result from the Solr index which
-            contains a number of fields relating to a dataset.
+        doc : XML Element | dataone.SolrRecord
+            A result from the Solr index which contains a number of fields
+            relating to a dataset, either as the XML element or already
+            converted with dataone.docToRecord. Fetched from Solr if not
+            given.
 
-        Returns: None
+        Returns:
+        --------
+
+        Dict
+            A record of the change that was made: the 'dataset' URI and
+            whether its previous triples were 'removed' (always, since the
+            dataset is replaced whether or not it existed). The triples that
+            were added are read back out of the graph when the change is
+            published (see iterChangeTriples).
         """
 
         if self.model is not None:
             raise Exception("Model existed when addDataset was called. This means the last Model wasn't cleaned up after finishing.")
 
+        # Forget URIs minted for a previous dataset that failed before its
+        # triples were written
+        if self.writer is None:
+            self.minted = {}
+
+        self.unindexed = {}
+
         self.createModel()
 
         # Get Solr fields if they weren't passed in
         if doc is None:
             doc = dataone.getSolrIndexFields(identifier)
 
-        identifier = dataone.extractDocumentIdentifier(doc)
+        if isinstance(doc, dataone.SolrRecord):
+            solr_record = doc
+        else:
+            solr_record = dataone.docToRecord(doc)
+
+        if solr_record.identifier is None:
+            raise Exception("Failed to add dataset because the identifier couldn't be processed.")
+
+        identifier = solr_record.identifier
         identifier_esc = urllib.unquote(identifier).decode('utf8')
 
         dataset_node = RDF.Uri(self.graph.ns['d1dataset'] + identifier_esc)
 
         self.add(dataset_node, 'rdf:type', 'geolink:Dataset')
 
-        # Delete if dataset is already in graph
-        if self.datasetExists(identifier):
-            logging.info("Dataset with identifier %s already exists. Deleting then re-adding.", identifier)
-            self.deleteDataset(identifier)
+        # Replace whatever is in the graph for this dataset. Its triples are
+        # deleted in the same request that inserts the new ones.
+        deletes = self.deleteDatasetOperations(identifier)
+        self.uncacheDatasetAgents(dataset_node)
+
+        # Only the parts of the science metadata creators are extracted from
+        # are kept (see dataone.streamScientificMetadata)
+        with timing.stage('scimeta'):
+            scimeta = dataone.streamScientificMetadata(identifier, solr_record.format_id)
 
-        scimeta = dataone.getScientificMetadata(identifier)
-        records = processing.extractCreators(identifier, scimeta)
+        with timing.stage('extract'):
+            records = processing.extractCreators(identifier, scimeta, solr_record.format_id)
 
         vld = validator.Validator()
 
         # Add Dataset triples first, we'll use them when we add people
         # to match to existing people by the current dataset's 'obsoletes' field
 
-        self.addDatasetTriples(dataset_node, doc)
+        self.addDatasetTriples(dataset_node, solr_record)
 
         # Add people and organizations
         people = [p for p in records if 'type' in p and p['type'] == 'person']
@@ -446,24 +922,43 @@ class Interface:
 
         # Always do organizations first, so peoples' organization URIs exist
         for organization in organizations:
-            organization = vld.validate(organization)
+            with timing.stage('validate'):
+                organization = vld.validate(organization)
+
             self.addOrganization(organization)
 
         for person in people:
-            person = vld.validate(person)
+            with timing.stage('validate'):
+                person = vld.validate(person)
+
             self.addPerson(person)
 
         # Commit or reject the model here
         if self.model is None:
             raise Exception("Model was None. It should have been an RDF.Model.")
 
-        self.insertModel()
+        change = {
+            'dataset': str(dataset_node),
+            'removed': True
+        }
+
+        self.rememberDatasetAgents(dataset_node)
+
+        if self.diff:
+            self.insertModelDifference(dataset_node, deletes)
+        else:
+            self.insertModel(deletes)
+
         self.model = None  # Remove the model since we're done
-        
-        return
 
+        # Batched triples aren't in the graph until the writer flushes
+        if self.writer is None:
+            self.cacheMintedURIs()
+
+        return change
 
-    def addDatasetTriples(self, dataset_node, doc):
+
+    def addDatasetTriples(self, dataset_node, record):
         """Adds a dataset triples to the RDF model
 
         Parameters:
@@ -471,65 +966,55 @@ class Interface:
         dataset_node : str
             The corresponding dataset node to be used to associate the properties in the model
 
-        doc : XML Element
-            An XML element containing a result from the Solr index which
-            contains a number of fields relating to a dataset.
+        record : dataone.SolrRecord
+            The dataset's fields from the Solr index (see
+            dataone.docToRecord)
 
         Returns: None
         """
         if self.model is None:
             raise Exception("Model not found.")
 
-        identifier = dataone.extractDocumentIdentifier(doc)
+        identifier = record.identifier
         identifier_esc = urllib.unquote(identifier).decode('utf8')
 
         # type Dataset
         self.add(dataset_node, 'rdf:type', 'geolink:Dataset')
 
         # Title
-        title_element = doc.find("./str[@name='title']")
-
-        if title_element is not None:
-            self.add(dataset_node, 'rdfs:label', RDF.Node(title_element.text))
+        if record.title is not None:
+            self.add(dataset_node, 'rdfs:label', RDF.Node(record.title))
 
         # Add geolink:Identifier
         self.addIdentifierTriples(dataset_node, identifier)
 
         # Abstract
-        abstract_element = doc.find("./str[@name='abstract']")
-
-        if abstract_element is not None:
-            self.add(dataset_node, 'geolink:description', RDF.Node(abstract_element.text))
+        if record.abstract is not None:
+            self.add(dataset_node, 'geolink:description', RDF.Node(record.abstract))
 
         # Spatial Coverage
-        bound_north = doc.find("./float[@name='northBoundCoord']")
-        bound_east = doc.find("./float[@name='eastBoundCoord']")
-        bound_south = doc.find("./float[@name='southBoundCoord']")
-        bound_west = doc.find("./float[@name='westBoundCoord']")
-
-        if all(ele is not None for ele in [bound_north, bound_east, bound_south, bound_west]):
-            if bound_north.text == bound_south.text and bound_west.text == bound_east.text:
-                wktliteral = "POINT (%s %s)" % (bound_north.text, bound_east.text)
+        bounds = [record.north_bound, record.east_bound, record.south_bound, record.west_bound]
+
+        if all(bound is not None for bound in bounds):
+            bound_north, bound_east, bound_south, bound_west = [dataone.formatFieldValue(bound) for bound in bounds]
+
+            if bound_north == bound_south and bound_west == bound_east:
+                wktliteral = "POINT (%s %s)" % (bound_north, bound_east)
             else:
-                wktliteral = "POLYGON ((%s %s, %s %s, %s %s, %s, %s))" % (bound_west.text, bound_north.text, bound_east.text, bound_north.text, bound_east.text, bound_south.text, bound_west.text, bound_south.text)
+                wktliteral = "POLYGON ((%s %s, %s %s, %s %s, %s, %s))" % (bound_west, bound_north, bound_east, bound_north, bound_east, bound_south, bound_west, bound_south)
 
             self.add(dataset_node, 'geolink:hasGeometryAsWktLiteral', RDF.Node(wktliteral))
 
         # Temporal Coverage
-        begin_date = doc.find("./date[@name='beginDate']")
-        end_date = doc.find("./date[@name='endDate']")
+        if record.begin_date is not None:
+            self.add(dataset_node, 'geolink:hasStartDate', RDF.Node(record.begin_date))
 
-        if begin_date is not None:
-            self.add(dataset_node, 'geolink:hasStartDate', RDF.Node(begin_date.text))
-
-        if end_date is not None:
-            self.add(dataset_node, 'geolink:hasEndDate', RDF.Node(end_date.text))
+        if record.end_date is not None:
+            self.add(dataset_node, 'geolink:hasEndDate', RDF.Node(record.end_date))
 
         # Obsoletes as PROV#wasRevisionOf
-        obsoletes_node = doc.find("./str[@name='obsoletes']")
-
-        if obsoletes_node is not None:
-            other_document_esc = urllib.unquote(obsoletes_node.text).decode('utf8')
+        if record.obsoletes is not None:
+            other_document_esc = urllib.unquote(record.obsoletes).decode('utf8')
             self.add(dataset_node, 'prov:wasRevisionOf', RDF.Uri(self.graph.ns['d1dataset'] + other_document_esc))
 
         # Landing page
@@ -539,27 +1024,38 @@ class Interface:
         # If this document has a resource map, get digital objects from there
         # Otherwise, use the cito:documents field in Solr
 
-        resource_map_identifiers = doc.findall("./arr[@name='resourceMap']/str")
+        if len(record.resource_maps) > 0:
+            digital_object_identifiers = []
 
-        if len(resource_map_identifiers) > 0:
-            for resource_map_node in resource_map_identifiers:
-                resource_map_identifier = resource_map_node.text
-
-                digital_objects = dataone.getAggregatedIdentifiers(resource_map_identifier)
+            for resource_map_identifier in record.resource_maps:
+                with timing.stage('resource_map'):
+                    digital_objects = dataone.getAggregatedIdentifiers(resource_map_identifier)
 
                 for digital_object in digital_objects:
-                    digital_object_identifier = urllib.unquote(digital_object).decode('utf8')
-                    self.addDigitalObject(identifier, digital_object_identifier)
+                    digital_object_identifiers.append(urllib.unquote(digital_object).decode('utf8'))
+
+            # Fetch every digital object's system metadata in parallel up
+            # front, then add them in resource map order. Cached copies older
+            # than an object's last system metadata modification are
+            # re-downloaded, or than the dataset's if Solr doesn't list it.
+            with timing.stage('sysmeta'):
+                modified = dict([(digital_object_identifier, record.date_modified) for digital_object_identifier in digital_object_identifiers])
+
+                if dataone.DOCUMENT_CACHE is not None:
+                    modified.update(dataone.getSystemMetadataModified(digital_object_identifiers))
+
+                sysmetas = dataone.getSystemMetadataConcurrently(digital_object_identifiers,
+                                                                 modified=modified)
+
+            for digital_object_identifier in digital_object_identifiers:
+                self.addDigitalObject(identifier, digital_object_identifier, sysmetas.get(digital_object_identifier))
         else:
             # If no resourceMap or documents field, at least add the metadata
             # file as a digital object
             # dataUrl e.g. https://cn.dataone.org/cn/v1/resolve/doi%3A10.6073%2FAA%2Fknb-lter-cdr.70061.123
 
-            data_url_node = doc.find("./str[@name='dataUrl']")
-
-            if data_url_node is not None:
-                data_url = data_url_node.text
-                digital_object = dataone.extractIdentifierFromFullURL(data_url)
+            if record.data_url is not None:
+                digital_object = dataone.extractIdentifierFromFullURL(record.data_url)
                 digital_object = urllib.unquote(digital_object).decode('utf8')
 
                 self.addDigitalObject(identifier, digital_object)
@@ -579,16 +1075,40 @@ class Interface:
 
 
     def deleteDatasetTriples(self, identifier):
-        """Delete all triples about this dataset. This includes:
+        """Delete all triples about this dataset in a single SPARQL Update
+        request. See deleteDatasetOperations.
+
+        Returns: None
+        """
+
+        identifier_esc = urllib.unquote(identifier).decode('utf8')
+        self.uncacheDatasetAgents(RDF.Uri(self.graph.ns['d1dataset']+identifier_esc))
+
+        query = u" ;\n".join(self.deleteDatasetOperations(identifier))
+        r = self.graph.update(query)
+
+        if r.status_code != 200:
+            raise Exception("Failed to delete dataset %s." % identifier)
+
+        return
+
+
+    def deleteDatasetOperations(self, identifier):
+        """Create the SPARQL Update operations that delete all triples about
+        this dataset. This includes:
 
-        - The dataset triples themselves (title, start date, etc)
-        - The dataset's digital objects
         - The identifiers for the dataset and digital object(s)
-        - The isCreatorOf statement for people and organizations
+        - The dataset's digital objects
+        - The dataset triples themselves (title, start date, etc)
+        - The isCreatorOf and isContactOf statements pointing at the dataset
+
+        Identifiers and digital objects are blank nodes so they're found
+        through the dataset. Every operation is scoped to the dataset and
+        they must be run in order, in one request, so the dataset is never
+        left half deleted.
 
-        This is a bit of extra work because identifiers and digital objects
-        are blank nodes and querying those takes some multi-statement SPARQL
-        queries.
+        Returns:
+            List of SPARQL Update operation strings
         """
 
         # Prepare some SPARQL query terms
@@ -597,69 +1117,68 @@ class Interface:
         has_identifier = RDF.Uri(self.graph.ns['geolink']+'hasIdentifier')
         is_part_of = RDF.Uri(self.graph.ns['geolink']+'isPartOf')
         has_part = RDF.Uri(self.graph.ns['geolink']+'hasPart')
+        is_creator_of = RDF.Uri(self.graph.ns['geolink']+'isCreatorOf')
+        is_contact_of = RDF.Uri(self.graph.ns['geolink']+'isContactOf')
 
-        """Delete Dataset identifier
+        patterns = [
+            # Dataset identifier
+            u"<%s> <%s> ?identifier . ?identifier ?p ?o" % (dataset, has_identifier),
 
-        Find the blank node for the identifier of this dataset and delete
-        all statements about it.
-        """
-        query = u"""DELETE WHERE
-        {
-            GRAPH <%s>
-            {
-                <%s> <%s> ?identifier .
-                ?identifier ?s ?p
-            }
-        }
-        """ % (self.graph.name, dataset, has_identifier)
+            # Digital Object identifiers
+            u"?digital_object <%s> <%s> . ?digital_object <%s> ?identifier . ?identifier ?p ?o" % (is_part_of, dataset, has_identifier),
+
+            # Digital Objects
+            u"<%s> <%s> ?digital_object . ?digital_object ?p ?o" % (dataset, has_part),
 
-        self.graph.update(query)
+            # The dataset itself
+            u"<%s> ?p ?o" % dataset,
 
-        """Delete Digital Object identifiers
+            # The people and organizations who created it or are its contacts
+            u"?s <%s> <%s>" % (is_creator_of, dataset),
+            u"?s <%s> <%s>" % (is_contact_of, dataset)
+        ]
 
-        Find all Digital Object (through Digital Object isPartOf) identifier
-        blank nodes and delete all statements about those blank nodes.
+        return [u"DELETE WHERE { GRAPH <%s> { %s } }" % (self.graph.name, pattern) for pattern in patterns]
+
+
+    def uncacheDatasetAgents(self, dataset):
+        """Remove the people and organizations who were linked to `dataset`
+        when this Interface last added it from the URI cache.
+
+        Returns: None
         """
-        query = u"""DELETE WHERE
-        {
-            GRAPH <%s>
-            {
-                ?digital_object <%s> <%s> .
-                ?digital_object <%s> ?identifier .
-                ?identifier ?p ?o
-            }
-        }
-        """ % (self.graph.name, is_part_of, dataset, has_identifier)
 
-        self.graph.update(query)
+        uris = self.dataset_agents.get(str(dataset))
+
+        if uris is None:
+            return
+
+        self.dataset_agents.discard(str(dataset))
+        num_discarded = self.uri_cache.discardValues(uris)
 
-        """Delete Digital Objects
+        logging.info("Discarded %d cached URI(s) linked to %s.", num_discarded, dataset)
 
-        Find all Digital Object blank nodes (through Dataset hasPart) and
-        delete statements about blank nodes.
+
+    def rememberDatasetAgents(self, dataset):
+        """Remember which people and organizations the current model links
+        to `dataset` so their cached URIs can be dropped when it's replaced.
+
+        Returns: None
         """
-        query = u"""DELETE WHERE
-        {
-            GRAPH <%s>
-            {
-              <%s> <%s> ?digital_object.
-              ?digital_object ?p ?o
-            }
-        }
-        """ % (self.graph.name, dataset, has_part)
 
-        self.graph.update(query)
+        uris = set()
 
-        """Delete statements about the dataset itself"""
-        self.delete('d1dataset:'+identifier_esc, '?p', '?o')
+        for predicate in ['isCreatorOf', 'isContactOf']:
+            query = RDF.Statement(predicate=RDF.Uri(self.graph.ns['geolink']+predicate),
+                                  object=dataset)
 
-        """Delete respective isCreatorOf statements"""
-        self.delete('?s', 'geolink:isCreatorOf', '?o')
+            for st in self.model.find_statements(query):
+                uris.add(str(st.subject))
 
-        return
+        self.dataset_agents.put(str(dataset), list(uris))
 
 
-    def addDigitalObject(self, dataset_identifier, digital_object_identifier):
+    def addDigitalObject(self, dataset_identifier, digital_object_identifier, data_meta=None):
         """
         Generates and adds Dataset Object within the Virtuoso database
 
@@ -669,17 +1188,21 @@ class Interface:
         :param digital_object_identifier: String
             Corresponding digital identifier for the PID
 
+        :param data_meta: XML Element
+            (optional) The digital object's system metadata, if it was
+            already fetched
+
         :return:
             None
         """
         try:
-            self.addDigitalObjectTriples(dataset_identifier, digital_object_identifier)
+            self.addDigitalObjectTriples(dataset_identifier, digital_object_identifier, data_meta)
         except Exception as e:
             logging.error(e)
         return
 
 
-    def addDigitalObjectTriples(self, dataset_identifier, digital_object_identifier):
+    def addDigitalObjectTriples(self, dataset_identifier, digital_object_identifier, data_meta=None):
         """
         Generates a new node for the dataset and adds metadata triples associated to the digital Object.
 
@@ -689,6 +1212,9 @@ class Interface:
         :param digital_object_identifier: String
             Corresponding digital identifier for the PID
 
+        :param data_meta: XML Element
+            (optional) The digital object's system metadata. Fetched from the
+            CN if not given.
 
         :return:
             None
@@ -697,10 +1223,15 @@ class Interface:
             raise Exception("Model not found.")
 
         dataset_identifier_esc = urllib.unquote(dataset_identifier).decode('utf8')
-        do_node = RDF.Node(blank=str(uuid.uuid4()))
+
+        if self.diff:
+            do_node = self.skolemize('digitalobject', dataset_identifier, digital_object_identifier)
+        else:
+            do_node = RDF.Node(blank=str(uuid.uuid4()))
 
         # Get data object meta
-        data_meta = dataone.getSystemMetadata(digital_object_identifier)
+        if data_meta is None:
+            data_meta = dataone.getSystemMetadata(digital_object_identifier)
 
         if data_meta is None:
             raise Exception("System metadata for data object %s was not found. Continuing to next data object." % digital_object_identifier)
@@ -817,12 +1348,17 @@ class Interface:
             return
 
         logging.info("Calling findPersonURI on %s.", record)
-        person_uri = self.findPersonURI(record)
+
+        with timing.stage('person_lookup'):
+            person_uri = self.findPersonURI(record)
 
         if person_uri is None:
             person_uri = self.mintPersonPrefixedURIString()
             logging.info("Person was not found. Minted URI of %s", person_uri)
 
+            if 'last_name' in record and 'email' in record:
+                self.rememberMintedURI(self.personMatchKey(record['last_name'], record['email']), person_uri)
+
         self.addPersonTriples(person_uri, record)
 
 
@@ -863,15 +1399,19 @@ class Interface:
             organization_name = record['organization']
             logging.info("Looking up organization with name '%s'", organization_name)
 
-            if self.organizationExists(organization_name):
+            organization_uri = self.findOrganizationURI({'name' : organization_name})
+
+            if organization_uri is not None:
                 logging.info("Organization with name '%s' exists.", organization_name)
-                organization_uri = self.findOrganizationURI({'name' : organization_name})
             else:
                 organization_uri = self.mintOrganizationPrefixedURIString()
                 logging.info("Minted new organization URI of '%s' and adding triples.", organization_uri)
                 self.add(organization_uri, 'rdfs:label', organization_name)
 
-            self.add(uri, 'geolink:hasAffiliation', RDF.Uri(organization_uri))
+                if len(organization_name) > 0:
+                    self.rememberMintedURI(self.organizationMatchKey(organization_name), organization_uri)
+
+            self.add(uri, 'geolink:hasAffiliation', self.prepareTerm(organization_uri))
 
         if 'email' in record:
             self.add(uri, 'foaf:mbox', RDF.Uri('mailto:' + record['email'].lower()))
@@ -902,12 +1442,17 @@ class Interface:
             return
 
         logging.info("Calling findOrganizationURI on %s.", record)
-        organization_uri = self.findOrganizationURI(record)
+
+        with timing.stage('organization_lookup'):
+            organization_uri = self.findOrganizationURI(record)
 
         if organization_uri is None:
             organization_uri = self.mintOrganizationPrefixedURIString()
             logging.info("Organization was not found. Minted URI of %s", organization_uri)
 
+            if 'name' in record:
+                self.rememberMintedURI(self.organizationMatchKey(record['name']), organization_uri)
+
         self.addOrganizationTriples(organization_uri, record)
 
 
@@ -977,6 +1522,33 @@ class Interface:
             if len(last_name) < 1 or len(email) < 1:
                 return None
 
+            key = self.personMatchKey(last_name, email)
+
+            # People minted for this dataset or earlier in the current batch
+            # aren't in the graph yet
+            if key in self.unindexed:
+                return self.unindexed[key]
+
+            if key in self.minted:
+                return self.minted[key]
+
+            person_uri = self.uri_cache.get(key)
+
+            if person_uri is not None:
+                logging.info("Match found in cache %s", person_uri)
+                return person_uri
+
+            person_uri = self.findIndexedURI(key)
+
+            if person_uri is not None:
+                logging.info("Match found in index %s", person_uri)
+                self.uri_cache.put(key, person_uri)
+                return person_uri
+
+            if self.matchKeyIndexIsComplete():
+                logging.info("No match found.")
+                return None
+
             query_string = u"""
             SELECT ?s
             WHERE {
@@ -1003,6 +1575,8 @@ class Interface:
             person_uri = RDF.Uri(person_uri_string)
             logging.info("Match found %s", person_uri)
 
+            self.uri_cache.put(key, person_uri)
+
             return person_uri
 
         # Search for existing records that are creators of documents obsoleted
@@ -1080,7 +1654,7 @@ class Interface:
         record = {}
         record["name"] = organizationName
 
-        return True if self.findOrganizationURI(record) == None else False
+        return self.findOrganizationURI(record) is not None
 
 
     def findOrganizationURI(self, record):
@@ -1109,6 +1683,33 @@ class Interface:
             if len(name) < 1:
                 return None
 
+            key = self.organizationMatchKey(name)
+
+            # Organizations minted for this dataset or earlier in the current
+            # batch aren't in the graph yet
+            if key in self.unindexed:
+                return self.unindexed[key]
+
+            if key in self.minted:
+                return self.minted[key]
+
+            organization_uri = self.uri_cache.get(key)
+
+            if organization_uri is not None:
+                logging.info("Found organization match in cache %s.", organization_uri)
+                return organization_uri
+
+            organization_uri = self.findIndexedURI(key)
+
+            if organization_uri is not None:
+                logging.info("Found organization match in index %s.", organization_uri)
+                self.uri_cache.put(key, organization_uri)
+                return organization_uri
+
+            if self.matchKeyIndexIsComplete():
+                logging.info("Organization not found by name.")
+                return None
+
             query_string = u"""
             SELECT ?s
             WHERE {
@@ -1133,11 +1734,173 @@ class Interface:
             organization_uri = RDF.Uri(organization_uri_string)
             logging.info("Found organiztion match for organization URI %s.", organization_uri)
 
+            self.uri_cache.put(key, organization_uri)
+
             return organization_uri
 
         return None
 
 
+    def personMatchKey(self, last_name, email):
+        """The key a person is matched on: their last name and (lowercased)
+        email."""
+
+        return ('person', last_name, email.lower())
+
+
+    def organizationMatchKey(self, name):
+        """The key an organization is matched on: its name."""
+
+        return ('organization', name)
+
+
+    def matchKeyString(self, key):
+        """Serialize a match key as stored in the match key index, e.g.
+        'person|Alpha|alpha@example.org'."""
+
+        parts = []
+
+        for part in key:
+            if isinstance(part, str):
+                part = part.decode('utf-8')
+
+            parts.append(part)
+
+        return u"|".join(parts)
+
+
+    def matchKeyIndexTriples(self, uris):
+        """Create the match key index statements for a Dict of URIs indexed
+        by match key.
+
+        Returns:
+            List of triples formatted for a SPARQL query
+        """
+
+        triples = []
+
+        for key, uri in uris.iteritems():
+            triples.append(u'<%s> <%s> "%s"' % (str(uri).decode('utf-8'),
+                                                MATCH_KEY_PREDICATE,
+                                                export.escapeLiteral(self.matchKeyString(key))))
+
+        return triples
+
+
+    def findIndexedURI(self, key):
+        """Look up the URI for a match key in the match key index.
+
+        Returns:
+            RDF.Uri or None if the key isn't indexed or is ambiguous
+        """
+
+        query_string = u"""
+        SELECT ?s
+        WHERE {
+            GRAPH <%s> { ?s <%s> "%s" }
+        }
+        """ % (self.match_key_graph,
+               MATCH_KEY_PREDICATE,
+               export.escapeLiteral(self.matchKeyString(key)))
+
+        result = self.graph.query(query_string)
+
+        if result is None or len(result) != 1 or 's' not in result[0]:
+            return None
+
+        return RDF.Uri(result[0]['s'])
+
+
+    def matchKeyIndexIsComplete(self):
+        """Whether the match key index has been built from the main graph,
+        meaning a key that isn't in the index isn't in the graph either.
+
+        Once the index is complete it stays that way, so that's remembered
+        for the lifetime of this Interface. Until then, the graph is asked
+        again every MATCH_KEY_INDEX_CHECK_INTERVAL seconds so workers pick up
+        an index rebuilt after they started.
+        """
+
+        if self.match_key_index_complete:
+            return True
+
+        if self.match_key_index_checked_at is not None and time.time() - self.match_key_index_checked_at < MATCH_KEY_INDEX_CHECK_INTERVAL:
+            return False
+
+        query_string = u"""
+        SELECT ?o
+        WHERE {
+            GRAPH <%s> { <%s> <%s> ?o }
+        }
+        """ % (self.match_key_graph, self.match_key_graph, MATCH_KEY_INDEX_COMPLETE)
+
+        result = self.graph.query(query_string)
+
+        self.match_key_index_complete = result is not None and len(result) > 0
+        self.match_key_index_checked_at = time.time()
+
+        return self.match_key_index_complete
+
+
+    def rebuildMatchKeyIndex(self):
+        """Rebuild the match key index from the people and organizations in
+        the main graph, then mark it as complete.
+
+        Returns: None
+        """
+
+        query = u"""
+        DROP SILENT GRAPH <%(index)s> ;
+
+        INSERT
+        {
+            GRAPH <%(index)s> { ?s <%(predicate)s> ?key }
+        }
+        WHERE
+        {
+            GRAPH <%(graph)s>
+            {
+                ?s rdf:type geolink:Person ;
+                   geolink:nameFamily ?last_name ;
+                   foaf:mbox ?mbox .
+            }
+
+            BIND(CONCAT("person|", STR(?last_name), "|", LCASE(SUBSTR(STR(?mbox), 8))) AS ?key)
+        } ;
+
+        INSERT
+        {
+            GRAPH <%(index)s> { ?s <%(predicate)s> ?key }
+        }
+        WHERE
+        {
+            GRAPH <%(graph)s>
+            {
+                ?s rdf:type geolink:Organization ;
+                   rdfs:label ?name .
+            }
+
+            BIND(CONCAT("organization|", STR(?name)) AS ?key)
+        } ;
+
+        INSERT DATA
+        {
+            GRAPH <%(index)s> { <%(index)s> <%(complete)s> true }
+        }
+        """ % {'index': self.match_key_graph,
+               'graph': self.graph.name,
+               'predicate': MATCH_KEY_PREDICATE,
+               'complete': MATCH_KEY_INDEX_COMPLETE}
+
+        logging.info("Rebuilding match key index %s.", self.match_key_graph)
+        r = self.graph.update(query)
+
+        if r.status_code != 200:
+            raise Exception("Failed to rebuild match key index %s." % self.match_key_graph)
+
+        self.match_key_index_complete = True
+
+
     def mintPersonPrefixedURIString(self):
         """
         Generates a new URI for the Person
@@ -1180,8 +1943,12 @@ class Interface:
         scheme = util.getIdentifierScheme(identifier)
         resolve_url = util.getIdentifierResolveURL(identifier)
 
-        # Create a blank node for the identifier
-        identifier_node = RDF.Node(blank=str(uuid.uuid4()))
+        # Create a blank node (or, in diff mode, a skolem IRI) for the
+        # identifier
+        if self.diff:
+            identifier_node = self.skolemize('identifier', str(self.prepareTerm(node)), identifier)
+        else:
+            identifier_node = RDF.Node(blank=str(uuid.uuid4()))
 
         self.add(node, 'geolink:hasIdentifier', identifier_node)
         self.add(identifier_node, 'rdf:type', 'geolink:Identifier')
@@ -1,23 +1,33 @@
-from __future__ import division
-
 """ jobs.py
 
 A collection of common jobs for the D1 LOD service.
 """
 
+from __future__ import division
+
 import os
 import sys
+import hashlib
+import time
 import datetime
+import itertools
+import functools
+import tempfile
 from dateutil.parser import parse
 import RDF
 import logging
 
 from redis import StrictRedis
-from rq import Queue
+from rq import Queue, Worker
+from rq.registry import StartedJobRegistry
 
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
 
+from d1lod import cache
 from d1lod import dataone
+from d1lod import export
+from d1lod import metrics
+from d1lod import timing
 from d1lod import Graph, Interface
 
 NAMESPACES = {
@@ -42,22 +52,189 @@ queues = {
     'dataset': Queue('dataset', connection=conn),
     'export': Queue('export', connection=conn)
 }
-QUEUE_MAX_SIZE = 100  # Controls whether adding new jobs is delayed
-QUEUE_MAX_SIZE_STANDOFF = 60  # (seconds) time to sleep before trying again
+QUEUE_TARGET_SIZE = 100  # Number of datasets update_graph tries to keep queued
 
 # Set up connections to services
 VIRTUOSO_HOST = "virtuoso"
 VIRTUOSO_PORT = "8890"
 VIRTUOSO_GRAPH = 'geolink'
+VIRTUOSO_POOL_SIZE = 10  # Keep-alive connections per worker process
 REDIS_LAST_RUN_KEY = 'lastrun'
+REDIS_CHANGES_KEY = 'changes:datasets'  # IRIs of the datasets changed since the last changeset
+REDIS_CHANGES_EXPORTING_KEY = 'changes:datasets:exporting'
+REDIS_DUMP_SEQUENCE_KEY = 'dump:changeset'  # Sequence number of the last changeset before the dump
+REDIS_ENQUEUED_KEY = 'datasets:enqueued'  # Number of datasets ever queued
+REDIS_COMPLETED_KEY = 'datasets:completed'  # Number of datasets ever processed
+REDIS_LATENCIES_KEY = 'datasets:latencies'  # Recent add_dataset times (seconds)
+REDIS_DRAIN_SAMPLE_KEY = 'datasets:drain'  # See getDrainRate
+REDIS_IN_FLIGHT_KEY = 'datasets:inflight'  # dateModified of each queued/running PID
+REDIS_IN_FLIGHT_TIMES_KEY = 'datasets:inflight:times'  # When each of those was queued
+REDIS_DATASET_LOCK_PREFIX = 'lock:dataset:'  # Held while a PID is being added
 
 # Set up file paths
 VOID_FILENAME = "void.ttl"
 VOID_FILEPATH = "/www/" + VOID_FILENAME
-DUMP_FILENAME = "d1lod.ttl"
+DUMP_COMPRESS = False  # Whether to gzip the full dump (appends .gz)
+DUMP_FILENAME = "d1lod.ttl" + (".gz" if DUMP_COMPRESS else "")
+DUMP_FILEPATH = "/www/" + DUMP_FILENAME
+CHANGESET_DIRNAME = "changesets"
+CHANGESET_DIRECTORY = "/www/" + CHANGESET_DIRNAME
+CHANGESET_RETAIN = 24 * 7  # Number of changesets to keep (hourly for a week)
+DOCUMENT_CACHE_ROOT = os.path.join(tempfile.gettempdir(), "d1lod-cache")
+DOCUMENT_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+DOCUMENT_CACHE_TTL = {'meta': 24 * 60 * 60}  # (seconds) Objects never expire
 
 # Set up job parameters
-UPDATE_CHUNK_SIZE = 100  # Number of datasets to add each update
+UPDATE_INTERVAL = 60  # (seconds) How often the scheduler runs update_graph
+UPDATE_CHUNK_SIZE = 100  # Number of datasets to add each update until drain rates are known
+UPDATE_MAX_CHUNK_SIZE = 1000  # Most datasets to add in one update
+LATENCY_SAMPLES = 100  # Number of add_dataset times averaged
+DATASET_LOCK_TIMEOUT = 10 * 60  # (seconds) Time after which a dataset lock is released anyway
+DATASET_LOCK_WAIT = 2 * 60  # (seconds) Time to wait for another job to release a dataset lock
+DATASET_IN_FLIGHT_TTL = 6 * 60 * 60  # (seconds) Time after which a queued dataset is assumed lost and can be queued again
+DATASET_BATCH_SIZE = 25  # Datasets per add_datasets job while backfilling
+DIFF_UPDATES = True  # Only write the triples that changed when re-adding datasets
+
+# Record metrics alongside the rest of the service's state
+metrics.setConnection(conn)
+
+# The Graph, Interface, and DocumentCache used by every job run in this
+# process. See getGraph, getInterface, and getDocumentCache.
+GRAPH = None
+INTERFACE = None
+DOCUMENT_CACHE = None
+
+
+def getGraph():
+    """Get the Graph shared by the jobs run in this process, creating it on
+    first use.
+
+    Jobs look their Graph and Interface up here instead of being passed them
+    as arguments so neither has to be pickled into every job. Workers run
+    jobs in their own process (see worker/work.py) so the same instances,
+    along with their pooled connections and caches, are reused by every job
+    a worker runs.
+    """
+
+    global GRAPH
+
+    if GRAPH is None:
+        GRAPH = Graph(host=VIRTUOSO_HOST, port=VIRTUOSO_PORT, name=VIRTUOSO_GRAPH, ns=NAMESPACES, pool_size=VIRTUOSO_POOL_SIZE)
+
+    return GRAPH
+
+
+def getInterface():
+    """Get the Interface shared by the jobs run in this process, creating it
+    (and its Graph) on first use. See getGraph."""
+
+    global INTERFACE
+
+    if INTERFACE is None:
+        getDocumentCache()
+        INTERFACE = Interface(getGraph(), diff=DIFF_UPDATES)
+
+    return INTERFACE
+
+
+def getDocumentCache():
+    """Get the DocumentCache shared by every worker on this host, creating
+    it on first use and handing it to dataone.
+
+    It's created here rather than when this module is imported because
+    creating it reads the size of the whole cache directory, which the
+    scheduler and anything else importing jobs have no use for."""
+
+    global DOCUMENT_CACHE
+
+    if DOCUMENT_CACHE is None:
+        DOCUMENT_CACHE = cache.DocumentCache(DOCUMENT_CACHE_ROOT,
+                                             max_bytes=DOCUMENT_CACHE_MAX_BYTES,
+                                             ttl=DOCUMENT_CACHE_TTL)
+        dataone.setDocumentCache(DOCUMENT_CACHE)
+
+    return DOCUMENT_CACHE
+
+# Records a PID's dateModified as in flight (at time ARGV[3]) unless the same
+# or a newer version already is and was queued after ARGV[4]. Returns 1 if it
+# was recorded.
+MARK_IN_FLIGHT = conn.register_script("""
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+
+if current and current >= ARGV[2] then
+    local queued_at = redis.call('ZSCORE', KEYS[2], ARGV[1])
+
+    if queued_at and tonumber(queued_at) > tonumber(ARGV[4]) then
+        return 0
+    end
+end
+
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+return 1
+""")
+
+# Removes a PID from the in-flight hash if it's still at the given dateModified
+CLEAR_IN_FLIGHT = conn.register_script("""
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+
+return 0
+""")
+
+# Removes the PIDs queued at or before ARGV[1]. Returns how many there were.
+PRUNE_IN_FLIGHT = conn.register_script("""
+local stale = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+
+for i, identifier in ipairs(stale) do
+    redis.call('HDEL', KEYS[1], identifier)
+end
+
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+return #stale
+""")
+
+
+def timed(job):
+    """Decorate a job so the number of runs, their outcome and their duration
+    are recorded as metrics (see d1lod.metrics)."""
+
+    @functools.wraps(job)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        status = 'failed'
+
+        try:
+            result = job(*args, **kwargs)
+            status = 'succeeded'
+
+            return result
+        finally:
+            metrics.increment('d1lod_jobs_total', {'job': job.__name__, 'status': status})
+            metrics.observe('d1lod_job_duration_seconds', time.time() - start, {'job': job.__name__})
+
+    return wrapper
+
+
+def reportTimings(job_name, timer, **fields):
+    """Log the stage timings of a job (see d1lod.timing) as JSON and record
+    them as metrics."""
+
+    logging.info("[%s] TIMINGS %s", job_name, timer.format(job=job_name, **fields))
+
+    stages = timer.summary()['stages']
+
+    for name in stages:
+        metrics.observe('d1lod_stage_duration_seconds', stages[name]['seconds'], {'job': job_name, 'stage': name})
+
+
+def collectMetrics():
+    """Update the gauges read at scrape time (see d1lod.metrics.serve)."""
+
+    for name in queues:
+        metrics.setGauge('d1lod_queue_length', len(queues[name]), {'queue': name})
 
 
 def getNowString():
@@ -107,10 +284,19 @@ def setLastRun(to=None):
     return to
 
 
-def createVoIDModel(to):
+def createVoIDModel(to, changesets=None, dump_sequence=None):
     """Creates an RDF Model according to the VoID Dataset spec for the given
     arguments.
 
+    Arguments:
+        to: str
+            Last-modified value
+        changesets: List(str)
+            (optional) Names of the changesets published alongside the dump
+        dump_sequence: int
+            (optional) Sequence number of the last changeset written before
+            the dump was started
+
     Returns: RDF.Model"""
 
     # Validate the to string
@@ -129,6 +315,7 @@ def createVoIDModel(to):
     void = "http://rdfs.org/ns/void#"
     d1lod = "http://dataone.org/"
     dcterms = "http://purl.org/dc/terms/"
+    xsd = "http://www.w3.org/2001/XMLSchema#"
 
     subject_node = RDF.Node(blank="d1lod")
 
@@ -149,11 +336,29 @@ def createVoIDModel(to):
                            RDF.Uri(void+'dataDump'),
                            RDF.Uri(d1lod+DUMP_FILENAME)))
 
+    if dump_sequence is not None:
+        m.append(RDF.Statement(RDF.Uri(d1lod+DUMP_FILENAME),
+                               RDF.Uri(d1lod+'changesetSequence'),
+                               RDF.Node(literal=str(dump_sequence), datatype=RDF.Uri(xsd+'integer'))))
+
+    if changesets is not None and len(changesets) > 0:
+        m.append(RDF.Statement(subject_node,
+                               RDF.Uri(void+'feature'),
+                               RDF.Uri(d1lod+'changesets')))
+
+        for changeset in changesets:
+            for suffix in [export.CHANGESET_REMOVED_SUFFIX, export.CHANGESET_ADDED_SUFFIX]:
+                m.append(RDF.Statement(subject_node,
+                                       RDF.Uri(d1lod+'changeset'),
+                                       RDF.Uri(d1lod+CHANGESET_DIRNAME+'/'+changeset+suffix)))
+
     return m
 
 
-def updateVoIDFile(to):
-    """Updates a VoID file with a new last-modified value.
+def updateVoIDFile(to, changesets=None, dump_sequence=None):
+    """Updates a VoID file with a new last-modified value, the list of
+    published changesets, and the sequence number of the last changeset the
+    dump includes (mirrors apply the ones after it).
 
     Note: The filepath of the VoID file is accessed by a global variable.
 
@@ -168,15 +373,34 @@ def updateVoIDFile(to):
     d1lod:d1lod a void:Dataset ;
       void:feature d1lod:fulldump ;
       dcterms:modified "2015-11-01";
-      void:dataDump d1lod:d1lod.ttl .
+      void:dataDump d1lod:d1lod.ttl ;
+      void:feature d1lod:changesets ;
+      d1lod:changeset <http://dataone.org/changesets/00000042-20151101T120000Z.removed.txt.gz> ,
+                      <http://dataone.org/changesets/00000042-20151101T120000Z.added.nt.gz> .
+
+    d1lod:d1lod.ttl d1lod:changesetSequence 41 .
     """
 
+    if changesets is None:
+        changesets = export.listChangesets(CHANGESET_DIRECTORY)
+
+    if dump_sequence is None and conn.exists(REDIS_DUMP_SEQUENCE_KEY):
+        dump_sequence = int(conn.get(REDIS_DUMP_SEQUENCE_KEY))
+
     # Create the VoID RDF Model
-    m = createVoIDModel(to)
+    m = createVoIDModel(to, changesets, dump_sequence)
 
     # Verify the size of the model as a check for its successful creation
-    if m.size() != 4:
-        logging.error("The VoID model that was created was the wronng size (%d, not %d).", m.size(), 4)
+    expected_size = 4
+
+    if dump_sequence is not None:
+        expected_size += 1
+
+    if len(changesets) > 0:
+        expected_size += 1 + 2 * len(changesets)
+
+    if m.size() != expected_size:
+        logging.error("The VoID model that was created was the wronng size (%d, not %d).", m.size(), expected_size)
         return
 
     # Create a serializer
@@ -190,6 +414,7 @@ def updateVoIDFile(to):
     s.set_namespace('void', void)
     s.set_namespace('dcterms', NAMESPACES['dcterms'])
     s.set_namespace('d1lod', d1lod)
+    s.set_namespace('xsd', "http://www.w3.org/2001/XMLSchema#")
 
     # Write to different locations depending on production or testing
     try:
@@ -201,6 +426,268 @@ def updateVoIDFile(to):
         logging.exception(e)
 
 
+def recordChange(change):
+    """Record the dataset changed by Interface.addDataset so it's published
+    in the next changeset.
+
+    Only the dataset's IRI is kept (in a Redis set, so a dataset that changes
+    more than once is only recorded once). Its triples are read back out of
+    the graph when the changeset is written. See iterChanges."""
+
+    if change is None:
+        return
+
+    conn.sadd(REDIS_CHANGES_KEY, change['dataset'])
+
+
+def iterChanges(key, interface, chunk_size=1000):
+    """Iterate over the datasets in the Redis set `key` as change records
+    for export.writeChangeset.
+
+    Every dataset is replaced by its triples as they are in the graph now
+    (see Interface.iterChangeTriples), which is also how a dataset that's
+    since been removed from the graph is published.
+    """
+
+    for dataset in conn.sscan_iter(key, count=chunk_size):
+        triples = interface.iterChangeTriples(dataset)
+
+        yield {
+            'dataset': dataset,
+            'removed': True,
+            'added': (export.formatTriple(s, p, o).rstrip(u"\n") for s, p, o in triples)
+        }
+
+
+def getQueuedDatasetCount():
+    """Get the number of datasets queued but not yet processed.
+
+    Jobs on the dataset queue can carry more than one dataset so this is
+    tracked with a pair of counters rather than read off the queue. The
+    counters are reset once the queue is empty and no dataset job is running
+    in case a job was lost without being counted (e.g., its worker was
+    killed). RQ drops jobs from the StartedJobRegistry once they've run past
+    their timeout, so a lost job doesn't stop the reset for long.
+    """
+
+    if len(queues['dataset']) == 0 and StartedJobRegistry('dataset', connection=conn).count == 0:
+        conn.set(REDIS_ENQUEUED_KEY, conn.get(REDIS_COMPLETED_KEY) or 0)
+        return 0
+
+    enqueued = int(conn.get(REDIS_ENQUEUED_KEY) or 0)
+    completed = int(conn.get(REDIS_COMPLETED_KEY) or 0)
+
+    return max(0, enqueued - completed)
+
+
+def recordCompleted(num_datasets, seconds=None):
+    """Record that `num_datasets` queued datasets were processed, taking
+    `seconds` in total (if they were all added successfully)."""
+
+    conn.incrby(REDIS_COMPLETED_KEY, num_datasets)
+
+    if seconds is None or num_datasets <= 0:
+        return
+
+    pipe = conn.pipeline()
+    pipe.lpush(REDIS_LATENCIES_KEY, seconds / num_datasets)
+    pipe.ltrim(REDIS_LATENCIES_KEY, 0, LATENCY_SAMPLES - 1)
+    pipe.execute()
+
+
+def getMeanLatency():
+    """Get the mean time (in seconds) recently taken to add a dataset.
+
+    Returns: float | None
+    """
+
+    latencies = [float(latency) for latency in conn.lrange(REDIS_LATENCIES_KEY, 0, -1)]
+
+    if len(latencies) == 0:
+        return None
+
+    return sum(latencies) / len(latencies)
+
+
+def getDatasetWorkerCount():
+    """Get the number of workers taking jobs off the dataset queue."""
+
+    return len([w for w in Worker.all(connection=conn) if 'dataset' in w.queue_names()])
+
+
+def recordDrainSample(queue_size):
+    """Record how many datasets are queued now that update_graph has queued
+    its chunk. See getDrainRate."""
+
+    conn.hmset(REDIS_DRAIN_SAMPLE_KEY, {
+        'time': time.time(),
+        'size': queue_size,
+        'completed': int(conn.get(REDIS_COMPLETED_KEY) or 0)
+    })
+
+
+def getDrainRate(queue_size):
+    """Estimate how many datasets per second the workers get through.
+
+    The rate is measured from the datasets completed since the last chunk
+    was queued, as long as the queue didn't run dry in the meantime (which
+    would make it an underestimate). Otherwise it's estimated from the
+    number of dataset workers and the mean time taken to add a dataset.
+
+    Returns: float | None
+        None if there's nothing to estimate from yet.
+    """
+
+    sample = conn.hgetall(REDIS_DRAIN_SAMPLE_KEY)
+
+    if sample and queue_size > 0:
+        elapsed = time.time() - float(sample['time'])
+        completed = int(conn.get(REDIS_COMPLETED_KEY) or 0) - int(sample['completed'])
+
+        if elapsed > 0 and completed > 0:
+            return completed / elapsed
+
+    latency = getMeanLatency()
+
+    if latency is None or latency <= 0:
+        return None
+
+    return getDatasetWorkerCount() / latency
+
+
+def calculateChunkSize(queue_size, drain_rate, interval=UPDATE_INTERVAL, target=QUEUE_TARGET_SIZE, default=UPDATE_CHUNK_SIZE, maximum=UPDATE_MAX_CHUNK_SIZE):
+    """Calculate how many datasets to queue so the queue holds about `target`
+    datasets when update_graph next runs.
+
+    Arguments:
+    ----------
+
+    queue_size : int
+        Number of datasets currently queued
+
+    drain_rate : float | None
+        Datasets processed per second, or None if unknown
+
+    interval : int
+        Seconds until the next update
+
+    target : int
+        Number of datasets to keep queued
+
+    default : int
+        Chunk size to use while the drain rate is unknown
+
+    maximum : int
+        Largest chunk size to return
+
+    Returns:
+        The number of datasets to queue (zero if the queue is full enough).
+    """
+
+    if drain_rate is None:
+        chunk_size = default - queue_size
+    else:
+        chunk_size = int(round(drain_rate * interval)) + target - queue_size
+
+    return max(0, min(maximum, chunk_size))
+
+
+def getDatasetJobId(datasets):
+    """Get the ID of the job adding `datasets`, a list of (identifier,
+    dateModified) tuples. Queueing the same versions of the same datasets
+    always gives the same ID."""
+
+    digest = hashlib.sha1()
+
+    for identifier, date_modified in datasets:
+        digest.update((u"%s\n%s\n" % (identifier, date_modified)).encode('utf-8'))
+
+    if len(datasets) == 1:
+        return "add_dataset:" + digest.hexdigest()
+
+    return "add_datasets:" + digest.hexdigest()
+
+
+def markInFlight(identifier, date_modified):
+    """Record that the version of a dataset modified at `date_modified` is
+    about to be queued.
+
+    Returns:
+        False if the same or a newer version is already queued or being
+        added, in which case it shouldn't be queued again. Versions queued
+        more than DATASET_IN_FLIGHT_TTL ago are assumed to have been lost.
+    """
+
+    if date_modified is None:
+        return True
+
+    now = time.time()
+
+    return MARK_IN_FLIGHT(keys=[REDIS_IN_FLIGHT_KEY, REDIS_IN_FLIGHT_TIMES_KEY],
+                          args=[identifier, date_modified, now, now - DATASET_IN_FLIGHT_TTL]) == 1
+
+
+def isSuperseded(identifier, date_modified):
+    """Check whether a newer version of a dataset was queued after this one,
+    in which case this one can be skipped."""
+
+    if date_modified is None:
+        return False
+
+    current = conn.hget(REDIS_IN_FLIGHT_KEY, identifier)
+
+    return current is not None and current > date_modified
+
+
+def clearInFlight(identifier, date_modified):
+    """Record that a version of a dataset has been added (or skipped),
+    unless a newer one has been queued since."""
+
+    if date_modified is None:
+        return
+
+    CLEAR_IN_FLIGHT(keys=[REDIS_IN_FLIGHT_KEY, REDIS_IN_FLIGHT_TIMES_KEY], args=[identifier, date_modified])
+
+
+def pruneInFlight():
+    """Forget datasets queued more than DATASET_IN_FLIGHT_TTL ago, which were
+    lost without being cleared (e.g., their worker was killed).
+
+    Returns:
+        The number of datasets forgotten.
+    """
+
+    return PRUNE_IN_FLIGHT(keys=[REDIS_IN_FLIGHT_KEY, REDIS_IN_FLIGHT_TIMES_KEY],
+                           args=[time.time() - DATASET_IN_FLIGHT_TTL])
+
+
+def lockDataset(identifier):
+    """Acquire the lock which stops two jobs adding the same dataset at the
+    same time, waiting up to DATASET_LOCK_WAIT for another job to release it.
+
+    Returns: redis.lock.Lock
+    """
+
+    lock = conn.lock(REDIS_DATASET_LOCK_PREFIX + identifier,
+                     timeout=DATASET_LOCK_TIMEOUT,
+                     blocking_timeout=DATASET_LOCK_WAIT)
+
+    if not lock.acquire():
+        raise Exception("Timed out waiting for the lock on dataset %s." % identifier)
+
+    return lock
+
+
+def releaseDataset(lock):
+    """Release a lock from lockDataset, which may have already expired."""
+
+    try:
+        lock.release()
+    except Exception, e:
+        logging.error("Failed to release lock %s: %s", lock.name, e)
+
+
+@timed
 def calculate_stats():
     """Collect and print out statistics about the graph.
     """
@@ -208,10 +695,12 @@ def calculate_stats():
     JOB_NAME = "JOB_GRAPH_STATS"
     logging.info("[%s] Job started.", JOB_NAME)
 
-    g = Graph(host=VIRTUOSO_HOST, port=VIRTUOSO_PORT, name=VIRTUOSO_GRAPH, ns=NAMESPACES)
-    Interface(g)  # Adds namespaces we need to repo
+    g = getGraph()
+    getInterface()  # Adds namespaces we need to repo
 
-    logging.info("[%s] graph.size=%d", JOB_NAME, int(g.size()))
+    size = int(g.size())
+    logging.info("[%s] graph.size=%d", JOB_NAME, size)
+    metrics.setGauge('d1lod_graph_triples', size)
 
     # Count Datasets, People, Organizations, etc
     concepts = ['geolink:Dataset', 'geolink:DigitalObject', 'geolink:Identifier',
@@ -231,14 +720,17 @@ def calculate_stats():
             continue
 
         concept_strings.append("%s:%s" % (concept, result[0]['count']))
+        metrics.setGauge('d1lod_graph_concepts', result[0]['count'], {'concept': concept})
 
     logging.info("[%s] Distinct Concepts: %s.", JOB_NAME, "; ".join(concept_strings))
 
 
+@timed
 def update_graph():
     """Update the graph with datasets that have been modified since the last
-    time the job was run. This job updates in chunks of UPDATE_CHUNK_SIZE. The
-    reason for this is to avoid long-running jobs.
+    time the job was run. This job updates in chunks sized from how quickly
+    the workers are getting through the dataset queue (see
+    calculateChunkSize). The reason for this is to avoid long-running jobs.
     """
     JOB_NAME = "JOB_UPDATE"
     logging.info("[%s] Job started.", JOB_NAME)
@@ -271,46 +763,69 @@ def update_graph():
     to_string = getNowString()  # Always just get all datasets since from_string
     logging.info("[%s] Running update job: from_string=%s to_string=%s", JOB_NAME, from_string, to_string)
 
-    # Return now if the queue is too large
-    if len(queues['dataset']) > QUEUE_MAX_SIZE:
-        logging.info("[%s] Ending update job early because dataset queue is too large (%d).", JOB_NAME, len(queues['dataset']))
+    # Size this chunk so the dataset queue stays near QUEUE_TARGET_SIZE
+    queue_size = getQueuedDatasetCount()
+    drain_rate = getDrainRate(queue_size)
+    chunk_size = calculateChunkSize(queue_size, drain_rate)
+    logging.info("[%s] queue_size=%d drain_rate=%s chunk_size=%d", JOB_NAME, queue_size, drain_rate, chunk_size)
+
+    if chunk_size <= 0:
+        logging.info("[%s] Ending update job early because dataset queue is full enough (%d).", JOB_NAME, queue_size)
         return
 
-    # Create the Solr query to grab the datasets
-    query_string = dataone.createSinceQueryURL(from_string, to_string, None, 0)
-    num_results = dataone.getNumResults(query_string)
-    logging.info("[%s] num_results=%d", JOB_NAME, num_results)
+    # Get the first chunk_size documents
+    docs = list(itertools.islice(dataone.iterSinceDocuments(from_string, to_string, page_size=min(chunk_size, UPDATE_MAX_CHUNK_SIZE)),
+                                 chunk_size))
 
-    # Set up Graph/Interface once per update job
-    # This ensures that all add_dataset jobs use the same instance of each
-    # which reduces uncessary overhead
+    if len(docs) <= 0:
+        logging.info("[%s] No datasets added since last update.", JOB_NAME)
+        return
 
-    graph = Graph(host=VIRTUOSO_HOST, port=VIRTUOSO_PORT, name=VIRTUOSO_GRAPH, ns=NAMESPACES)
-    interface = Interface(graph)
+    # Drop datasets whose current (or a newer) version is already queued or
+    # being added. Entries left behind by lost jobs expire after
+    # DATASET_IN_FLIGHT_TTL.
+    num_pruned = pruneInFlight()
 
-    # Get first page of size UPDATE_CHUNK_SIZE
-    page_xml = dataone.getSincePage(from_string, to_string, 1, UPDATE_CHUNK_SIZE)
-    docs = page_xml.findall(".//doc")
+    if num_pruned > 0:
+        logging.info("[%s] Forgot %d queued dataset(s) which were never added.", JOB_NAME, num_pruned)
 
-    if docs is None or len(docs) <= 0:
-        logging.info("[%s] No datasets added since last update.", JOB_NAME)
-        return
+    records = [dataone.docToRecord(doc) for doc in docs]
+    queued_records = []
 
-    for doc in docs:
-        identifier = dataone.extractDocumentIdentifier(doc)
-        logging.info("[%s] Queueing job add_dataset with identifier='%s'", JOB_NAME, identifier)
-        queues['dataset'].enqueue(add_dataset, graph, interface, identifier, doc)
+    for record in records:
+        if record.identifier is None:
+            logging.error("[%s] Not queueing dataset without an identifier.", JOB_NAME)
+            continue
+
+        if markInFlight(record.identifier, record.date_modified):
+            queued_records.append(record)
+        else:
+            logging.info("[%s] Not queueing dataset with identifier='%s' because it's already queued.", JOB_NAME, record.identifier)
+
+    # Jobs only carry the Solr fields of their datasets, as SolrRecords. The
+    # Graph and Interface come from the worker (see getInterface).
+    # When we're behind (i.e., there were at least chunk_size datasets to
+    # add), queue datasets in batches so their triples get written with a
+    # few large INSERT DATA requests
+    conn.incrby(REDIS_ENQUEUED_KEY, len(queued_records))
+    recordDrainSample(queue_size + len(queued_records))
+
+    if len(docs) >= chunk_size:
+        for i in range(0, len(queued_records), DATASET_BATCH_SIZE):
+            batch = queued_records[i:i + DATASET_BATCH_SIZE]
+            job_id = getDatasetJobId([(record.identifier, record.date_modified) for record in batch])
+            logging.info("[%s] Queueing job add_datasets with %d datasets", JOB_NAME, len(batch))
+            queues['dataset'].enqueue(add_datasets, batch, job_id=job_id)
+    else:
+        for record in queued_records:
+            job_id = getDatasetJobId([(record.identifier, record.date_modified)])
+            logging.info("[%s] Queueing job add_dataset with identifier='%s'", JOB_NAME, record.identifier)
+            queues['dataset'].enqueue(add_dataset, record.identifier, record, job_id=job_id)
 
     logging.info("[%s] Done queueing datasets.", JOB_NAME)
 
     # Get sysmeta modified string for the last document in the sorted list
-    last_modified = docs[len(docs)-1]
-    last_modified_ele = last_modified.find("./date[@name='dateModified']")
-
-    if last_modified_ele is None:
-        raise Exception("Solr result did not contain a dateModified element.")
-
-    last_modified_value = last_modified_ele.text
+    last_modified_value = records[-1].date_modified
 
     if last_modified_value is None or len(last_modified_value) <= 0:
         raise Exception("Last document's dateModified value was None or length zero.")
@@ -324,25 +839,71 @@ def update_graph():
         updateVoIDFile(last_modified_value)
 
 
-def add_dataset(graph, interface, identifier, doc=None):
-    """Adds the dataset from a set of Solr fields."""
+@timed
+def add_dataset(identifier, record=None):
+    """Adds the dataset from its Solr fields (a dataone.SolrRecord), fetching
+    them from Solr if none were passed.
+
+    The job is skipped if a newer version of the dataset has been queued
+    since, and waits for any other job adding the same dataset to finish.
+    """
 
     JOB_NAME = "JOB_ADD_DATASET"
     logging.info("[%s] [%s] Job started.", JOB_NAME, identifier)
+
+    date_modified = None
+
+    if record is not None:
+        date_modified = record.date_modified
+
+    if isSuperseded(identifier, date_modified):
+        logging.info("[%s] [%s] Skipping dataset because a newer version has been queued.", JOB_NAME, identifier)
+        recordCompleted(1)
+        return
+
     logging.info("[%s] [%s] Adding dataset with identifier='%s'", JOB_NAME, identifier, identifier)
 
-    # Handle case where no Solr fields were passed in
-    if doc is None:
-        doc = dataone.getSolrIndexFields(identifier)
+    timer = timing.StageTimer()
 
-    if doc is None:
-        raise Exception("No solr fields could be retrieved for dataset with PID %s.", identifier)
+    with timing.activate(timer):
+        # Handle case where no Solr fields were passed in
+        if record is None:
+            doc = dataone.getSolrIndexFields(identifier)
 
-    # Collect stats for before and after
-    datetime_before = datetime.datetime.now()
+            if doc is not None:
+                record = dataone.docToRecord(doc)
+
+        if record is None:
+            recordCompleted(1)
+            raise Exception("No solr fields could be retrieved for dataset with PID %s.", identifier)
+
+        # Collect stats for before and after
+        datetime_before = datetime.datetime.now()
+
+        # Add the dataset
+        graph = getGraph()
+        interface = getInterface()
+
+        try:
+            # Clear the in-flight marker even if the lock is never acquired,
+            # so later versions of the dataset aren't skipped until it expires
+            try:
+                with timing.stage('lock'):
+                    lock = lockDataset(identifier)
 
-    # Add the dataset
-    interface.addDataset(identifier, doc)
+                try:
+                    change = interface.addDataset(identifier, record)
+                finally:
+                    releaseDataset(lock)
+            finally:
+                clearInFlight(identifier, date_modified)
+        except:
+            interface.model = None  # Don't leave a half-built model for the worker's next job
+            recordCompleted(1)
+            reportTimings(JOB_NAME, timer, identifier=identifier, failed=True)
+            raise
+
+    recordChange(change)
 
     # Collect stats for after
     datetime_after = datetime.datetime.now()
@@ -350,19 +911,181 @@ def add_dataset(graph, interface, identifier, doc=None):
     datetime_diff_seconds = datetime_diff.seconds + datetime_diff.microseconds / 1e6
 
     logging.info("[%s] [%s] Dataset added in: %f second(s).", JOB_NAME, identifier, datetime_diff_seconds)
+    reportTimings(JOB_NAME, timer, identifier=identifier, failed=False)
+    recordCompleted(1, datetime_diff_seconds)
+
+    connection_stats = graph.connection_stats()
+    logging.info("[%s] [%s] SPARQL requests=%d connections=%d reused=%d", JOB_NAME, identifier, connection_stats['requests'], connection_stats['connections'], connection_stats['reused'])
+
+    if dataone.DOCUMENT_CACHE is not None:
+        cache_stats = dataone.DOCUMENT_CACHE.stats()
+        logging.info("[%s] [%s] Document cache size=%d hits=%s misses=%s", JOB_NAME, identifier, cache_stats['size'], cache_stats['hits'], cache_stats['misses'])
+        metrics.setGauge('d1lod_document_cache_bytes', cache_stats['size'])
+
+
+@timed
+def add_datasets(records):
+    """Adds a batch of datasets from their Solr fields (dataone.SolrRecords),
+    writing their triples into the graph with as few
+    INSERT DATA requests as possible.
+
+    Datasets with a newer version queued since are skipped. The locks on the
+    rest (see lockDataset) are taken up front, in order, and held until the
+    batch is written."""
+
+    JOB_NAME = "JOB_ADD_DATASETS"
+    logging.info("[%s] Job started with %d datasets.", JOB_NAME, len(records))
+
+    interface = getInterface()
+    datasets = []
+
+    for record in records:
+        if isSuperseded(record.identifier, record.date_modified):
+            logging.info("[%s] [%s] Skipping dataset because a newer version has been queued.", JOB_NAME, record.identifier)
+            continue
+
+        datasets.append(record)
+
+    datetime_before = datetime.datetime.now()
+    timer = timing.StageTimer()
+    locks = []
+
+    try:
+        with timing.activate(timer):
+            # Locking in order means two batches can't each wait on the other
+            with timing.stage('lock'):
+                for identifier in sorted(set([record.identifier for record in datasets])):
+                    locks.append(lockDataset(identifier))
+
+            writer = interface.beginBatch()
+
+            # Changes are only recorded once the batch is in the graph, since
+            # export_changeset reads the changed datasets back out of it
+            changes = []
+
+            try:
+                for record in datasets:
+                    logging.info("[%s] [%s] Adding dataset with identifier='%s'", JOB_NAME, record.identifier, record.identifier)
+
+                    try:
+                        changes.append(interface.addDataset(record.identifier, record))
+                    except Exception, e:
+                        logging.exception(e)
+                        interface.model = None  # Don't leave a half-built model behind
+            finally:
+                interface.endBatch()
+
+            for change in changes:
+                recordChange(change)
+    except:
+        recordCompleted(len(records))
+        reportTimings(JOB_NAME, timer, datasets=len(datasets), failed=True)
+        raise
+    finally:
+        for lock in locks:
+            releaseDataset(lock)
+
+        for record in datasets:
+            clearInFlight(record.identifier, record.date_modified)
+
+    datetime_after = datetime.datetime.now()
+    datetime_diff = datetime_after - datetime_before
+    datetime_diff_seconds = datetime_diff.seconds + datetime_diff.microseconds / 1e6
+
+    logging.info("[%s] %d datasets added in: %f second(s) using %d INSERT DATA request(s).", JOB_NAME, len(records), datetime_diff_seconds, writer.flushes)
+    reportTimings(JOB_NAME, timer, datasets=len(datasets), failed=False)
+    recordCompleted(len(records), datetime_diff_seconds)
+
+
+@timed
+def rebuild_match_key_index(force=False):
+    """Build the person/organization match key index from the graph if it
+    hasn't been built yet (or always, if `force` is set)."""
+
+    JOB_NAME = "JOB_REBUILD_MATCH_KEY_INDEX"
+    logging.info("[%s] Job started.", JOB_NAME)
+
+    interface = getInterface()
+
+    if not force and interface.matchKeyIndexIsComplete():
+        logging.info("[%s] Match key index is already complete.", JOB_NAME)
+        return
+
+    datetime_before = datetime.datetime.now()
+    interface.rebuildMatchKeyIndex()
+    datetime_after = datetime.datetime.now()
+    datetime_diff = datetime_after - datetime_before
+    datetime_diff_seconds = datetime_diff.seconds + datetime_diff.microseconds / 1e6
 
+    logging.info("[%s] Rebuilt match key index in %f second(s).", JOB_NAME, datetime_diff_seconds)
 
+
+@timed
 def export_graph():
+    """Export the entire graph as Turtle to DUMP_FILEPATH."""
+
     JOB_NAME = "EXPORT_GRAPH"
     logging.info("[%s] Job started.", JOB_NAME)
 
-    g = Graph(host=VIRTUOSO_HOST, port=VIRTUOSO_PORT, name=VIRTUOSO_GRAPH, ns=NAMESPACES)
+    g = getGraph()
+
+    # Changes made while the dump is written go into later changesets, so it
+    # picks up after the last changeset written before it starts
+    dump_sequence = export.getLatestChangesetSequence(CHANGESET_DIRECTORY)
 
     logging.info("[%s] Exporting graph of size %d.", JOB_NAME, g.size())
 
+    datetime_before = datetime.datetime.now()
+
     try:
-        with open("/www/d1lod.ttl", "wb") as f:
-            dump = g.export()
-            f.write(dump.encode('utf-8'))
+        num_triples = export.exportGraph(g, DUMP_FILEPATH, format='turtle', compress=DUMP_COMPRESS)
     except Exception, e:
         logging.exception(e)
+        return
+
+    datetime_after = datetime.datetime.now()
+    datetime_diff = datetime_after - datetime_before
+    datetime_diff_seconds = datetime_diff.seconds + datetime_diff.microseconds / 1e6
+
+    logging.info("[%s] Exported %d triples to %s in %f second(s).", JOB_NAME, num_triples, DUMP_FILEPATH, datetime_diff_seconds)
+
+    conn.set(REDIS_DUMP_SEQUENCE_KEY, dump_sequence)
+
+    last_run = getLastRun()
+
+    if last_run is not None:
+        updateVoIDFile(last_run, dump_sequence=dump_sequence)
+
+
+@timed
+def export_changeset():
+    """Write the changes made since the last changeset into a new changeset
+    in CHANGESET_DIRECTORY and list it in the VoID file."""
+
+    JOB_NAME = "EXPORT_CHANGESET"
+    logging.info("[%s] Job started.", JOB_NAME)
+
+    # Set aside the changed datasets so add_dataset jobs can keep recording
+    # new ones while we write. A leftover set from a failed run is written
+    # out first.
+    if not conn.exists(REDIS_CHANGES_EXPORTING_KEY):
+        if not conn.exists(REDIS_CHANGES_KEY):
+            logging.info("[%s] No changes since the last changeset.", JOB_NAME)
+            return
+
+        conn.rename(REDIS_CHANGES_KEY, REDIS_CHANGES_EXPORTING_KEY)
+
+    filenames = export.writeChangeset(iterChanges(REDIS_CHANGES_EXPORTING_KEY, getInterface()), CHANGESET_DIRECTORY)
+    conn.delete(REDIS_CHANGES_EXPORTING_KEY)
+
+    logging.info("[%s] Wrote changeset files %s.", JOB_NAME, ", ".join(filenames))
+
+    num_pruned = export.pruneChangesets(CHANGESET_DIRECTORY, CHANGESET_RETAIN)
+
+    if num_pruned > 0:
+        logging.info("[%s] Pruned %d old changeset(s).", JOB_NAME, num_pruned)
+
+    last_run = getLastRun()
+
+    if last_run is not None:
+        updateVoIDFile(last_run)
@@ -1,4 +1,6 @@
+import xpath
 import eml
 import dryad
 import fgdc
 import iso
+import registry
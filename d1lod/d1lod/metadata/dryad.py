@@ -7,6 +7,11 @@
 
 import re
 
+from xpath import Path
+
+# Compiled once (see xpath.py)
+CREATORS = Path('.//dcterms:creator')
+
 
 def process(xmldoc, document):
     """
@@ -15,7 +20,7 @@ def process(xmldoc, document):
     """
 
     # Process each <creator>
-    creators = xmldoc.findall(".//ns2:creator", { 'ns2': 'http://purl.org/dc/terms/'})
+    creators = CREATORS.findall(xmldoc)
 
     records = []
 
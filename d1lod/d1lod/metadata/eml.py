@@ -30,6 +30,24 @@
 
 import re
 
+from xpath import Path
+
+# Paths used below, compiled once (see xpath.py)
+CREATORS = Path('.//dataset/creator')
+INDIVIDUAL_NAME = Path('./individualName')
+ORGANIZATION_NAMES = Path('./organizationName')
+ADDRESS = Path('./address')
+EMAIL = Path('./electronicMailAddress')
+VOICE_PHONE = Path("./phone[@phonetype='voice']")
+SALUTATIONS = Path('./salutation')
+GIVEN_NAMES = Path('./givenName')
+SUR_NAME = Path('./surName')
+DELIVERY_POINTS = Path('./deliveryPoint')
+CITY = Path('./city')
+ADMINISTRATIVE_AREA = Path('./administrativeArea')
+POSTAL_CODE = Path('./postalCode')
+COUNTRY = Path('./country')
+
 
 def process(xmldoc, document):
     """
@@ -39,7 +57,7 @@ def process(xmldoc, document):
 
     # Process each <dataset/creator>
     # https://knb.ecoinformatics.org/#external//emlparser/docs/eml-2.1.1/./eml-resource.html#creator
-    creators = xmldoc.findall(".//dataset/creator")
+    creators = CREATORS.findall(xmldoc)
 
     records = []
 
@@ -61,8 +79,8 @@ def processCreator(creator, document):
     records = [] # Store all records parsed
     record = {} # Stores the primary record being parsed
 
-    individual = creator.find("./individualName")
-    organizations = creator.findall("./organizationName")
+    individual = INDIVIDUAL_NAME.find(creator)
+    organizations = ORGANIZATION_NAMES.findall(creator)
 
     # Process individual or organization
     if individual is not None:  # Individual
@@ -79,12 +97,12 @@ def processCreator(creator, document):
         if len(org_strings) > 0:
             record['name'] = " ".join([o for o in org_strings if o is not None and len(o) > 0])
 
-    address = creator.find("./address")
+    address = ADDRESS.find(creator)
 
     if address is not None:
         record = processAddress(record, address)
 
-    email = creator.find("./electronicMailAddress")
+    email = EMAIL.find(creator)
 
     if email is not None and email.text is not None:
         # Extract email address, replacng 'at' with '@'
@@ -101,7 +119,7 @@ def processCreator(creator, document):
         if len(record['email']) <= 0 or record['email'].find(' ') >= 0:
             record.pop('email', None)  # None is the return value
 
-    phone = creator.find("./phone[@phonetype='voice']")
+    phone = VOICE_PHONE.find(creator)
 
     if phone is not None and phone.text is not None:
         record['phone'] = phone.text.strip()
@@ -122,9 +140,9 @@ def processCreator(creator, document):
 
 
 def processIndividual(record, individual):
-    salutations = individual.findall("./salutation")
-    given_names = individual.findall('./givenName')
-    sur_name = individual.find('./surName')
+    salutations = SALUTATIONS.findall(individual)
+    given_names = GIVEN_NAMES.findall(individual)
+    sur_name = SUR_NAME.find(individual)
 
     fields = []
 
@@ -170,11 +188,11 @@ def processIndividual(record, individual):
 
 
 def processAddress(record, address):
-    delivery_points = address.findall("./deliveryPoint")
-    city = address.find("./city")
-    admin_area = address.find("./administrativeArea")
-    postal = address.find("./postalCode")
-    country = address.find("./country")
+    delivery_points = DELIVERY_POINTS.findall(address)
+    city = CITY.find(address)
+    admin_area = ADMINISTRATIVE_AREA.find(address)
+    postal = POSTAL_CODE.find(address)
+    country = COUNTRY.find(address)
 
     fields = []
 
@@ -23,6 +23,23 @@
 
 import re
 
+from xpath import Path
+
+# Paths used below, compiled once (see xpath.py)
+ORIGINATORS = Path('./idinfo/citation/citeinfo/origin')
+CONTACT_PERSON = Path('./cntperp')
+CONTACT_ORGANIZATION = Path('./cntorgp')
+CONTACT_PERSON_NAME = Path('./cntper')
+CONTACT_ORGANIZATION_NAME = Path('./cntorg')
+CONTACT_ADDRESS = Path('./cntaddr')
+CONTACT_EMAIL = Path('./cntemail')
+CONTACT_VOICE = Path('./cntvoice')
+ADDRESS_LINES = Path('./address')
+CITY = Path('./city')
+STATE = Path('./state')
+POSTAL = Path('./postal')
+COUNTRY = Path('./country')
+
 
 def process(xmldoc, document):
     """
@@ -43,7 +60,7 @@ def process(xmldoc, document):
 
 
     # Process originator
-    origin_nodes = xmldoc.findall("./idinfo/citation/citeinfo/origin")
+    origin_nodes = ORIGINATORS.findall(xmldoc)
 
     if origin_nodes is not None:
         for origin_node in origin_nodes:
@@ -113,12 +130,12 @@ def processContactInfo(info, document):
     # If it's a cntorgp, we save it as an organization
     # If it's a cntperp, we save it as a person
 
-    cntperp = info.find("./cntperp")
-    cntorgp = info.find("./cntorgp")
+    cntperp = CONTACT_PERSON.find(info)
+    cntorgp = CONTACT_ORGANIZATION.find(info)
 
     if cntperp is not None:
-        name = cntperp.find("./cntper")
-        org = cntperp.find("./cntorg")
+        name = CONTACT_PERSON_NAME.find(cntperp)
+        org = CONTACT_ORGANIZATION_NAME.find(cntperp)
 
         if name is not None and name.text is not None:
             record['name'] = name.text.strip()
@@ -127,14 +144,14 @@ def processContactInfo(info, document):
             record['organization'] = org.text.strip()
 
     if cntorgp is not None:
-        org = cntorgp.find("./cntorg")
+        org = CONTACT_ORGANIZATION_NAME.find(cntorgp)
 
         if org is not None and org.text is not None:
             record['organization'] = org.text.strip()
 
-    address = info.find("./cntaddr")
-    email = info.find("./cntemail")
-    voice = info.find("./cntvoice")
+    address = CONTACT_ADDRESS.find(info)
+    email = CONTACT_EMAIL.find(info)
+    voice = CONTACT_VOICE.find(info)
 
     if address is not None:
         processAddress(record, address)
@@ -165,11 +182,11 @@ def processContactInfo(info, document):
 
 
 def processAddress(record, address):
-    address_nodes = address.findall("./address")
-    city = address.find("./city")
-    state = address.find("./state")
-    postal = address.find("./postal")
-    country = address.find("./country")
+    address_nodes = ADDRESS_LINES.findall(address)
+    city = CITY.find(address)
+    state = STATE.find(address)
+    postal = POSTAL.find(address)
+    country = COUNTRY.find(address)
 
     fields = []
 
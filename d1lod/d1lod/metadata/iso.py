@@ -51,16 +51,31 @@ References:
 
 import re
 
+from xpath import Path
+
+# Paths used below, compiled once (see xpath.py)
+CITED_PARTIES = Path('.//gmd:identificationInfo/gmd:MD_DataIdentification/gmd:citation/gmd:CI_Citation/gmd:citedResponsibleParty/gmd:CI_ResponsibleParty')
+INDIVIDUAL_NAME = Path('./gmd:individualName')
+ORGANISATION_NAME = Path('./gmd:organisationName')
+CONTACT = Path('./gmd:contactInfo/gmd:CI_Contact')
+ROLE_CODE = Path('./gmd:role/gmd:CI_RoleCode')
+ADDRESS = Path('./gmd:address/gmd:CI_Address')
+DELIVERY_POINTS = Path('./gmd:deliveryPoint/gco:CharacterString')
+CITY = Path('./gmd:city/gco:CharacterString')
+ADMINISTRATIVE_AREA = Path('./gmd:administrativeArea/gco:CharacterString')
+POSTAL_CODE = Path('./gmd:postalCode/gco:CharacterString')
+COUNTRY = Path('./gmd:country/gco:CharacterString')
+EMAIL = Path('./gmd:electronicMailAddress/gco:CharacterString')
+PHONE = Path('./gmd:phone/gmd:CI_Telephone/gmd:voice/gco:CharacterString')
+
 
 def process(xmldoc, document=None):
     """Process the XML document for metadata and data contacts."""
 
-    gmd = '{http://www.isotc211.org/2005/gmd}'
-
     records = []
 
     # Process metadata
-    parties = xmldoc.findall('.//'+gmd+'identificationInfo/'+gmd+'MD_DataIdentification/'+gmd+'citation/'+gmd+'CI_Citation/'+gmd+'citedResponsibleParty/'+gmd+'CI_ResponsibleParty')
+    parties = CITED_PARTIES.findall(xmldoc)
 
     for party in parties:
         record = processResponsibleParty(party, document)
@@ -84,11 +99,6 @@ def processResponsibleParty(party, document):
     5. role
     """
 
-    # Define prefixes
-    gmd = '{http://www.isotc211.org/2005/gmd}'
-    gco = '{http://www.isotc211.org/2005/gco}'
-    gmx = '{http://www.isotc211.org/2005/gmx}'
-
     # Set aside a blank record
     record = {}
 
@@ -98,8 +108,8 @@ def processResponsibleParty(party, document):
     gmx:Anchor
     """
 
-    individ_name = party.find('./'+gmd+'individualName')
-    org_name = party.find('./'+gmd+'organisationName')
+    individ_name = INDIVIDUAL_NAME.find(party)
+    org_name = ORGANISATION_NAME.find(party)
 
     # Person
     if individ_name is not None:
@@ -127,7 +137,7 @@ def processResponsibleParty(party, document):
                 record['type'] = 'organization'
 
     # contactInfo
-    contact = party.find('./'+gmd+'contactInfo/'+gmd+'CI_Contact')
+    contact = CONTACT.find(party)
 
     if contact is not None:
         contact_record = processCIContact(contact)
@@ -169,7 +179,7 @@ def processResponsibleParty(party, document):
     Other concepts are not mapped.
     """
 
-    role_code = party.find('./'+gmd+'role/'+gmd+'CI_RoleCode')
+    role_code = ROLE_CODE.find(party)
 
     if role_code is not None:
         codeListValue = role_code.get('codeListValue')
@@ -202,42 +212,38 @@ def processResponsibleParty(party, document):
 def processCIContact(contact_info):
     """Extracts relevant fields from a gmd:CI_Contact element."""
 
-    # Define prefixes
-    gmd = '{http://www.isotc211.org/2005/gmd}'
-    gco = '{http://www.isotc211.org/2005/gco}'
-
     # Store partial record
     record = {}
 
     # Address
-    address = contact_info.find('./'+gmd+'address/'+gmd+'CI_Address')
+    address = ADDRESS.find(contact_info)
 
     if address is not None:
         # Mailing address
         address_strings = [] # Just append each address part to a List
 
-        delivery_points = address.findall('./'+gmd+'deliveryPoint/'+gco+'CharacterString')
+        delivery_points = DELIVERY_POINTS.findall(address)
 
         for dp in delivery_points:
             if dp.text is not None:
                 address_strings.append(dp.text)
 
-        city = address.find('./'+gmd+'city/'+gco+'CharacterString')
+        city = CITY.find(address)
 
         if city is not None and city.text is not None:
             address_strings.append(city.text)
 
-        admin_area = address.find('./'+gmd+'administrativeArea/'+gco+'CharacterString')
+        admin_area = ADMINISTRATIVE_AREA.find(address)
 
         if admin_area is not None and admin_area.text is not None:
             address_strings.append(admin_area.text)
 
-        postal_code = address.find('./'+gmd+'postalCode/'+gco+'CharacterString')
+        postal_code = POSTAL_CODE.find(address)
 
         if postal_code is not None and postal_code.text is not None:
             address_strings.append(postal_code.text)
 
-        country = address.find('./'+gmd+'country/'+gco+'CharacterString')
+        country = COUNTRY.find(address)
 
         if country is not None and country.text is not None:
             address_strings.append(country.text)
@@ -246,7 +252,7 @@ def processCIContact(contact_info):
             record['address'] = " ".join(address_strings)
 
         # Email
-        email = address.find('./'+gmd+'electronicMailAddress/'+gco+'CharacterString')
+        email = EMAIL.find(address)
 
         if email is not None and email.text is not None:
 
@@ -257,7 +263,7 @@ def processCIContact(contact_info):
                 record.pop('email', None)  # None is the return value
 
     # Phone
-    phone = contact_info.find('./'+gmd+'phone/'+gmd+'CI_Telephone/'+gmd+'voice/'+gco+'CharacterString')
+    phone = PHONE.find(contact_info)
 
     if phone is not None and phone.text is not None:
         record['phone_number'] = phone.text
@@ -0,0 +1,218 @@
+""" registry.py
+
+    A registry of the metadata formats people and organizations can be
+    extracted from, and of how to recognize each one.
+
+    A format is registered with the function that processes it and any
+    number of keys to recognize it by:
+
+    - CN formatIds, e.g. 'eml://ecoinformatics.org/eml-2.1.1'
+    - Namespace URIs of the document's root element
+    - Local names of the document's root element, for formats whose root
+      isn't namespaced (or whose namespace varies)
+
+    Each is a dictionary lookup, tried in that order. A formatId that isn't
+    registered gets the format detected from its first document and the
+    result is remembered so later documents with the same formatId are
+    dispatched without looking at their root element.
+
+    New formats can be added with register(), e.g.
+
+        registry.register('dif', dif.process, namespaces=[DIF_NAMESPACE])
+
+    Formats registered with the tags of the elements their processor looks
+    in (`keep`) can be parsed with iterparse, which discards the rest of the
+    document as it's read.
+"""
+
+import xpath
+import eml
+import dryad
+import fgdc
+import iso
+
+UNKNOWN = 'unknown'
+
+# Processing functions, indexed by format name
+PROCESSORS = {}
+
+# Format names, indexed by CN formatId, root namespace URI, and root local name
+FORMAT_IDS = {}
+NAMESPACES = {}
+ROOT_NAMES = {}
+
+# Format names detected for formatIds that aren't registered
+DETECTED = {}
+
+# Tags of the subtrees each format's processor looks in, indexed by format
+# name (see iterparse)
+KEEP = {}
+
+
+def register(name, process, format_ids=(), namespaces=(), root_names=(), keep=None):
+    """Register a metadata format.
+
+    Arguments:
+    ----------
+
+    name : str
+        Name of the format, e.g. 'eml'
+
+    process : function
+        Called as process(xmldoc, identifier) to extract a List of records
+
+    format_ids : List
+        CN formatIds of documents in this format
+
+    namespaces : List
+        Namespace URIs of the root elements of documents in this format
+
+    root_names : List
+        Local names of the root elements of documents in this format
+
+    keep : List
+        (optional) Tags of the elements `process` looks in (and under).
+        iterparse keeps whole documents in formats without them.
+
+    Returns: None
+    """
+
+    PROCESSORS[name] = process
+
+    if keep is not None:
+        KEEP[name] = frozenset(keep)
+    else:
+        KEEP.pop(name, None)
+
+    for format_id in format_ids:
+        FORMAT_IDS[format_id] = name
+
+    for namespace in namespaces:
+        NAMESPACES[namespace] = name
+
+    for root_name in root_names:
+        ROOT_NAMES[root_name] = name
+
+    # Anything detected before may now be recognized differently
+    DETECTED.clear()
+
+
+def splitTag(tag):
+    """Split an element's tag, e.g. '{http://...}MI_Metadata', into its
+    namespace URI (None if it has none) and local name."""
+
+    if tag[:1] == '{':
+        namespace, name = tag[1:].split('}', 1)
+
+        return namespace, name
+
+    return None, tag
+
+
+def detectFormat(xmldoc, format_id=None):
+    """Detect the format of the metadata in `xmldoc`.
+
+    Arguments:
+    ----------
+
+    xmldoc : Element
+        The document (or its root element)
+
+    format_id : str
+        (optional) The document's CN formatId
+
+    Returns:
+        The name of the format, or UNKNOWN.
+    """
+
+    if format_id is not None:
+        if format_id in FORMAT_IDS:
+            return FORMAT_IDS[format_id]
+
+        if format_id in DETECTED:
+            return DETECTED[format_id]
+
+    if hasattr(xmldoc, 'getroot'):
+        xmldoc = xmldoc.getroot()
+
+    namespace, root_name = splitTag(xmldoc.tag)
+
+    if namespace in NAMESPACES:
+        name = NAMESPACES[namespace]
+    elif root_name in ROOT_NAMES:
+        name = ROOT_NAMES[root_name]
+    else:
+        return UNKNOWN
+
+    if format_id is not None:
+        DETECTED[format_id] = name
+
+    return name
+
+
+def getProcessor(name):
+    """Get the processing function for the format `name`, or None if there
+    isn't one."""
+
+    return PROCESSORS.get(name)
+
+
+def iterparse(source, format_id=None):
+    """Parse the metadata document in the file-like object `source` as it's
+    read, keeping only the parts its format's processor looks at (see
+    xpath.iterparse). Reading stops at the root element if the format isn't
+    known.
+
+    Arguments:
+    ----------
+
+    source : file
+        The document
+
+    format_id : str
+        (optional) The document's CN formatId
+
+    Returns:
+        The document's (pruned) root element.
+    """
+
+    def select(root):
+        name = detectFormat(root, format_id)
+
+        if name not in PROCESSORS:
+            return None
+
+        return KEEP.get(name, xpath.ALL)
+
+    return xpath.iterparse(source, select)
+
+
+register('eml', eml.process,
+         format_ids=['eml://ecoinformatics.org/eml-2.0.0',
+                     'eml://ecoinformatics.org/eml-2.0.1',
+                     'eml://ecoinformatics.org/eml-2.1.0',
+                     'eml://ecoinformatics.org/eml-2.1.1',
+                     'https://eml.ecoinformatics.org/eml-2.2.0'],
+         root_names=['eml'],
+         keep=['creator'])
+
+register('dryad', dryad.process,
+         format_ids=['http://datadryad.org/profile/v3.1'],
+         namespaces=['http://purl.org/dryad/schema/terms/v3.1'],
+         root_names=['DryadDataPackage', 'DryadDataFile'],
+         keep=['{http://purl.org/dc/terms/}creator'])
+
+register('fgdc', fgdc.process,
+         format_ids=['FGDC-STD-001-1998',
+                     'FGDC-STD-001.1-1999',
+                     'FGDC-STD-001.2-1999'],
+         root_names=['metadata'],
+         keep=['origin'])
+
+register('iso', iso.process,
+         format_ids=['http://www.isotc211.org/2005/gmd',
+                     'http://www.isotc211.org/2005/gmd-noaa',
+                     'http://www.isotc211.org/2005/gmd-pangaea'],
+         namespaces=['http://www.isotc211.org/2005/gmd',
+                     'http://www.isotc211.org/2005/gmi'],
+         keep=['{http://www.isotc211.org/2005/gmd}citedResponsibleParty'])
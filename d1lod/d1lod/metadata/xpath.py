@@ -0,0 +1,218 @@
+""" xpath.py
+
+    Precompiled paths for extracting people and organizations from metadata
+    documents.
+
+    Each format module declares the paths it uses once, at import, as Path
+    objects. When lxml is installed, every Path is compiled to an lxml XPath
+    object up front and reused for every document parsed with fromstring or
+    parse, which use lxml too.
+
+    Documents parsed with xml.etree.ElementTree (e.g., in the tests) are
+    searched with ElementTree's own find/findall using the same path, so
+    paths must stay within the subset of XPath that ElementTree supports:
+    child and descendant steps, '*', and [@attribute='value'] predicates.
+    Namespaced steps use the prefixes in NAMESPACES, e.g. 'gmd:CI_Contact'.
+
+    Science metadata comes from untrusted sources, so lxml is told not to
+    expand entities or fetch anything over the network. Otherwise a document
+    could pull in local files (e.g., <!ENTITY x SYSTEM "file:///etc/passwd">)
+    which would end up in the graph. ElementTree never loads external
+    entities.
+
+    iterparse parses a document as it's read, only keeping the subtrees
+    (e.g., <creator>s) the processors look at along with their ancestors.
+    Everything else is discarded as soon as it's been parsed, so large
+    documents (e.g., EML with long attribute lists or inline data) are never
+    held in memory in full.
+"""
+
+import xml.etree.ElementTree as ET
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+NAMESPACES = {
+    'gmd': 'http://www.isotc211.org/2005/gmd',
+    'gco': 'http://www.isotc211.org/2005/gco',
+    'gmx': 'http://www.isotc211.org/2005/gmx',
+    'dcterms': 'http://purl.org/dc/terms/'
+}
+
+# Options for lxml's parsers. Comments and processing instructions are
+# dropped, as ElementTree does, so they don't show up as children of the
+# elements we look at. Entities are left unexpanded (see above).
+PARSER_OPTIONS = {
+    'remove_comments': True,
+    'remove_pis': True,
+    'resolve_entities': False,
+    'no_network': True
+}
+
+if etree is not None:
+    PARSER = etree.XMLParser(**PARSER_OPTIONS)
+    PARSE_ERRORS = (etree.XMLSyntaxError, ET.ParseError)
+else:
+    PARSER = None
+    PARSE_ERRORS = (ET.ParseError,)
+
+# Returned by an iterparse `select` function to keep the whole document
+ALL = 'all'
+
+
+def fromstring(content):
+    """Parse the XML document in `content`, with lxml if it's installed.
+
+    Returns: The document's root element
+    """
+
+    if etree is not None:
+        return etree.fromstring(content, PARSER)
+
+    return ET.fromstring(content)
+
+
+def parse(source):
+    """Parse the XML document in the file (or file-like object) `source`,
+    with lxml if it's installed.
+
+    Returns: The document's root element
+    """
+
+    if etree is not None:
+        return etree.parse(source, PARSER).getroot()
+
+    return ET.parse(source).getroot()
+
+
+def iterparse(source, select):
+    """Parse the XML document in the file-like object `source` as it's read,
+    keeping only the subtrees whose root tag was selected.
+
+    Arguments:
+    ----------
+
+    source : file
+        The document
+
+    select : function
+        Called with the document's root element (with no children yet).
+        Returns the tags (e.g., 'creator' or '{namespace}creator') of the
+        subtrees to keep, ALL to keep the whole document, or None to stop
+        parsing straight away.
+
+    Returns:
+        The document's root element, with only the selected subtrees (and
+        their ancestors) under it.
+    """
+
+    if etree is not None:
+        events = etree.iterparse(source, events=('start', 'end'), **PARSER_OPTIONS)
+    else:
+        events = ET.iterparse(source, events=('start', 'end'))
+
+    root = None
+    keep = None
+
+    # [element, whether it's in a kept subtree, whether it has a kept
+    # subtree under it] for each open element
+    stack = []
+
+    for event, element in events:
+        if event == 'start':
+            if root is None:
+                root = element
+                keep = select(root)
+
+                if keep is None:
+                    # Drop whatever else was parsed from the same read
+                    del root[:]
+                    break
+
+                stack.append([element, keep == ALL, False])
+                continue
+
+            parent = stack[-1]
+            stack.append([element, parent[1] or element.tag in keep, False])
+            continue
+
+        element, kept, has_kept = stack.pop()
+
+        if len(stack) == 0:
+            break
+
+        parent = stack[-1]
+
+        if kept or has_kept:
+            parent[2] = True
+            continue
+
+        element.clear()
+        parent[0].remove(element)
+
+    return root
+
+
+class Path:
+    def __init__(self, path, namespaces=NAMESPACES):
+        """Initialize and, if lxml is installed, compile a path.
+
+        Arguments:
+        ----------
+
+        path : str
+            The path, relative to the element it's applied to, e.g.
+            './address/city'
+
+        namespaces : Dict
+            Namespace URIs, indexed by the prefixes used in `path`
+        """
+
+        self.path = path
+        self.namespaces = namespaces
+        self.xpath = None
+
+        if etree is not None:
+            self.xpath = etree.XPath(path, namespaces=namespaces)
+
+
+    def __str__(self):
+        return "Path: '%s'" % self.path
+
+
+    def findall(self, element):
+        """Find every element matching the path under `element`, which may
+        also be a whole document.
+
+        Returns: List of elements
+        """
+
+        if hasattr(element, 'getroot'):
+            element = element.getroot()
+
+        if self.xpath is not None and isinstance(element, etree._Element):
+            return self.xpath(element)
+
+        return element.findall(self.path, self.namespaces)
+
+
+    def find(self, element):
+        """Find the first element matching the path under `element`.
+
+        Returns: An element or None
+        """
+
+        if hasattr(element, 'getroot'):
+            element = element.getroot()
+
+        if self.xpath is not None and isinstance(element, etree._Element):
+            results = self.xpath(element)
+
+            if len(results) > 0:
+                return results[0]
+
+            return None
+
+        return element.find(self.path, self.namespaces)
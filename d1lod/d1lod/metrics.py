@@ -0,0 +1,294 @@
+""" metrics.py
+
+    Prometheus-style metrics for the D1 LOD service.
+
+    Jobs run in several worker processes (which are restarted when they die)
+    so metrics are accumulated in Redis rather than in memory. Each metric is a
+    Redis hash under KEY_PREFIX + name whose fields are the metric's label
+    sets, e.g.
+
+        metrics:d1lod_sparql_requests_total
+            operation="query",status="200" -> 1234
+
+    Histograms store a count per bucket (non-cumulative) plus the sum and
+    count of their observations. Each recording is a single round trip to
+    Redis. Failures to record are logged and never raised.
+
+    serve() starts a background HTTP server which renders every metric in
+    METRICS in the Prometheus text exposition format at /metrics. Since every
+    process reads the same metrics out of Redis, only one process (the
+    scheduler) serves them. Otherwise each series would be scraped once per
+    process.
+"""
+
+import math
+import logging
+import threading
+import BaseHTTPServer
+
+KEY_PREFIX = 'metrics:'
+
+# (seconds) Upper bounds of the histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Every metric that can be recorded, with its type and help text
+METRICS = {
+    'd1lod_queue_length': ('gauge', "Number of jobs waiting on each RQ queue."),
+    'd1lod_graph_triples': ('gauge', "Number of triples in the graph."),
+    'd1lod_graph_concepts': ('gauge', "Number of distinct instances of each concept in the graph."),
+    'd1lod_document_cache_bytes': ('gauge', "Size of the document cache."),
+    'd1lod_jobs_total': ('counter', "Number of jobs run, by job and outcome."),
+    'd1lod_job_duration_seconds': ('histogram', "Time taken by each job."),
+    'd1lod_stage_duration_seconds': ('histogram', "Time taken by each stage of a job (see d1lod.timing)."),
+    'd1lod_sparql_requests_total': ('counter', "Number of requests sent to the SPARQL endpoint, by operation and status."),
+    'd1lod_sparql_request_duration_seconds': ('histogram', "Time taken by requests to the SPARQL endpoint, by operation."),
+    'd1lod_cn_requests_total': ('counter', "Number of requests sent to the DataOne CN, by endpoint and status."),
+    'd1lod_cn_request_duration_seconds': ('histogram', "Time taken by requests to the DataOne CN, by endpoint."),
+    'd1lod_http_retries_total': ('counter', "Number of HTTP requests retried, by host."),
+    'd1lod_document_cache_requests_total': ('counter', "Number of document cache lookups, by kind and result.")
+}
+
+# Redis connection metrics are stored with. See setConnection.
+CONNECTION = None
+
+
+def setConnection(conn):
+    """Set the Redis connection metrics are stored with. Metrics aren't
+    recorded until this is called."""
+
+    global CONNECTION
+    CONNECTION = conn
+
+
+def formatLabels(labels):
+    """Format a Dict of labels as the inside of a Prometheus label set, e.g.
+    'operation="query",status="200"'."""
+
+    if labels is None or len(labels) == 0:
+        return ''
+
+    escape = lambda value: unicode(value).replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n')
+
+    return u",".join([u'%s="%s"' % (name, escape(labels[name])) for name in sorted(labels)])
+
+
+def formatBucket(bound):
+    """Format a bucket's upper bound as its 'le' label value."""
+
+    if bound == float('inf'):
+        return '+Inf'
+
+    return repr(float(bound))
+
+
+def record(name, operations):
+    """Apply `operations`, a list of (method, args) tuples, to a Redis
+    pipeline in one round trip, logging rather than raising failures."""
+
+    if CONNECTION is None:
+        return
+
+    if name not in METRICS:
+        logging.error("Failed to record metric %s: Unknown metric.", name)
+        return
+
+    try:
+        pipe = CONNECTION.pipeline(transaction=False)
+
+        for method, args in operations:
+            getattr(pipe, method)(*args)
+
+        pipe.execute()
+    except Exception, e:
+        logging.error("Failed to record metric %s: %s", name, e)
+
+
+def increment(name, labels=None, value=1):
+    """Increment the counter `name`."""
+
+    record(name, [('hincrbyfloat', (KEY_PREFIX + name, formatLabels(labels), value))])
+
+
+def setGauge(name, value, labels=None):
+    """Set the gauge `name` to `value`."""
+
+    record(name, [('hset', (KEY_PREFIX + name, formatLabels(labels), value))])
+
+
+def observe(name, value, labels=None, buckets=DEFAULT_BUCKETS):
+    """Record an observation (e.g., a duration in seconds) in the histogram
+    `name`."""
+
+    label_string = formatLabels(labels)
+    bucket = float('inf')
+
+    for bound in buckets:
+        if value <= bound:
+            bucket = bound
+            break
+
+    key = KEY_PREFIX + name
+
+    record(name, [('hincrby', (key, label_string + u"|" + formatBucket(bucket), 1)),
+                  ('hincrbyfloat', (key, label_string + u"|sum", value)),
+                  ('hincrby', (key, label_string + u"|count", 1))])
+
+
+def formatValue(value):
+    """Format a sample value, dropping the decimals of whole numbers."""
+
+    value = float(value)
+
+    if value == math.floor(value) and abs(value) < 1e15:
+        return str(int(value))
+
+    return repr(value)
+
+
+def formatMetric(name, metric_type, help_text, values, buckets=DEFAULT_BUCKETS):
+    """Format a metric in the Prometheus text exposition format.
+
+    Arguments:
+    ----------
+
+    name : str
+        Metric name
+
+    metric_type : str
+        'counter', 'gauge' or 'histogram'
+
+    help_text : str
+        Description of the metric
+
+    values : Dict
+        The metric's Redis hash
+
+    buckets : tuple
+        Histogram bucket upper bounds
+
+    Returns:
+        List of lines
+    """
+
+    lines = ["# HELP %s %s" % (name, help_text), "# TYPE %s %s" % (name, metric_type)]
+
+    if metric_type != 'histogram':
+        for label_string in sorted(values):
+            if len(label_string) > 0:
+                lines.append(u"%s{%s} %s" % (name, label_string, formatValue(values[label_string])))
+            else:
+                lines.append(u"%s %s" % (name, formatValue(values[label_string])))
+
+        return lines
+
+    # Group the histogram's fields by label set
+    series = {}
+
+    for field in values:
+        label_string, suffix = field.rsplit(u"|", 1)
+        series.setdefault(label_string, {})[suffix] = float(values[field])
+
+    for label_string in sorted(series):
+        fields = series[label_string]
+        prefix = label_string + u"," if len(label_string) > 0 else u""
+        cumulative = 0
+
+        for bound in list(buckets) + [float('inf')]:
+            le = formatBucket(bound)
+            cumulative += fields.get(le, 0)
+            lines.append(u'%s_bucket{%sle="%s"} %s' % (name, prefix, le, formatValue(cumulative)))
+
+        label_set = u"{%s}" % label_string if len(label_string) > 0 else u""
+        lines.append(u"%s_sum%s %s" % (name, label_set, formatValue(fields.get('sum', 0))))
+        lines.append(u"%s_count%s %s" % (name, label_set, formatValue(fields.get('count', 0))))
+
+    return lines
+
+
+def render():
+    """Render every metric in METRICS in the Prometheus text exposition
+    format.
+
+    Returns: str
+    """
+
+    if CONNECTION is None:
+        return ""
+
+    pipe = CONNECTION.pipeline(transaction=False)
+    names = sorted(METRICS)
+
+    for name in names:
+        pipe.hgetall(KEY_PREFIX + name)
+
+    lines = []
+
+    for name, values in zip(names, pipe.execute()):
+        metric_type, help_text = METRICS[name]
+        values = dict([(field.decode('utf-8'), value) for field, value in values.iteritems()])
+        lines.extend(formatMetric(name, metric_type, help_text, values))
+
+    return (u"\n".join(lines) + u"\n").encode('utf-8')
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Called before each render to update gauges (see serve)
+    collect = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        try:
+            if self.collect is not None:
+                self.collect()
+
+            body = render()
+        except Exception, e:
+            logging.exception(e)
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise be logged to stderr
+        pass
+
+
+def serve(port, collect=None):
+    """Serve /metrics on `port` from a daemon thread.
+
+    Arguments:
+    ----------
+
+    port : int
+        Port to listen on
+
+    collect : function
+        (optional) Called before each scrape, e.g. to set gauges
+
+    Returns: threading.Thread
+    """
+
+    class Handler(MetricsHandler):
+        pass
+
+    if collect is not None:
+        Handler.collect = staticmethod(collect)
+
+    server = BaseHTTPServer.HTTPServer(('', port), Handler)
+
+    thread = threading.Thread(target=server.serve_forever, name="MetricsServer")
+    thread.daemon = True
+    thread.start()
+
+    logging.info("Serving metrics on port %d.", port)
+
+    return thread
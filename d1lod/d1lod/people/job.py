@@ -7,6 +7,7 @@
 """
 
 import os
+import multiprocessing
 import processing
 import helpers
 import unicodecsv
@@ -92,10 +93,16 @@ class Job:
             access = access[['guid', 'permission']]
             access = access[access.permission >= 4]
 
-            self.public_pids = access.guid.tolist()
+            self.public_pids = set(access.guid.tolist())
 
-    def run(self):
-        processing.processDirectory(self)
+    def run(self, processes=1):
+        """Process the directory, parsing documents in `processes` processes
+        (0 for one per core). See processing.processDirectory."""
+
+        if processes == 0:
+            processes = multiprocessing.cpu_count()
+
+        processing.processDirectory(self, processes)
 
     def finish(self):
         if self.people_file_handle:
@@ -10,54 +10,126 @@
     The document a person/organization was found in are also added to that
     person/organization so the documents belonging to that person/organization
     can be attributed to them and used in later graph generation activities.
+
+    Documents can be parsed and processed by a pool of processes (see
+    processDirectory). Their records are still written by the Job, one
+    document at a time in filename order, so the output (including row IDs)
+    is the same however many processes are used.
 """
 
 import os
 import re
-import xml.etree.ElementTree as ET
-from xml.etree.ElementTree import ParseError
-from d1lod.metadata import eml
-from d1lod.metadata import dryad
-from d1lod.metadata import fgdc
+import itertools
+import multiprocessing
+from d1lod.metadata import xpath
+from d1lod.metadata import registry
+
+# Number of documents handed to a worker process at a time
+PROCESS_CHUNK_SIZE = 100
+
+# (directory, identifier_map, public_pids) of the directory being processed.
+# Set in each worker process by initProcess.
+PROCESS_STATE = None
 
 
-def processDirectory(job):
-    filenames = os.listdir("%s" % job.directory)
+def processDirectory(job, processes=1):
+    """Process every document in the job's directory, writing the people and
+    organizations found to the job.
+
+    Arguments:
+        job: Job
+            The Job to process the directory of and write records to
+
+        processes: int
+            Number of processes to parse and process documents in. Records
+            are written by this process either way.
+
+    Returns: None
+    """
+
+    filenames = sorted(os.listdir("%s" % job.directory))
+    state = (job.directory, job.identifier_map, job.public_pids)
+    pool = None
+
+    if processes > 1:
+        # Worker processes are forked so they get the (large) identifier map
+        # and access list without them being pickled
+        pool = multiprocessing.Pool(processes, initProcess, state)
+        results = pool.imap(processFile, filenames, PROCESS_CHUNK_SIZE)
+    else:
+        initProcess(*state)
+        results = itertools.imap(processFile, filenames)
 
     i = 0
-    for filename in filenames:
-        if i % 1000 == 0:
-            print "%d..." % i
 
-        try:
-            xmldoc = ET.parse("%s/%s" % (job.directory, filename))
-        except ParseError:
-            continue
+    try:
+        for records in results:
+            # Documents that couldn't be parsed
+            if records is None:
+                continue
+
+            if i % 1000 == 0:
+                print "%d..." % i
+
+            saveRecords(job, records)
+            i += 1
+    except:
+        if pool is not None:
+            pool.terminate()
 
-        processDocument(job, xmldoc, filename)
-        i += 1
+        raise
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     print "Processed a total of %d documents" % i
 
 
-def detectMetadataFormat(xmldoc):
-    """ Detect the format of the metadata in `xmldoc`.
+def initProcess(directory, identifier_map, public_pids):
+    """Set up a process to run processFile on documents in `directory`."""
+
+    global PROCESS_STATE
 
+    if public_pids is not None and not isinstance(public_pids, (set, frozenset)):
+        public_pids = set(public_pids)
+
+    PROCESS_STATE = (directory, identifier_map, public_pids)
+
+
+def processFile(filename):
+    """Parse a document and extract people/organization creators from it.
+    See initProcess.
+
+    Returns:
+        List of records, or None if the document couldn't be parsed.
     """
 
-    root = xmldoc
+    directory, identifier_map, public_pids = PROCESS_STATE
 
-    if re.search("eml$", root.tag):
-        return "eml"
-    elif re.search("Dryad", root.tag):
-        return "dryad"
-    elif re.search("metadata", root.tag):
-        return "fgdc"
-    else:
-        return "unknown"
+    # Only the parts of each document creators are extracted from are kept in
+    # memory
+    try:
+        with open("%s/%s" % (directory, filename), 'rb') as f:
+            xmldoc = registry.iterparse(f)
+    except xpath.PARSE_ERRORS:
+        return None
+
+    document = getDocumentIdentifier(filename, identifier_map, public_pids)
+
+    return extractCreators(document, xmldoc)
 
 
-def extractCreators(identifier, doc):
+def detectMetadataFormat(xmldoc, format_id=None):
+    """ Detect the format of the metadata in `xmldoc`, using its CN
+    `format_id` when it's known. See d1lod.metadata.registry.
+
+    """
+
+    return registry.detectFormat(xmldoc, format_id)
+
+
+def extractCreators(identifier, doc, format_id=None):
     """
     Detect the format of and extract people/organization creators from a document.
 
@@ -68,6 +140,9 @@ def extractCreators(identifier, doc):
         doc:
             An XML document of the scientific metadata
 
+        format_id: str
+            (optional) The document's CN formatId
+
     Returns:
         List of records.
     """
@@ -76,24 +151,21 @@ def extractCreators(identifier, doc):
         return []
 
     # Detect the format
-    metadata_format = detectMetadataFormat(doc)
+    metadata_format = detectMetadataFormat(doc, format_id)
+    process = registry.getProcessor(metadata_format)
 
-    # Process the document for people/orgs
-    if metadata_format == "eml":
-        records = eml.process(doc, identifier)
-    elif metadata_format == "dryad":
-        records = dryad.process(doc, identifier)
-    elif metadata_format == "fgdc":
-        records = fgdc.process(doc, identifier)
-    else:
+    if process is None:
         print "Unknown format."
-        records = []
+        return []
 
-    return records
+    # Process the document for people/orgs
+    return process(doc, identifier)
 
 
-def processDocument(job, xmldoc, filename):
-    """ Process an individual document."""
+def getDocumentIdentifier(filename, identifier_map=None, public_pids=None):
+    """Get the PID of the document stored in `filename`, or '' if it isn't
+    public."""
+
     document = filename
 
     # Strip trailing revision number from filename
@@ -103,15 +175,22 @@ def processDocument(job, xmldoc, filename):
         document = just_pid.groups(0)[0]
 
     # Map the filename to its PID if we have a map to go off of
-    if job.identifier_map is not None:
-        if document in job.identifier_map:
-            document = job.identifier_map[document]
+    if identifier_map is not None:
+        if document in identifier_map:
+            document = identifier_map[document]
 
     # Null out the document PID if it's not public
-    if job.public_pids is not None:
-        if document not in job.public_pids:
+    if public_pids is not None:
+        if document not in public_pids:
             document = ''
 
+    return document
+
+
+def processDocument(job, xmldoc, filename):
+    """ Process an individual document."""
+    document = getDocumentIdentifier(filename, job.identifier_map, job.public_pids)
+
     records = extractCreators(document, xmldoc)
 
     if records is not None:
@@ -136,8 +215,8 @@ def saveRecords(job, records):
             if 'organization' in record and len(record['organization']) > 0:
                 org_record = {
                     'name': record['organization'],
-                    'format': record['format'],
-                    'source': record['source'],
+                    'format': record.get('format'),
+                    'source': record.get('source'),
                     'document': record['document']
                 }
 
@@ -0,0 +1,316 @@
+""" resilience.py
+
+    HTTP requests with timeouts, bounded retries and a circuit breaker per
+    host, shared by the requests made to the DataOne CN and to the SPARQL
+    endpoint.
+
+    A request that fails with a connection error, a timeout, or one of the
+    `retry_statuses` is retried up to `retries` times, sleeping for a random
+    time between zero and BACKOFF_BASE * 2^attempt seconds (capped at
+    BACKOFF_MAX) in between ("full jitter"), or for as long as a
+    Retry-After header asks.
+
+    Requests which aren't idempotent (e.g., SPARQL updates) are only retried
+    when they failed to connect, or got one of `retry_statuses`, since a
+    timeout or a connection dropped part-way through doesn't mean the server
+    didn't (or won't still) act on them.
+
+    Every host gets a CircuitBreaker. After BREAKER_THRESHOLD consecutive
+    failed requests to a host its breaker opens and further requests fail
+    straight away for BREAKER_RESET seconds, after which a single request is
+    let through to test the host. This stops every worker from piling retries
+    onto a host that's down. A request only counts as failed once its retries
+    have run out, so one request can't open a breaker on its own.
+"""
+
+import time
+import errno
+import socket
+import random
+import urlparse
+import threading
+import logging
+import requests
+from requests.packages.urllib3 import exceptions as urllib3_exceptions
+
+from d1lod import metrics
+
+# Number of times a failed request is retried
+DEFAULT_RETRIES = 4
+
+# (seconds) Timeouts for connecting and for reading the response
+DEFAULT_TIMEOUT = (10, 60)
+
+# Statuses worth retrying. Requests to Virtuoso use a narrower set because it
+# also responds with a 500 to malformed queries.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# (seconds) Backoff between retries
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+
+# Errors (errno) which mean a request never reached the server
+CONNECT_ERRNOS = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH, errno.EADDRNOTAVAIL)
+
+# Errors raised while reading a streamed response's body (Response.raw),
+# which requests doesn't wrap, e.g. when the connection drops or stalls
+# part-way through
+STREAM_ERRORS = (requests.exceptions.ConnectionError,
+                 requests.exceptions.ChunkedEncodingError,
+                 urllib3_exceptions.ReadTimeoutError,
+                 urllib3_exceptions.ProtocolError,
+                 socket.error)
+
+# Consecutive failures before a host's breaker opens and (seconds) how long
+# it stays open
+BREAKER_THRESHOLD = 5
+BREAKER_RESET = 30
+
+# Circuit breakers, indexed by host. See getBreaker.
+BREAKERS = {}
+BREAKERS_LOCK = threading.Lock()
+
+
+def getBreaker(url):
+    """Get the CircuitBreaker for the host `url` is on, creating it on first
+    use."""
+
+    host = urlparse.urlparse(url).netloc
+
+    with BREAKERS_LOCK:
+        if host not in BREAKERS:
+            BREAKERS[host] = CircuitBreaker(host)
+
+        return BREAKERS[host]
+
+
+def getBackoff(attempt, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    """Get a random time (in seconds) to wait before retry number `attempt`
+    (counting from zero)."""
+
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def isConnectError(e):
+    """Check whether a requests exception means the request couldn't be
+    sent at all (e.g., the connection was refused), rather than that it was
+    sent and something went wrong after."""
+
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+
+    if not isinstance(e, requests.exceptions.ConnectionError):
+        return False
+
+    # Dig the socket error out of the urllib3 exceptions it's wrapped in
+    reason = e
+
+    while reason is not None:
+        if isinstance(reason, socket.gaierror):
+            return True
+
+        if isinstance(reason, socket.error):
+            return reason.errno in CONNECT_ERRNOS
+
+        if getattr(reason, 'reason', None) is not None:
+            reason = reason.reason
+        elif len(getattr(reason, 'args', ())) > 0 and isinstance(reason.args[-1], Exception):
+            reason = reason.args[-1]
+        else:
+            reason = None
+
+    return False
+
+
+def getRetryAfter(response):
+    """Get the delay (in seconds) asked for by a response's Retry-After
+    header, if it has one in seconds."""
+
+    if response is None:
+        return None
+
+    try:
+        return min(BACKOFF_MAX, max(0, int(response.headers.get('Retry-After'))))
+    except (TypeError, ValueError):
+        return None
+
+
+def request(method, url, session=None, retries=DEFAULT_RETRIES, timeout=DEFAULT_TIMEOUT, retry_statuses=RETRY_STATUSES, idempotent=True, **kwargs):
+    """Make an HTTP request, retrying transient failures.
+
+    Arguments:
+    ----------
+
+    method : str
+        HTTP method, e.g. 'GET'
+
+    url : str
+        URL to request
+
+    session : requests.Session
+        (optional) Session to send the request over. Defaults to a plain
+        requests.request.
+
+    retries : int
+        Number of times to retry a failed request
+
+    timeout : float | tuple
+        Timeout passed to requests
+
+    retry_statuses : tuple
+        Response statuses which are retried
+
+    idempotent : bool
+        Whether the request can safely be sent more than once. If not, only
+        failures to connect (see isConnectError) and `retry_statuses` are
+        retried.
+
+    kwargs:
+        Keyword arguments passed through to requests
+
+    Returns:
+        The requests.Response. It may have one of `retry_statuses` if the
+        retries ran out. Responses with other statuses are returned as-is.
+
+    Raises:
+        Exception if the host's circuit breaker is open, the last attempt's
+        connection error or timeout if the retries ran out (or it isn't
+        retried), or any other error sending the request.
+    """
+
+    if session is None:
+        session = requests
+
+    breaker = getBreaker(url)
+
+    # Checked once per request, not per attempt, so a half-open breaker's
+    # trial request can be retried too
+    if not breaker.allow():
+        raise Exception("Not sending %s %s because the circuit breaker for %s is open." % (method, url, breaker.name))
+
+    attempt = 0
+
+    while True:
+        response = None
+
+        try:
+            response = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
+            if attempt >= retries or not (idempotent or isConnectError(e)):
+                breaker.recordFailure()
+                raise
+
+            logging.warning("%s %s failed (attempt %d of %d): %s", method, url, attempt + 1, retries + 1, e)
+        except:
+            # Anything else (e.g., a ChunkedEncodingError) isn't retried but
+            # still counts against the host. It also has to end a half-open
+            # breaker's trial, or no further requests would be let through.
+            breaker.recordFailure()
+            raise
+        else:
+            if response.status_code not in retry_statuses:
+                breaker.recordSuccess()
+                return response
+
+            if attempt >= retries:
+                breaker.recordFailure()
+                return response
+
+            logging.warning("%s %s got status %d (attempt %d of %d).", method, url, response.status_code, attempt + 1, retries + 1)
+            response.close()
+
+        metrics.increment('d1lod_http_retries_total', {'host': breaker.name})
+        delay = getRetryAfter(response)
+
+        if delay is None:
+            delay = getBackoff(attempt)
+
+        time.sleep(delay)
+        attempt += 1
+
+
+class CircuitBreaker:
+    def __init__(self, name, threshold=BREAKER_THRESHOLD, reset=BREAKER_RESET):
+        """Initialize a closed circuit breaker.
+
+        Arguments:
+        ----------
+
+        name : str
+            Name of what the breaker protects (e.g., a host) for messages
+
+        threshold : int
+            Number of consecutive failures which open the breaker
+
+        reset : float
+            Time (in seconds) the breaker stays open before letting a trial
+            request through
+        """
+
+        self.name = name
+        self.threshold = threshold
+        self.reset = reset
+
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+
+    def __str__(self):
+        return "CircuitBreaker: '%s'" % self.name
+
+
+    def state(self):
+        """Get the breaker's state: 'closed', 'open' or 'half-open' (when it's
+        ready to let a trial request through)."""
+
+        if self.opened_at is None:
+            return 'closed'
+
+        if time.time() - self.opened_at >= self.reset:
+            return 'half-open'
+
+        return 'open'
+
+
+    def allow(self):
+        """Check whether a request may be sent. Only one trial request is let
+        through while the breaker is half-open.
+
+        Returns: bool
+        """
+
+        with self.lock:
+            state = self.state()
+
+            if state == 'closed':
+                return True
+
+            if state == 'open' or self.trial:
+                return False
+
+            self.trial = True
+
+            return True
+
+
+    def recordSuccess(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logging.info("Closing %s.", self)
+
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+
+    def recordFailure(self):
+        with self.lock:
+            self.failures += 1
+
+            if self.trial or (self.opened_at is None and self.failures >= self.threshold):
+                logging.error("Opening %s after %d consecutive failure(s).", self, self.failures)
+                self.opened_at = time.time()
+
+            self.trial = False
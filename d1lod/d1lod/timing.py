@@ -0,0 +1,110 @@
+""" timing.py
+
+    Per-stage timers for jobs.
+
+    A job activates a StageTimer while it runs and the code it calls wraps
+    each stage of interest (e.g., fetching science metadata) in
+
+        with timing.stage('scimeta'):
+            ...
+
+    which adds the time taken to that stage on the active timer, if there is
+    one. Stages can be entered any number of times (and from several
+    threads) and are reported with their total time and count.
+
+    Jobs log the result as a single line of JSON following "TIMINGS ", which
+    the logstash pipeline parses into fields, e.g.,
+
+        TIMINGS {"job": "JOB_ADD_DATASET", "identifier": "...", "total": 2.5,
+                 "stages": {"scimeta": {"seconds": 0.8, "count": 1}, ...}}
+"""
+
+import time
+import json
+import threading
+import contextlib
+
+# The StageTimer stages are recorded on. See activate.
+ACTIVE = None
+
+
+@contextlib.contextmanager
+def activate(timer):
+    """Record stages on `timer` until the block exits."""
+
+    global ACTIVE
+
+    previous = ACTIVE
+    ACTIVE = timer
+
+    try:
+        yield timer
+    finally:
+        ACTIVE = previous
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Add the time taken by the block to stage `name` on the active timer.
+    Does nothing if there's no active timer."""
+
+    timer = ACTIVE
+
+    if timer is None:
+        yield
+        return
+
+    start = time.time()
+
+    try:
+        yield
+    finally:
+        timer.add(name, time.time() - start)
+
+
+class StageTimer:
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}  # [seconds, count], indexed by stage name
+        self.lock = threading.Lock()
+
+
+    def add(self, name, seconds):
+        """Add `seconds` to the stage `name`.
+
+        Returns: None
+        """
+
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = [0.0, 0]
+
+            self.stages[name][0] += seconds
+            self.stages[name][1] += 1
+
+
+    def summary(self):
+        """Summarize the time spent so far.
+
+        Returns:
+            A Dict with the 'total' seconds since the timer was created and
+            the 'seconds' and 'count' of each of its 'stages'.
+        """
+
+        with self.lock:
+            stages = dict([(name, {'seconds': round(seconds, 6), 'count': count}) for name, (seconds, count) in self.stages.iteritems()])
+
+        return {
+            'total': round(time.time() - self.started, 6),
+            'stages': stages
+        }
+
+
+    def format(self, **fields):
+        """Format the summary, along with any extra `fields`, as the JSON
+        logged after "TIMINGS "."""
+
+        summary = self.summary()
+        summary.update(fields)
+
+        return json.dumps(summary, sort_keys=True)
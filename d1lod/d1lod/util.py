@@ -4,13 +4,19 @@
 """
 
 import os
+import re
 import sys
+import time
 import xml.etree.ElementTree as ET
 import json
 import csv
 import requests
 import urllib
 
+import formats
+import metrics
+import resilience
+
 
 def continue_or_quit():
     """ Allows the program to pause in order to ask the user to
@@ -32,14 +38,51 @@ def continue_or_quit():
         sys.exit()
 
 
-def getXML(url):
-    """Get XML document at the given url `url`"""
+def getCNEndpoint(url):
+    """Get the name of the CN API endpoint `url` is on (e.g., 'meta' or
+    'query') for labelling metrics. Falls back to the URL's host."""
+
+    match = re.search(r"/cn/v\d/(\w+)", url)
+
+    if match is not None:
+        return match.group(1)
+
+    return url.split('/')[2] if url.count('/') >= 2 else url
+
+
+def requestCN(url, **kwargs):
+    """GET `url` (see d1lod.resilience), recording the number and latency of
+    requests to each CN endpoint. Keyword arguments are passed on to
+    requests.
+
+    Returns: The requests.Response
+    """
+
+    endpoint = getCNEndpoint(url)
+    start = time.time()
 
     try:
-        r = requests.get(url)
-    except:
-        print "\tgetXML failed for %s" % url
-        return None
+        r = resilience.request('GET', url, **kwargs)
+    except Exception:
+        metrics.increment('d1lod_cn_requests_total', {'endpoint': endpoint, 'status': 'error'})
+        raise
+
+    metrics.increment('d1lod_cn_requests_total', {'endpoint': endpoint, 'status': r.status_code})
+    metrics.observe('d1lod_cn_request_duration_seconds', time.time() - start, {'endpoint': endpoint})
+
+    return r
+
+
+def getXML(url):
+    """Get XML document at the given url `url`
+
+    Transient failures are retried (see d1lod.resilience). Raises an
+    Exception if the document still can't be retrieved."""
+
+    r = requestCN(url)
+
+    if r.status_code != 200:
+        raise Exception("getXML got status %d for %s" % (r.status_code, url))
 
     content = r.text
     xmldoc = ET.fromstring(content.encode('utf-8'))
@@ -47,6 +90,80 @@ def getXML(url):
     return(xmldoc)
 
 
+def getContent(url):
+    """Get the raw content of the document at the given url `url`.
+
+    Transient failures are retried (see d1lod.resilience) and an Exception is
+    raised if they keep failing. Returns None if the document doesn't exist
+    (or otherwise doesn't return a 200)."""
+
+    r = requestCN(url)
+
+    if r.status_code in resilience.RETRY_STATUSES:
+        raise Exception("getContent got status %d for %s" % (r.status_code, url))
+
+    if r.status_code != 200:
+        print "\tgetContent got status %d for %s" % (r.status_code, url)
+        return None
+
+    return r.content
+
+
+def getStream(url):
+    """Start downloading the document at the given url `url` without reading
+    its body, e.g. to parse it as it arrives.
+
+    Failures are handled as in getContent.
+
+    Returns:
+        The requests.Response, whose `raw` attribute is the (decompressed)
+        body, or None if the document doesn't exist. The caller closes it.
+    """
+
+    r = requestCN(url, stream=True)
+
+    if r.status_code in resilience.RETRY_STATUSES:
+        r.close()
+        raise Exception("getStream got status %d for %s" % (r.status_code, url))
+
+    if r.status_code != 200:
+        print "\tgetStream got status %d for %s" % (r.status_code, url)
+        r.close()
+        return None
+
+    r.raw.decode_content = True
+
+    return r
+
+
+class TeeReader:
+    def __init__(self, source, sink):
+        """Initialize a file-like object which reads from `source` and
+        writes everything it reads to `sink`.
+
+        Arguments:
+        ----------
+
+        source : file
+            File-like object to read from
+
+        sink : file
+            File-like object to copy what's read to
+        """
+
+        self.source = source
+        self.sink = sink
+
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+
+        if len(data) > 0:
+            self.sink.write(data)
+
+        return data
+
+
 def loadJSONFile(filename):
     """ Loads as a JSON file as a Python dict.
     """
@@ -116,23 +233,15 @@ def loadFormatsMap():
     Gets the formats map from GitHub. These are the GeoLink URIs for the
     file format types DataOne knows about.
 
+    See d1lod.formats.FormatRegistry for a cached copy of the formats map.
+
     Returns:
         A Dict of formats, indexed by format ID.
     """
 
-    r = requests.get("https://raw.githubusercontent.com/ec-geolink/design/master/data/dataone/formats/formats.csv")
-    reader = csv.DictReader(r.text.splitlines())
-
-    formats_map = {}
-
-    for row in reader:
-        formats_map[row['id']] = {
-            'type': row['type'],
-            'uri' : row['uri'],
-            'name': row['name']
-        }
+    r = requests.get(formats.FORMATS_URL)
 
-    return formats_map
+    return formats.parseFormats(r.content)
 
 
 def createIdentifierMap(path):
@@ -0,0 +1,108 @@
+"""test_cache.py
+
+Test the on-disk document cache.
+"""
+
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+from d1lod import cache
+
+
+def test_can_store_and_get_documents(tmpdir):
+    c = cache.DocumentCache(str(tmpdir))
+
+    assert c.get('object', 'doi:10.5063/F1125QWP') is None
+
+    c.put('object', 'doi:10.5063/F1125QWP', '<eml/>')
+
+    assert c.get('object', 'doi:10.5063/F1125QWP') == '<eml/>'
+    assert c.get('meta', 'doi:10.5063/F1125QWP') is None
+    assert c.stats() == {'size': 6, 'hits': {'object': 1}, 'misses': {'object': 1, 'meta': 1}}
+
+
+def test_expires_documents(tmpdir):
+    c = cache.DocumentCache(str(tmpdir), ttl={'meta': 60})
+
+    c.put('meta', 'a', '<sysmeta/>')
+    c.put('object', 'a', '<eml/>')
+
+    an_hour_ago = time.time() - 60 * 60
+    os.utime(c.path('meta', 'a'), (an_hour_ago, an_hour_ago))
+    os.utime(c.path('object', 'a'), (an_hour_ago, an_hour_ago))
+
+    assert c.get('meta', 'a') is None
+    assert c.get('object', 'a') == '<eml/>'
+    assert c.get('object', 'a', newer_than=time.time()) is None
+
+
+def test_evicts_least_recently_used_documents(tmpdir):
+    c = cache.DocumentCache(str(tmpdir), max_bytes=25)
+
+    for i, key in enumerate(['a', 'b']):
+        c.put('object', key, '0123456789')
+        then = time.time() - 60 * (10 - i)
+        os.utime(c.path('object', key), (then, then))
+
+    # Reading 'a' makes 'b' the least recently used
+    assert c.get('object', 'a') is not None
+
+    c.put('object', 'c', '0123456789')
+
+    assert c.get('object', 'b') is None
+    assert c.get('object', 'a') is not None
+    assert c.get('object', 'c') is not None
+    assert c.size == 20
+
+
+def test_counts_requests_from_several_threads(tmpdir):
+    c = cache.DocumentCache(str(tmpdir))
+    c.put('meta', 'a', '<sysmeta/>')
+
+    pool = ThreadPool(8)
+
+    try:
+        pool.map(lambda i: c.get('meta', 'a' if i % 2 == 0 else 'b'), range(1000))
+    finally:
+        pool.close()
+
+    assert c.stats() == {'size': 10, 'hits': {'meta': 500}, 'misses': {'meta': 500}}
+
+
+def test_lru_cache_discards_least_recently_used_entries():
+    c = cache.LRUCache(max_size=2)
+
+    c.put('a', 1)
+    c.put('b', 2)
+    assert c.get('a') == 1
+
+    c.put('c', 3)
+
+    assert 'b' not in c
+    assert c.get('a') == 1
+    assert c.get('c') == 3
+    assert c.discardValues([3]) == 1
+    assert len(c) == 1
+    assert c.stats() == {'size': 1, 'hits': 3, 'misses': 0}
+
+
+def test_only_stores_committed_documents(tmpdir):
+    c = cache.DocumentCache(str(tmpdir))
+
+    writer = c.writer('object', 'a')
+    writer.write('<eml>')
+    writer.abort()
+
+    assert c.get('object', 'a') is None
+    assert os.listdir(os.path.dirname(c.path('object', 'a'))) == []
+
+    writer = c.writer('object', 'a')
+    writer.write('<eml>')
+    writer.write('</eml>')
+    writer.commit()
+
+    with c.open('object', 'a') as f:
+        assert f.read() == '<eml></eml>'
+
+    assert c.size == 11
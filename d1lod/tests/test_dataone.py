@@ -3,7 +3,13 @@
 Test the DataOne utility library.
 """
 
+import StringIO
+import xml.etree.ElementTree as ET
+
+from requests.packages.urllib3 import exceptions as urllib3_exceptions
+
 from d1lod import dataone
+from d1lod import util
 
 
 def test_parsing_resource_map():
@@ -27,3 +33,118 @@ def test_extracting_identifiers_from_urls():
     assert dataone.extractIdentifierFromFullURL('https://cn.dataone.org/cn/v1/resolve/kgordon.23.30') == 'kgordon.23.30'
     assert dataone.extractIdentifierFromFullURL('https://cn.dataone.org/cn/v1/object/kgordon.23.30') == 'kgordon.23.30'
     assert dataone.extractIdentifierFromFullURL('https://cn.dataone.org/cn/v2/object/kgordon.23.30') == 'kgordon.23.30'
+
+
+def test_can_get_system_metadata_concurrently():
+    pids = dataone.getAggregatedIdentifiers('resourceMap_df35d.3.2')
+
+    sysmetas = dataone.getSystemMetadataConcurrently(pids, num_threads=4)
+
+    assert sorted(sysmetas.keys()) == sorted(set(pids))
+
+    for pid in pids:
+        assert sysmetas[pid] is not None
+        assert dataone.extractDocumentIdentifier(sysmetas[pid]) == pid
+
+
+def test_can_get_when_system_metadata_was_modified(monkeypatch):
+    urls = []
+
+    def getXML(url):
+        urls.append(url)
+
+        return ET.fromstring("""<response><result>
+            <doc><str name="id">a</str><date name="dateModified">2015-05-30T23:21:15.567Z</date></doc>
+            <doc><str name="id">b"c</str><date name="dateModified">2016-01-01T00:00:00Z</date></doc>
+        </result></response>""")
+
+    monkeypatch.setattr(util, 'getXML', getXML)
+    monkeypatch.setattr(dataone, 'SYSTEM_METADATA_LOOKUP_SIZE', 2)
+
+    dates = dataone.getSystemMetadataModified(['a', 'b"c', 'a', 'd'])
+
+    assert dates == {'a': '2015-05-30T23:21:15.567Z', 'b"c': '2016-01-01T00:00:00Z'}
+    assert len(urls) == 2
+    assert 'q=id%3A%28%22a%22+OR+%22b%5C%22c%22%29' in urls[0]
+
+
+def test_checks_each_cached_system_metadata_against_its_own_date(monkeypatch):
+    requested = []
+
+    def getSystemMetadata(identifier, modified=None):
+        requested.append((identifier, modified))
+
+    monkeypatch.setattr(dataone, 'getSystemMetadata', getSystemMetadata)
+
+    dataone.getSystemMetadataConcurrently(['a', 'b'], num_threads=1, modified={'a': '2015-05-30T23:21:15.567Z'})
+
+    assert requested == [('a', '2015-05-30T23:21:15.567Z'), ('b', None)]
+
+
+def test_can_create_cursor_query_urls():
+    url = dataone.createSinceQueryURL('2015-01-01T00:00:00.000Z', '2015-01-02T00:00:00.000Z', fields=['identifier'], page_size=10, cursor_mark='AoE/BWZvbw==')
+
+    assert 'sort=dateModified+asc,id+asc' in url
+    assert 'cursorMark=AoE%2FBWZvbw%3D%3D' in url
+    assert 'start=' not in url
+    assert url.endswith('&fl=identifier')
+
+
+def test_can_iterate_over_documents_since():
+    docs = list(dataone.iterSinceDocuments('2015-05-30T00:00:00.000Z', '2015-05-31T00:00:00.000Z', page_size=5))
+    identifiers = [dataone.extractDocumentIdentifier(doc) for doc in docs]
+
+    assert len(identifiers) > 5
+    assert len(identifiers) == len(set(identifiers))
+
+
+def test_can_convert_solr_docs_to_records():
+    doc = ET.fromstring("""<doc>
+        <str name="identifier">doi:10.5063/F1125QWP</str>
+        <str name="submitter">CN=someone</str>
+        <float name="northBoundCoord">45.5</float>
+        <date name="dateModified">2015-05-30T12:34:56.789Z</date>
+        <arr name="resourceMap"><str>resourceMap_df35d.3.2</str><str>resourceMap_df35d.3.3</str></arr>
+    </doc>""")
+
+    record = dataone.docToRecord(doc)
+
+    assert record.identifier == 'doi:10.5063/F1125QWP'
+    assert record.north_bound == 45.5
+    assert record.south_bound is None
+    assert record.date_modified == '2015-05-30T12:34:56.789Z'
+    assert record.resource_maps == ('resourceMap_df35d.3.2', 'resourceMap_df35d.3.3')
+    assert dataone.docToRecord(ET.fromstring("<doc/>")).resource_maps == ()
+
+
+class FlakyReader:
+    def __init__(self, content, fail_after=None):
+        self.content = StringIO.StringIO(content)
+        self.fail_after = fail_after
+
+    def read(self, size=-1):
+        if self.fail_after is not None and self.content.tell() >= self.fail_after:
+            raise urllib3_exceptions.ProtocolError('Connection broken: IncompleteRead')
+
+        return self.content.read(16)
+
+
+class StreamedResponse:
+    def __init__(self, raw):
+        self.raw = raw
+
+    def close(self):
+        pass
+
+
+def test_downloads_streams_that_fail_part_way_again(monkeypatch):
+    content = '<eml:eml xmlns:eml="eml://ecoinformatics.org/eml-2.1.1"><dataset><creator><individualName><surName>Smith</surName></individualName></creator></dataset></eml:eml>'
+    responses = [StreamedResponse(FlakyReader(content, fail_after=32)), StreamedResponse(FlakyReader(content))]
+
+    monkeypatch.setattr(util, 'getStream', lambda url: responses.pop(0))
+    monkeypatch.setattr(dataone.time, 'sleep', lambda seconds: None)
+
+    root = dataone.streamScientificMetadata('xxx', cache=False)
+
+    assert len(responses) == 0
+    assert root.find('.//surName').text == 'Smith'
@@ -0,0 +1,172 @@
+"""test_export.py
+
+Test exporting graphs to disk.
+"""
+
+import re
+import gzip
+import datetime
+import RDF
+
+from d1lod import export
+
+
+def test_can_format_terms():
+    assert export.formatTerm({'type': 'uri', 'value': 'http://example.org/#Foo'}) == '<http://example.org/#Foo>'
+    assert export.formatTerm({'type': 'uri', 'value': 'http://example.org/a b'}) == '<http://example.org/a\\u0020b>'
+    assert export.formatTerm({'type': 'bnode', 'value': 'nodeID://b1'}) == '_:nodeID_3a__2f__2f_b1'
+    assert export.formatTerm({'type': 'literal', 'value': 'Say "hi"\n'}) == '"Say \\"hi\\"\\n"'
+    assert export.formatTerm({'type': 'literal', 'value': 'Foo', 'xml:lang': 'en'}) == '"Foo"@en'
+    assert export.formatTerm({'type': 'literal', 'value': '1', 'datatype': 'http://www.w3.org/2001/XMLSchema#int'}) == '"1"^^<http://www.w3.org/2001/XMLSchema#int>'
+
+
+def test_uses_prefixed_names_for_turtle():
+    ns = {'geolink': 'http://schema.geolink.org/1.0/base/main#',
+          'd1dataset': 'http://dataone.org/dataset/'}
+
+    assert export.formatTerm({'type': 'uri', 'value': 'http://schema.geolink.org/1.0/base/main#Dataset'}, ns) == 'geolink:Dataset'
+    assert export.formatTerm({'type': 'uri', 'value': 'http://dataone.org/dataset/doi:10.5063/F1125QWP'}, ns) == '<http://dataone.org/dataset/doi:10.5063/F1125QWP>'
+
+
+def test_can_export_a_graph(graph, tmpdir):
+    graph.clear()
+
+    graph.insert(s=RDF.Uri('http://example.org/#Foo'),
+                 p=RDF.Uri('http://example.org/#isA'),
+                 o=RDF.Uri('http://name.org/Foo'))
+    graph.insert(s=RDF.Uri('http://example.org/#Bar'),
+                 p=RDF.Uri('http://example.org/#isA'),
+                 o=RDF.Uri('http://name.org/Bar'))
+
+    filepath = str(tmpdir.join('dump.nt'))
+
+    assert export.exportGraph(graph, filepath, format='ntriples', compress=True, page_size=1) == 2
+
+    with gzip.open(filepath + '.gz') as f:
+        lines = f.read().splitlines()
+
+    assert lines == ['<http://example.org/#Bar> <http://example.org/#isA> <http://name.org/Bar> .',
+                     '<http://example.org/#Foo> <http://example.org/#isA> <http://name.org/Foo> .']
+    assert tmpdir.listdir() == [tmpdir.join('dump.nt.gz')]
+
+
+def test_can_export_more_than_one_page(graph, tmpdir):
+    graph.clear()
+
+    # Five subjects with two triples each, three pages of two subjects
+    for name in ['A', 'B', 'C', 'D', 'E']:
+        for predicate in ['isA', 'name']:
+            graph.insert(s=RDF.Uri('http://example.org/#' + name),
+                         p=RDF.Uri('http://example.org/#' + predicate),
+                         o=RDF.Node(name))
+
+    filepath = str(tmpdir.join('dump.nt'))
+
+    assert export.exportGraph(graph, filepath, format='ntriples', page_size=2) == 10
+
+    with open(filepath) as f:
+        lines = f.read().splitlines()
+
+    assert len(set(lines)) == 10
+    assert [line.split(' ')[0] for line in lines] == ['<http://example.org/#%s>' % name for name in 'AABBCCDDEE']
+
+
+class PagedGraph:
+    """Just enough of a Graph to answer the queries iterTriples makes."""
+
+    def __init__(self, triples):
+        self.name = 'http://example.org/graph'
+        self.triples = triples
+        self.queries = []
+
+    def iter_query(self, query, terms=False):
+        self.queries.append(query)
+
+        after = re.search(r"\?s > <([^>]*)>", query)
+        until = re.search(r"\?s <= <([^>]*)>", query)
+        limit = re.search(r"LIMIT (\d+)", query)
+
+        if 'isBlank(?s)' in query:
+            matching = [t for t in self.triples if t[0]['type'] == 'bnode']
+        else:
+            matching = [t for t in self.triples if t[0]['type'] == 'uri' and
+                        (after is None or t[0]['value'] > after.group(1)) and
+                        (until is None or t[0]['value'] <= until.group(1))]
+
+        matching.sort(key=lambda t: (t[0]['value'], t[1]['value'], t[2]['value']))
+
+        if 'SELECT DISTINCT ?s' in query:
+            subjects = sorted(set(t[0]['value'] for t in matching))
+
+            if limit is not None:
+                subjects = subjects[:int(limit.group(1))]
+
+            return iter([{'s': subject} for subject in subjects])
+
+        return iter([{'s': t[0], 'p': t[1], 'o': t[2]} for t in matching])
+
+
+def test_pages_dont_drop_or_repeat_subjects():
+    # Subjects that are prefixes of one another fall either side of page
+    # boundaries
+    names = ['A', 'A/1', 'AB', 'B', 'B/', 'C', 'C#D']
+    triples = [({'type': 'bnode', 'value': 'nodeID://b1'},
+                {'type': 'uri', 'value': 'http://example.org/#name'},
+                {'type': 'literal', 'value': 'Blank'})]
+
+    for name in names:
+        for predicate in ['isA', 'name']:
+            triples.append(({'type': 'uri', 'value': 'http://example.org/#' + name},
+                            {'type': 'uri', 'value': 'http://example.org/#' + predicate},
+                            {'type': 'literal', 'value': name}))
+
+    for page_size in [1, 2, 3, len(names), len(names) + 1]:
+        graph = PagedGraph(triples)
+        exported = list(export.iterTriples(graph, page_size))
+
+        assert len(exported) == len(triples)
+        assert sorted(exported) == sorted(triples)
+        assert [s['value'] for s, p, o in exported] == ['http://example.org/#%s' % name for name in names for _ in range(2)] + ['nodeID://b1']
+
+        # Pages are keyed on the IRI, never its string value
+        assert not any('STR(?s)' in query for query in graph.queries)
+
+
+def test_can_format_subject_ranges():
+    assert export.formatSubjectRange(None) == u'isIRI(?s)'
+    assert export.formatSubjectRange('http://example.org/#A') == u'isIRI(?s) && ?s > <http://example.org/#A>'
+    assert export.formatSubjectRange(None, 'http://example.org/#B') == u'isIRI(?s) && ?s <= <http://example.org/#B>'
+    assert export.formatSubjectRange('http://example.org/a>b', 'c') == u'isIRI(?s) && ?s > <http://example.org/a\\u003Eb> && ?s <= <c>'
+
+
+def test_can_write_and_prune_changesets(tmpdir):
+    directory = str(tmpdir)
+    changes = [
+        {'dataset': 'http://dataone.org/dataset/a', 'removed': True,
+         'added': ['<http://dataone.org/dataset/a> <http://example.org/#isA> <http://name.org/Foo> .']},
+        {'dataset': 'http://dataone.org/dataset/b', 'removed': False,
+         'added': ['<http://dataone.org/dataset/b> <http://example.org/#isA> <http://name.org/Foo> .']}
+    ]
+
+    assert export.writeChangeset([], directory) == []
+    assert export.listChangesets(directory) == []
+
+    filenames = export.writeChangeset(changes, directory, datetime.datetime(2015, 12, 10, 1))
+    assert filenames == ['00000001-20151210T010000Z.removed.txt.gz', '00000001-20151210T010000Z.added.nt.gz']
+
+    with gzip.open(str(tmpdir.join(filenames[0]))) as f:
+        assert f.read() == '<http://dataone.org/dataset/a>\n'
+
+    with gzip.open(str(tmpdir.join(filenames[1]))) as f:
+        assert len(f.read().splitlines()) == 2
+
+    export.writeChangeset(changes, directory, datetime.datetime(2015, 12, 10, 2))
+    assert export.listChangesets(directory) == ['00000001-20151210T010000Z', '00000002-20151210T020000Z']
+
+    assert export.pruneChangesets(directory, 1) == 1
+    assert export.listChangesets(directory) == ['00000002-20151210T020000Z']
+    assert export.getLatestChangesetSequence(directory) == 2
+
+    # Numbering carries on from the latest changeset left after pruning
+    export.writeChangeset(changes, directory, datetime.datetime(2015, 12, 10, 3))
+    assert export.listChangesets(directory)[-1] == '00000003-20151210T030000Z'
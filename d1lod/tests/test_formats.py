@@ -0,0 +1,93 @@
+"""test_formats.py
+
+Test the formats registry.
+"""
+
+import pickle
+
+from d1lod import formats
+
+
+FORMATS_CSV = """id,type,uri,name
+eml://ecoinformatics.org/eml-2.1.1,METADATA,http://schema.geolink.org/1.0/voc/dataone/format#003,"Ecological Metadata Language, version 2.1.1"
+text/csv,DATA,http://schema.geolink.org/1.0/voc/dataone/format#100,Comma Separated Values Text
+"""
+
+
+def test_can_load_formats_from_a_snapshot(tmpdir):
+    snapshot = tmpdir.join('formats.csv')
+    snapshot.write(FORMATS_CSV)
+
+    registry = formats.FormatRegistry(snapshot_path=str(snapshot))
+
+    assert len(registry) == 2
+    assert 'text/csv' in registry
+    assert registry['text/csv']['uri'] == 'http://schema.geolink.org/1.0/voc/dataone/format#100'
+    assert registry.get('text/plain') is None
+
+
+def test_reloads_a_replaced_snapshot(tmpdir):
+    snapshot = tmpdir.join('formats.csv')
+    snapshot.write(FORMATS_CSV)
+
+    registry = formats.FormatRegistry(snapshot_path=str(snapshot), check_interval=0)
+    assert len(registry) == 2
+
+    snapshot.write(FORMATS_CSV.splitlines()[0] + "\n")
+    snapshot.setmtime(snapshot.mtime() + 10)
+
+    assert len(registry) == 0
+
+
+def test_keeps_the_snapshot_when_a_refresh_fails(tmpdir):
+    snapshot = tmpdir.join('formats.csv')
+    snapshot.write(FORMATS_CSV)
+
+    assert formats.refreshSnapshot(snapshot_path=str(snapshot), url='http://localhost:1/formats.csv', ttl=0) is False
+    assert snapshot.read() == FORMATS_CSV
+
+
+def test_only_refreshes_stale_snapshots(tmpdir):
+    snapshot = tmpdir.join('formats.csv')
+    snapshot.write(FORMATS_CSV)
+
+    # Fresh snapshots aren't fetched again (which would fail here)
+    assert formats.refreshSnapshot(snapshot_path=str(snapshot), url='http://localhost:1/formats.csv', ttl=60) is False
+    assert formats.getSnapshotAge(str(snapshot)) < 60
+    assert formats.getSnapshotAge(str(tmpdir.join('missing.csv'))) is None
+
+
+def test_is_empty_without_a_snapshot(tmpdir):
+    registry = formats.FormatRegistry(snapshot_path=str(tmpdir.join('missing.csv')),
+                                      fallback_path=str(tmpdir.join('also-missing.csv')))
+
+    assert len(registry) == 0
+    assert 'text/csv' not in registry
+
+
+def test_falls_back_to_the_packaged_snapshot(tmpdir):
+    snapshot = tmpdir.join('formats.csv')
+    registry = formats.FormatRegistry(snapshot_path=str(snapshot), check_interval=0)
+
+    assert registry.loaded_path == formats.PACKAGED_SNAPSHOT_PATH
+    assert registry['eml://ecoinformatics.org/eml-2.1.1']['uri'] == 'http://schema.geolink.org/dev/voc/dataone/format#004'
+
+    # Switches over once a refreshed snapshot is written
+    snapshot.write(FORMATS_CSV)
+
+    assert len(registry) == 2
+    assert registry.loaded_path == str(snapshot)
+
+
+def test_doesnt_refresh_the_packaged_snapshot():
+    assert formats.FORMATS_SNAPSHOT_PATH != formats.PACKAGED_SNAPSHOT_PATH
+
+
+def test_can_be_pickled(tmpdir):
+    snapshot = tmpdir.join('formats.csv')
+    snapshot.write(FORMATS_CSV)
+
+    registry = pickle.loads(pickle.dumps(formats.FormatRegistry(snapshot_path=str(snapshot))))
+
+    assert len(registry) == 2
+    assert 'text/csv' in registry
@@ -1,5 +1,6 @@
 import pytest
 import RDF
+import io
 
 from d1lod.graph import Graph
 
@@ -116,3 +117,92 @@ def test_graph_can_list_its_graphs(graph):
 
 
     assert 'canadd' in graph.graphs()
+
+
+def test_graph_reuses_connections(graph):
+    graph.size()
+    graph.size()
+
+    stats = graph.connection_stats()
+
+    assert stats['requests'] >= 2
+    assert stats['reused'] > 0
+
+
+def test_batch_writer_flushes_at_its_limits(graph):
+    graph.clear()
+    assert graph.size() == 0
+
+    writer = graph.batch(max_triples=2)
+
+    writer.add(['<http://example.org/#Foo> <http://example.org/#isA> <http://name.org/Foo>'])
+    assert writer.flushes == 0
+    assert graph.size() == 0
+
+    writer.add(['<http://example.org/#Bar> <http://example.org/#isA> <http://name.org/Bar>'])
+    assert writer.flushes == 1
+    assert graph.size() == 2
+
+    writer.add(['<http://example.org/#Baz> <http://example.org/#isA> <http://name.org/Baz>'])
+    writer.flush()
+    assert writer.flushes == 2
+    assert graph.size() == 3
+
+
+def test_batch_writer_can_write_to_other_graphs(graph):
+    graph.clear()
+    graph.update("DROP SILENT GRAPH <test/other>")
+
+    writer = graph.batch()
+    writer.add(['<http://example.org/#Foo> <http://example.org/#isA> <http://name.org/Foo>'],
+               {'test/other': ['<http://example.org/#Foo> <http://example.org/#key> "foo"']})
+    writer.flush()
+
+    assert writer.flushes == 1
+    assert graph.size() == 1
+    assert len(graph.query('SELECT ?s WHERE { GRAPH <test/other> { ?s ?p "foo" } }')) == 1
+
+
+def test_can_parse_sparql_xml_results(graph):
+    results = io.BytesIO(b"""<?xml version="1.0"?>
+<sparql xmlns="http://www.w3.org/2005/sparql-results#">
+  <head><variable name="s"/><variable name="o"/></head>
+  <results>
+    <result>
+      <binding name="s"><uri>http://example.org/#Foo</uri></binding>
+      <binding name="o"><literal xml:lang="en">Foo</literal></binding>
+    </result>
+    <result>
+      <binding name="s"><bnode>b0</bnode></binding>
+      <binding name="o"><literal datatype="http://www.w3.org/2001/XMLSchema#int">1</literal></binding>
+    </result>
+  </results>
+</sparql>""")
+
+    rows = list(graph.iter_results(results, terms=True))
+
+    assert len(rows) == 2
+    assert rows[0]['s'] == {'type': 'uri', 'value': 'http://example.org/#Foo'}
+    assert rows[0]['o'] == {'type': 'literal', 'value': 'Foo', 'xml:lang': 'en'}
+    assert rows[1]['s'] == {'type': 'bnode', 'value': 'b0'}
+    assert rows[1]['o']['datatype'] == 'http://www.w3.org/2001/XMLSchema#int'
+
+    results.seek(0)
+    assert list(graph.iter_results(results)) == [
+        {'s': 'http://example.org/#Foo', 'o': 'Foo'},
+        {'s': 'b0', 'o': '1'}
+    ]
+
+
+def test_can_iterate_over_query_results(graph):
+    graph.clear()
+
+    graph.insert(s=RDF.Uri('http://example.org/#Foo'),
+                 p=RDF.Uri('http://example.org/#isA'),
+                 o=RDF.Uri('http://name.org/Foo'))
+
+    rows = list(graph.iter_query("SELECT ?s ?p ?o WHERE { GRAPH <%s> { ?s ?p ?o } }" % graph.name))
+
+    assert rows == [{'s': 'http://example.org/#Foo',
+                     'p': 'http://example.org/#isA',
+                     'o': 'http://name.org/Foo'}]
@@ -2,9 +2,11 @@ import pytest
 from urllib import quote_plus
 import RDF
 import urllib
+import xml.etree.ElementTree as ET
 
 from d1lod.graph import Graph
 from d1lod.interface import Interface
+from d1lod import interface as interface_module
 from d1lod import dataone
 
 def test_interface_can_be_created(interface):
@@ -94,6 +96,187 @@ def test_can_reuse_an_org_uri(graph, interface):
     assert graph.size() == 2
 
 
+def test_caches_person_and_org_uris(graph, interface):
+    graph.clear()
+    interface.uri_cache.clear()
+
+    interface.model = None
+    interface.createModel()
+    interface.addPerson({ 'last_name': 'Alpha', 'email': 'alpha@example.org', 'organization': 'Test Organization'})
+    interface.insertModel()
+    interface.model = None
+    interface.cacheMintedURIs()
+
+    assert len(interface.uri_cache) == 2
+
+    hits = interface.uri_cache.hits
+    person_uri = interface.findPersonURI({ 'last_name': 'Alpha', 'email': 'ALPHA@example.org'})
+
+    assert person_uri is not None
+    assert interface.uri_cache.hits == hits + 1
+
+    interface.uri_cache.clear()
+
+    assert str(interface.findPersonURI({ 'last_name': 'Alpha', 'email': 'alpha@example.org'})) == str(person_uri)
+    assert interface.findOrganizationURI({ 'name': 'Test Organization' }) is not None
+    assert len(interface.uri_cache) == 2
+
+
+def test_can_find_people_and_orgs_in_the_match_key_index(graph, interface):
+    graph.clear()
+    graph.update("DROP SILENT GRAPH <%s>" % interface.match_key_graph)
+    interface.uri_cache.clear()
+
+    interface.model = None
+    interface.createModel()
+    interface.addPerson({ 'last_name': 'Alpha', 'email': 'alpha@example.org', 'organization': 'Test Organization'})
+    interface.insertModel()
+    interface.model = None
+
+    person_key = interface.personMatchKey('Alpha', 'alpha@example.org')
+    organization_key = interface.organizationMatchKey('Test Organization')
+
+    assert interface.findIndexedURI(person_key) is not None
+    assert interface.findIndexedURI(organization_key) is not None
+
+    # Rebuilding from the main graph gives the same index
+    person_uri = interface.findIndexedURI(person_key)
+    graph.update("DROP SILENT GRAPH <%s>" % interface.match_key_graph)
+    assert interface.findIndexedURI(person_key) is None
+
+    interface.rebuildMatchKeyIndex()
+
+    assert interface.matchKeyIndexIsComplete()
+    assert str(interface.findIndexedURI(person_key)) == str(person_uri)
+    assert interface.findIndexedURI(organization_key) is not None
+
+
+def test_notices_a_match_key_index_built_by_another_worker(graph, monkeypatch):
+    graph.update("DROP SILENT GRAPH <%s>" % (graph.name + interface_module.MATCH_KEY_GRAPH_SUFFIX))
+
+    worker = Interface(graph)
+    other_worker = Interface(graph)
+
+    assert not worker.matchKeyIndexIsComplete()
+
+    other_worker.rebuildMatchKeyIndex()
+
+    # Not asked again until the check interval is up
+    assert not worker.matchKeyIndexIsComplete()
+
+    monkeypatch.setattr(interface_module, 'MATCH_KEY_INDEX_CHECK_INTERVAL', 0)
+    assert worker.matchKeyIndexIsComplete()
+
+
+def test_can_update_a_dataset_by_difference(graph):
+    graph.clear()
+
+    interface = Interface(graph, diff=True)
+    identifier = 'doi:10.5063/F1125QWP'
+
+    interface.addDataset(identifier)
+    size = graph.size()
+
+    assert len(graph.query("SELECT ?s WHERE { ?s ?p ?o FILTER(isBlank(?s)) }")) == 0
+
+    interface.model = None
+    interface.addDataset(identifier)
+
+    assert graph.size() == size
+
+    # Changed triples are replaced
+    dataset = interface.prepareTerm('d1dataset:' + identifier)
+    interface.createModel()
+    interface.add(dataset, 'rdf:type', 'geolink:Dataset')
+    interface.add(dataset, 'rdfs:label', 'Changed')
+    interface.insertModelDifference(dataset, interface.deleteDatasetOperations(identifier))
+    interface.model = None
+
+    assert len(graph.query("SELECT ?o WHERE { <http://dataone.org/dataset/doi:10.5063/F1125QWP> ?p ?o }")) == 2
+
+
+def test_diff_compares_typed_literals_by_value(graph):
+    graph.clear()
+
+    interface = Interface(graph, diff=True)
+    xsd = 'http://www.w3.org/2001/XMLSchema#'
+
+    graph.update("""INSERT DATA { GRAPH <%s> {
+        <http://dataone.org/dataset/x> <http://purl.org/dc/terms/modified> "2015-05-30T23:21:15.567+00:00"^^<%sdateTime> .
+        <http://dataone.org/dataset/x> <http://example.org/#size> "45.50"^^<%sdecimal>
+    } }""" % (graph.name, xsd, xsd))
+
+    writes = []
+    interface.writeTriples = lambda triples, deletes=None: writes.append((triples, deletes))
+
+    dataset = RDF.Uri('http://dataone.org/dataset/x')
+    interface.createModel()
+    interface.add(dataset, 'dcterms:modified', RDF.Node(literal='2015-05-30T23:21:15.567Z', datatype=RDF.Uri(xsd + 'dateTime')))
+    interface.add(dataset, RDF.Uri('http://example.org/#size'), RDF.Node(literal='45.5', datatype=RDF.Uri(xsd + 'decimal')))
+    interface.insertModelDifference(dataset, [])
+    interface.model = None
+
+    assert writes == [([], [])]
+
+
+def test_can_normalize_typed_literals(interface):
+    xsd = 'http://www.w3.org/2001/XMLSchema#'
+    date_time = lambda value: interface.normalizeTerm({'type': 'literal', 'value': value, 'datatype': xsd + 'dateTime'})['value']
+
+    assert date_time('2015-05-30T23:21:15.567Z') == date_time('2015-05-30T23:21:15.567+00:00')
+    assert date_time('2015-05-30T23:21:15.567Z') == date_time('2015-05-30T16:21:15.567-07:00')
+    assert date_time('2015-05-30T23:21:15Z') == date_time('2015-05-30T23:21:15')
+    assert date_time('2015-05-30T23:21:15Z') != date_time('2015-05-30T23:21:16Z')
+    assert date_time('not a date') == 'not a date'
+
+    assert interface.normalizeTerm({'type': 'literal', 'value': '45.50', 'datatype': xsd + 'decimal'})['value'] == '45.5'
+    assert interface.normalizeTerm({'type': 'literal', 'value': '4.55E1', 'datatype': xsd + 'double'})['value'] == '45.5'
+    assert interface.normalizeTerm({'type': 'literal', 'value': '45.50'}) == {'type': 'literal', 'value': '45.50'}
+
+
+def test_failed_datasets_in_a_batch_dont_leave_minted_people_behind(graph, monkeypatch):
+    graph.clear()
+
+    interface = Interface(graph)
+    creator = {'type': 'person', 'role': 'creator', 'full_name': 'Jo Smith', 'last_name': 'Smith', 'email': 'smith@example.org'}
+
+    monkeypatch.setattr(interface_module.dataone, 'streamScientificMetadata', lambda identifier, format_id=None: None)
+    monkeypatch.setattr(interface_module.processing, 'extractCreators', lambda identifier, doc, format_id=None: [dict(creator, document=identifier)])
+
+    remember = interface.rememberDatasetAgents
+
+    def failFor(identifier):
+        def rememberDatasetAgents(dataset):
+            if str(dataset).endswith('/' + identifier):
+                raise Exception("Failed before the dataset's triples were written.")
+
+            remember(dataset)
+
+        return rememberDatasetAgents
+
+    monkeypatch.setattr(interface, 'rememberDatasetAgents', failFor('a'))
+
+    interface.beginBatch()
+
+    # The first dataset mints Smith then fails, as in jobs.add_datasets
+    with pytest.raises(Exception):
+        interface.addDataset('a', dataone.docToRecord(ET.fromstring('<doc><str name="identifier">a</str></doc>')))
+
+    interface.model = None
+
+    # The second links to a Smith whose triples it writes itself
+    interface.addDataset('b', dataone.docToRecord(ET.fromstring('<doc><str name="identifier">b</str></doc>')))
+    interface.endBatch()
+
+    creators = graph.query("SELECT ?person WHERE { ?person geolink:isCreatorOf d1dataset:b }")
+    assert len(creators) == 1
+    assert len(graph.query("SELECT ?name WHERE { <%s> geolink:nameFamily ?name }" % creators[0]['person'])) == 1
+
+    key = interface.personMatchKey('Smith', 'smith@example.org')
+    assert str(interface.uri_cache.get(key)) == creators[0]['person']
+    assert str(interface.findIndexedURI(key)) == creators[0]['person']
+
+
 def test_can_prepare_terms_properly(interface):
     assert isinstance(interface.prepareTerm('test'), RDF.Node)
     assert isinstance(interface.prepareTerm('d1dataset:' + 'test'), RDF.Uri)
@@ -119,3 +302,49 @@ def test_can_use_the_formats_list(interface):
 
     assert interface.exists(o='<http://schema.geolink.org/dev/voc/dataone/format#004>')
 
+
+
+def test_adding_a_dataset_returns_its_changes(graph, interface):
+    graph.clear()
+
+    identifier = 'doi:10.5063/F1125QWP'
+
+    interface.model = None
+    change = interface.addDataset(identifier)
+
+    assert change['dataset'] == 'http://dataone.org/dataset/doi:10.5063/F1125QWP'
+    assert change['removed'] is True
+
+    # The added triples are read back out of the graph, creators included
+    triples = list(interface.iterChangeTriples(change['dataset']))
+    predicates = set([p['value'] for s, p, o in triples])
+    objects = set([o['value'] for s, p, o in triples])
+
+    assert graph.ns['geolink'] + 'isCreatorOf' in predicates
+    assert graph.ns['geolink'] + 'Person' in objects or graph.ns['geolink'] + 'Organization' in objects
+
+
+def test_replacing_a_dataset_only_touches_that_dataset(graph, interface):
+    graph.clear()
+
+    interface.model = None
+    interface.createModel()
+    interface.add('d1person:urn:uuid:other', 'geolink:isCreatorOf', 'd1dataset:other')
+    interface.insertModel()
+    interface.model = None
+
+    identifier = 'doi:10.5063/F1125QWP'
+
+    interface.addDataset(identifier)
+    size = graph.size()
+
+    interface.model = None
+    interface.addDataset(identifier)
+
+    assert graph.size() == size
+    assert len(graph.query("SELECT ?s WHERE { ?s geolink:isCreatorOf d1dataset:other }")) == 1
+
+    interface.deleteDataset(identifier)
+
+    assert len(graph.query("SELECT ?p WHERE { <http://dataone.org/dataset/doi:10.5063/F1125QWP> ?p ?o }")) == 0
+    assert len(graph.query("SELECT ?s WHERE { ?s geolink:isCreatorOf d1dataset:other }")) == 1
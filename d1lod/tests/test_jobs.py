@@ -3,7 +3,9 @@
 Test aspects of the job module.
 """
 
+import pytest
 import RDF
+import xml.etree.ElementTree as ET
 
 from d1lod import jobs
 
@@ -20,3 +22,99 @@ def test_can_create_a_void_model():
 def test_fails_to_create_a_void_model_with_bad_input():
     assert not isinstance(jobs.createVoIDModel(""), RDF.Model)
     assert not isinstance(jobs.createVoIDModel(5), RDF.Model)
+
+
+def test_can_create_a_void_model_with_changesets():
+    m = jobs.createVoIDModel("2015-12-10", ["00000001-20151210T000000Z", "00000002-20151210T010000Z"])
+
+    assert isinstance(m, RDF.Model)
+    assert m.size() == 4 + 1 + 2 * 2
+
+
+def test_can_create_a_void_model_with_a_dump_sequence_number():
+    m = jobs.createVoIDModel("2015-12-10", ["00000042-20151210T010000Z"], 41)
+
+    assert isinstance(m, RDF.Model)
+    assert m.size() == 4 + 1 + 1 + 2
+
+
+def test_can_calculate_chunk_sizes():
+    # Falls back to the default chunk size until the drain rate is known
+    assert jobs.calculateChunkSize(0, None, default=100) == 100
+    assert jobs.calculateChunkSize(40, None, default=100) == 60
+
+    # Queues what'll be drained before the next update plus the shortfall
+    assert jobs.calculateChunkSize(50, 2.0, interval=60, target=100, maximum=1000) == 170
+    assert jobs.calculateChunkSize(0, 100.0, interval=60, target=100, maximum=1000) == 1000
+    assert jobs.calculateChunkSize(500, 1.0, interval=60, target=100, maximum=1000) == 0
+
+
+def test_can_get_dataset_job_ids():
+    job_id = jobs.getDatasetJobId([('doi:10.5063/F1125QWP', '2015-05-30T12:34:56.789Z')])
+
+    assert job_id.startswith('add_dataset:')
+    assert job_id == jobs.getDatasetJobId([('doi:10.5063/F1125QWP', '2015-05-30T12:34:56.789Z')])
+    assert job_id != jobs.getDatasetJobId([('doi:10.5063/F1125QWP', '2015-05-31T12:34:56.789Z')])
+    assert jobs.getDatasetJobId([('a', None), ('b', None)]).startswith('add_datasets:')
+
+
+class FailingBatchInterface:
+    """Stands in for an Interface whose batch fails to flush."""
+
+    def __init__(self):
+        self.model = None
+        self.ended = False
+
+    def beginBatch(self):
+        return None
+
+    def addDataset(self, identifier, record):
+        return {'dataset': 'http://dataone.org/dataset/' + identifier, 'removed': True}
+
+    def endBatch(self):
+        self.ended = True
+        raise Exception("Flush failed.")
+
+
+def test_batches_only_record_changes_once_written(monkeypatch):
+    interface = FailingBatchInterface()
+    recorded = []
+
+    monkeypatch.setattr(jobs, 'getInterface', lambda: interface)
+    monkeypatch.setattr(jobs, 'recordChange', recorded.append)
+    monkeypatch.setattr(jobs, 'isSuperseded', lambda identifier, date_modified: False)
+    monkeypatch.setattr(jobs, 'lockDataset', lambda identifier: identifier)
+    monkeypatch.setattr(jobs, 'releaseDataset', lambda lock: None)
+    monkeypatch.setattr(jobs, 'clearInFlight', lambda identifier, date_modified: None)
+    monkeypatch.setattr(jobs, 'recordCompleted', lambda num_datasets, seconds=None: None)
+    monkeypatch.setattr(jobs.metrics, 'CONNECTION', None)
+
+    records = [jobs.dataone.docToRecord(ET.fromstring('<doc><str name="identifier">%s</str></doc>' % identifier)) for identifier in ['a', 'b']]
+
+    with pytest.raises(Exception):
+        jobs.add_datasets(records)
+
+    assert interface.ended
+    assert recorded == []
+
+
+def test_clears_the_in_flight_marker_when_the_lock_times_out(monkeypatch):
+    cleared = []
+
+    def lockDataset(identifier):
+        raise Exception("Timed out waiting for the lock on dataset %s." % identifier)
+
+    monkeypatch.setattr(jobs, 'getGraph', lambda: None)
+    monkeypatch.setattr(jobs, 'getInterface', lambda: FailingBatchInterface())
+    monkeypatch.setattr(jobs, 'isSuperseded', lambda identifier, date_modified: False)
+    monkeypatch.setattr(jobs, 'lockDataset', lockDataset)
+    monkeypatch.setattr(jobs, 'clearInFlight', lambda identifier, date_modified: cleared.append((identifier, date_modified)))
+    monkeypatch.setattr(jobs, 'recordCompleted', lambda num_datasets, seconds=None: None)
+    monkeypatch.setattr(jobs.metrics, 'CONNECTION', None)
+
+    record = jobs.dataone.docToRecord(ET.fromstring('<doc><str name="identifier">a</str><date name="dateModified">2015-05-30T23:21:15.567Z</date></doc>'))
+
+    with pytest.raises(Exception):
+        jobs.add_dataset('a', record)
+
+    assert cleared == [('a', '2015-05-30T23:21:15.567Z')]
@@ -88,3 +88,103 @@ def test_iso_can_process_a_ncei_file():
     creators = [record for record in records if 'role' in record and record['role']=='creator']
     assert len(records) == 5
     assert len(creators) == 1
+
+
+def test_can_process_documents_parsed_with_xpath():
+    """Test that documents parsed with xpath.parse (lxml, when it's installed)
+    produce the same records as ones parsed with ElementTree."""
+
+    for filename in ['creator.xml', 'creator_bad_email.xml', 'ncei.xml']:
+        path = 'tests/data/metadata/iso/%s' % filename
+
+        assert iso.process(xpath.parse(path), 'xxx') == iso.process(ET.parse(path), 'xxx')
+
+
+def test_does_not_expand_external_entities(tmpdir):
+    secret = tmpdir.join('secret.txt')
+    secret.write('SECRET')
+
+    content = '''<?xml version="1.0"?>
+<!DOCTYPE eml [<!ENTITY xxe SYSTEM "file://%s">]>
+<eml><dataset><creator><individualName><surName>Smith&xxe;</surName></individualName></creator></dataset></eml>''' % secret
+
+    # ElementTree refuses the document outright, lxml leaves &xxe; as is
+    for parse in [xpath.fromstring, lambda content: registry.iterparse(StringIO.StringIO(content))]:
+        try:
+            doc = parse(content)
+        except xpath.PARSE_ERRORS:
+            continue
+
+        assert 'SECRET' not in ''.join(doc.itertext())
+        assert 'SECRET' not in repr(eml.process(doc, 'xxx'))
+
+
+def test_paths_search_whole_documents_and_elements():
+    doc = ET.fromstring('<eml><dataset><creator><individualName><surName>Smith</surName></individualName></creator></dataset></eml>')
+
+    creators = eml.CREATORS.findall(ET.ElementTree(doc))
+    assert len(creators) == 1
+    assert eml.SUR_NAME.find(eml.INDIVIDUAL_NAME.find(creators[0])).text == 'Smith'
+    assert eml.EMAIL.find(creators[0]) is None
+
+
+def test_can_detect_formats():
+    doc = ET.parse('tests/data/metadata/iso/creator.xml')
+
+    assert registry.detectFormat(doc) == 'iso'
+    assert registry.detectFormat(ET.fromstring('<metadata/>')) == 'fgdc'
+    assert registry.detectFormat(ET.fromstring('<eml:eml xmlns:eml="eml://ecoinformatics.org/eml-2.1.1"/>')) == 'eml'
+    assert registry.detectFormat(ET.fromstring('<foo/>')) == registry.UNKNOWN
+    assert registry.detectFormat(ET.fromstring('<foo/>'), 'eml://ecoinformatics.org/eml-2.1.1') == 'eml'
+
+
+def test_remembers_formats_detected_for_unregistered_format_ids():
+    registry.DETECTED.clear()
+
+    assert registry.detectFormat(ET.parse('tests/data/metadata/iso/creator.xml'), 'test-iso') == 'iso'
+    assert registry.detectFormat(ET.fromstring('<foo/>'), 'test-iso') == 'iso'
+
+    registry.DETECTED.clear()
+
+
+def test_can_extract_creators_from_iso():
+    from d1lod.people import processing
+
+    records = processing.extractCreators('xxx', ET.parse('tests/data/metadata/iso/creator.xml'))
+
+    assert len(records) == 1
+    assert records[0]['role'] == 'creator'
+    assert records[0]['document'] == 'xxx'
+
+
+def test_iterparse_only_keeps_what_processors_look_at():
+    content = '''<eml:eml xmlns:eml="eml://ecoinformatics.org/eml-2.1.1">
+        <dataset>
+            <title>A dataset</title>
+            <creator><individualName><givenName>Jo</givenName><surName>Smith</surName></individualName></creator>
+            <dataTable><attributeList><attribute><attributeName>a</attributeName></attribute></attributeList></dataTable>
+        </dataset>
+        <additionalMetadata><creator/></additionalMetadata>
+    </eml:eml>'''
+
+    doc = registry.iterparse(StringIO.StringIO(content))
+
+    assert [child.tag for child in doc] == ['dataset', 'additionalMetadata']
+    assert [child.tag for child in doc[0]] == ['creator']
+    assert eml.process(doc, 'xxx') == eml.process(ET.fromstring(content), 'xxx')
+
+
+def test_iterparse_keeps_what_iso_processing_looks_at():
+    path = 'tests/data/metadata/iso/ncei.xml'
+
+    with open(path, 'rb') as f:
+        doc = registry.iterparse(f)
+
+    assert iso.process(doc, 'xxx') == iso.process(ET.parse(path), 'xxx')
+
+
+def test_iterparse_stops_at_unknown_formats():
+    doc = registry.iterparse(StringIO.StringIO('<foo><bar/></foo>'))
+
+    assert doc.tag == 'foo'
+    assert len(doc) == 0
@@ -0,0 +1,58 @@
+"""test_metrics.py
+
+Test formatting metrics for Prometheus.
+"""
+
+from d1lod import metrics
+
+
+def test_can_format_labels():
+    assert metrics.formatLabels(None) == ''
+    assert metrics.formatLabels({'status': 200, 'operation': 'query'}) == 'operation="query",status="200"'
+    assert metrics.formatLabels({'concept': 'a "b"'}) == 'concept="a \\"b\\""'
+
+
+def test_can_format_counters():
+    lines = metrics.formatMetric('d1lod_jobs_total', 'counter', "Jobs.", {'job="add_dataset"': '3'})
+
+    assert lines == ['# HELP d1lod_jobs_total Jobs.',
+                     '# TYPE d1lod_jobs_total counter',
+                     'd1lod_jobs_total{job="add_dataset"} 3']
+
+
+def test_can_format_histograms():
+    values = {'operation="query"|0.1': '2', 'operation="query"|+Inf': '1',
+              'operation="query"|sum': '60.15', 'operation="query"|count': '3'}
+
+    lines = metrics.formatMetric('d1lod_sparql_request_duration_seconds', 'histogram', "SPARQL.", values, buckets=(0.1, 1))
+
+    assert lines[2:] == ['d1lod_sparql_request_duration_seconds_bucket{operation="query",le="0.1"} 2',
+                         'd1lod_sparql_request_duration_seconds_bucket{operation="query",le="1.0"} 2',
+                         'd1lod_sparql_request_duration_seconds_bucket{operation="query",le="+Inf"} 3',
+                         'd1lod_sparql_request_duration_seconds_sum{operation="query"} 60.15',
+                         'd1lod_sparql_request_duration_seconds_count{operation="query"} 3']
+
+
+class RecordingConnection:
+    def __init__(self):
+        self.calls = []
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def hincrbyfloat(self, *args):
+        self.calls.append(('hincrbyfloat', args))
+
+    def execute(self):
+        pass
+
+
+def test_ignores_unknown_metrics(monkeypatch):
+    conn = RecordingConnection()
+    monkeypatch.setattr(metrics, 'CONNECTION', conn)
+
+    metrics.increment('d1lod_not_a_metric')
+    assert conn.calls == []
+
+    metrics.increment('d1lod_jobs_total', {'job': 'add_dataset'})
+    assert len(conn.calls) == 1
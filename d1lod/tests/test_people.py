@@ -0,0 +1,42 @@
+"""test_people.py
+
+Test processing directories of metadata for people and organizations.
+"""
+
+import os
+
+from d1lod.people import processing
+from d1lod.people.job import Job
+
+
+def runJob(directory, processes):
+    """Run a Job over `directory` in the current directory and read back the
+    people and organizations it wrote."""
+
+    job = Job(directory)
+    job.run(processes=processes)
+    job.finish()
+
+    with open(job.people_file, 'rb') as f:
+        people = f.read()
+
+    with open(job.organizations_file, 'rb') as f:
+        organizations = f.read()
+
+    return people, organizations
+
+
+def test_output_is_the_same_however_many_processes_are_used(tmpdir, monkeypatch):
+    directory = os.path.abspath('tests/data/metadata/iso')
+
+    # Hand out one document at a time so both processes get some
+    monkeypatch.setattr(processing, 'PROCESS_CHUNK_SIZE', 1)
+
+    monkeypatch.chdir(tmpdir.mkdir('serial'))
+    serial = runJob(directory, 1)
+
+    monkeypatch.chdir(tmpdir.mkdir('parallel'))
+    parallel = runJob(directory, 2)
+
+    assert serial == parallel
+    assert len(serial[1].splitlines()) > 1
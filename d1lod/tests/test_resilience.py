@@ -0,0 +1,159 @@
+"""test_resilience.py
+
+Test the retrying HTTP layer.
+"""
+
+import errno
+import socket
+import pytest
+import requests
+
+from d1lod import resilience
+
+
+class Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {'Retry-After': '0'}
+
+    def close(self):
+        pass
+
+
+class Session:
+    """Responds to each request with the next of `outcomes`, raising it if
+    it's an exception."""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.num_requests = 0
+
+    def request(self, method, url, **kwargs):
+        self.num_requests += 1
+        outcome = self.outcomes.pop(0)
+
+        if isinstance(outcome, Exception):
+            raise outcome
+
+        return Response(outcome)
+
+
+def test_backs_off_exponentially():
+    for attempt in range(10):
+        assert 0 <= resilience.getBackoff(attempt, base=0.5, maximum=30) <= min(30, 0.5 * 2 ** attempt)
+
+
+def test_retries_transient_failures():
+    session = Session([requests.exceptions.ConnectionError(), 503, 200])
+
+    r = resilience.request('GET', 'http://retries.example.org/', session=session, retries=2)
+
+    assert r.status_code == 200
+    assert session.num_requests == 3
+
+
+def test_returns_other_statuses_without_retrying():
+    session = Session([404])
+
+    assert resilience.request('GET', 'http://notfound.example.org/', session=session).status_code == 404
+    assert session.num_requests == 1
+
+
+def test_circuit_breaker_opens_and_recovers():
+    breaker = resilience.CircuitBreaker('test', threshold=2, reset=0)
+
+    breaker.recordFailure()
+    assert breaker.state() == 'closed'
+
+    breaker.recordFailure()
+    assert breaker.state() != 'closed'
+
+    # Only one trial request is let through once it's half-open
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.recordSuccess()
+    assert breaker.state() == 'closed'
+    assert breaker.allow()
+
+
+def test_counts_a_failure_once_its_retries_run_out():
+    url = 'http://down.example.org/'
+    breaker = resilience.CircuitBreaker('down.example.org', threshold=2, reset=60)
+    resilience.BREAKERS['down.example.org'] = breaker
+    session = Session([503] * 6)
+
+    # Three failed attempts are one failed request
+    assert resilience.request('GET', url, session=session, retries=2).status_code == 503
+    assert session.num_requests == 3
+    assert breaker.failures == 1
+    assert breaker.state() == 'closed'
+
+    assert resilience.request('GET', url, session=session, retries=2).status_code == 503
+    assert breaker.failures == 2
+    assert breaker.state() == 'open'
+
+    # Further requests aren't sent while it's open
+    with pytest.raises(Exception):
+        resilience.request('GET', url, session=session, retries=2)
+
+    assert session.num_requests == 6
+
+
+def test_retries_a_half_open_breakers_trial():
+    url = 'http://trial.example.org/'
+    breaker = resilience.CircuitBreaker('trial.example.org', threshold=1, reset=60)
+    resilience.BREAKERS['trial.example.org'] = breaker
+    breaker.recordFailure()
+    breaker.opened_at -= 60  # Ready for a trial request
+
+    session = Session([503, 200])
+
+    assert resilience.request('GET', url, session=session, retries=1).status_code == 200
+    assert session.num_requests == 2
+    assert breaker.state() == 'closed'
+
+
+def test_other_errors_end_a_half_open_breakers_trial():
+    url = 'http://halfopen.example.org/'
+    resilience.BREAKERS['halfopen.example.org'] = resilience.CircuitBreaker('halfopen.example.org', threshold=1, reset=0)
+    session = Session([requests.exceptions.ConnectionError(), requests.exceptions.ChunkedEncodingError(), 200])
+
+    for error in [requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError]:
+        try:
+            resilience.request('GET', url, session=session, retries=0)
+            assert False
+        except error:
+            pass
+
+    # The breaker lets the next trial request through
+    assert resilience.request('GET', url, session=session, retries=0).status_code == 200
+
+
+def test_only_retries_failures_to_connect_when_not_idempotent():
+    session = Session([requests.exceptions.ReadTimeout(), 200])
+
+    try:
+        resilience.request('POST', 'http://update.example.org/', session=session, idempotent=False)
+        assert False
+    except requests.exceptions.ReadTimeout:
+        pass
+
+    assert session.num_requests == 1
+
+    session = Session([requests.exceptions.ConnectTimeout(), 503, 200])
+
+    assert resilience.request('POST', 'http://update.example.org/', session=session, idempotent=False).status_code == 200
+    assert session.num_requests == 3
+
+
+def test_can_tell_failures_to_connect_apart():
+    ProtocolError = requests.packages.urllib3.exceptions.ProtocolError
+
+    refused = ProtocolError('Connection aborted.', socket.error(errno.ECONNREFUSED, 'Connection refused'))
+    reset = ProtocolError('Connection aborted.', socket.error(errno.ECONNRESET, 'Connection reset by peer'))
+
+    assert resilience.isConnectError(requests.exceptions.ConnectionError(refused))
+    assert not resilience.isConnectError(requests.exceptions.ConnectionError(reset))
+    assert resilience.isConnectError(requests.exceptions.ConnectTimeout())
+    assert not resilience.isConnectError(requests.exceptions.ReadTimeout())
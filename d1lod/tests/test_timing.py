@@ -0,0 +1,30 @@
+"""test_timing.py
+
+Test the per-stage job timers.
+"""
+
+import json
+
+from d1lod import timing
+
+
+def test_records_stages_on_the_active_timer():
+    timer = timing.StageTimer()
+
+    with timing.stage('scimeta'):
+        pass
+
+    with timing.activate(timer):
+        for i in range(3):
+            with timing.stage('sysmeta_object'):
+                pass
+
+    with timing.stage('write'):
+        pass
+
+    summary = json.loads(timer.format(identifier='a'))
+
+    assert summary['identifier'] == 'a'
+    assert summary['stages'].keys() == ['sysmeta_object']
+    assert summary['stages']['sysmeta_object']['count'] == 3
+    assert timing.ACTIVE is None
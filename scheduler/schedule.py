@@ -1,3 +1,4 @@
+import os
 import time
 import logging
 logging.basicConfig(level=logging.DEBUG)
@@ -10,6 +11,10 @@ from apscheduler.schedulers.blocking import BlockingScheduler
 import sys
 sys.path.append('/d1lod')
 from d1lod import jobs
+from d1lod import formats
+from d1lod import metrics
+
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))
 
 conn = StrictRedis(host='redis', port='6379')
 queues = {
@@ -31,17 +36,35 @@ def queue_stats_job():
     queues['default'].enqueue(jobs.calculate_stats)
 
 
-@sched.scheduled_job('interval', id='export', hours=1)
+@sched.scheduled_job('interval', id='changeset', hours=1)
+def queue_changeset_job():
+    queues['export'].enqueue(jobs.export_changeset)
+
+
+# Workers read the formats map from a snapshot on disk (see d1lod.formats).
+# It's only fetched here so jobs never wait on, or fail because of, GitHub.
+@sched.scheduled_job('interval', id='formats', hours=1)
+def refresh_formats():
+    formats.refreshSnapshot()
+
+
+# Mirrors keep up to date between full dumps with the hourly changesets
+@sched.scheduled_job('interval', id='export', hours=24)
 def queue_export_job():
     queues['export'].enqueue(jobs.export_graph)
 
 # Wait a bit for Sesame to start
 time.sleep(10)
 
+refresh_formats()
+
 # Queue the stats job first. This creates the graph before any other
 # jobs are run.
 queues['default'].enqueue(jobs.calculate_stats)
+queues['default'].enqueue(jobs.rebuild_match_key_index)
 queues['default'].enqueue(jobs.update_graph)
 
-# Start the scheduler
+# Serve metrics (see d1lod.metrics) then start the scheduler. The workers
+# record metrics into the same Redis but don't serve them.
+metrics.serve(METRICS_PORT, jobs.collectMetrics)
 sched.start()
@@ -1,25 +1,296 @@
+""" work.py
+
+Supervises a pool of RQ workers.
+
+Each queue gets its own set of worker processes so a long export_graph or a
+slow dataset doesn't hold up the other queues. The number of workers per
+queue is read from the WORKER_CONCURRENCY environment variable, e.g.
+
+    WORKER_CONCURRENCY=default:1,dataset:4,export:1
+
+Queues left out of WORKER_CONCURRENCY get DEFAULT_CONCURRENCY workers, except
+for the dataset queue which defaults to one worker per core.
+
+Workers run their jobs in their own process rather than forking a work horse
+for each one, so the Graph, Interface and other per-process state (pooled
+connections, URI caches, circuit breakers, ...) carry over from one job to the
+next.
+
+The supervisor restarts workers that die and periodically logs the state of
+every worker and the length of every queue. On SIGTERM or SIGINT it passes
+SIGTERM on to the workers, which finish their current job before exiting
+(RQ's warm shutdown), and exits once they all have.
+
+The metrics jobs record (see d1lod.metrics) are served by the scheduler.
+"""
+
+import os
 import sys
 import time
+import signal
 import logging
+import multiprocessing
 logging.basicConfig(level=logging.DEBUG, format='[%(asctime)s] [%(levelname)s] %(message)s')
 
 from redis import StrictRedis
-from rq import Worker, Queue, Connection
+from rq import SimpleWorker, Worker, Queue, Connection
 
 sys.path.append('/d1lod')
 from d1lod import jobs
 
-conn = StrictRedis(host='redis', port='6379')
-queues = {
-    'default': Queue('default', connection=conn),
-    'dataset': Queue('dataset', connection=conn),
-    'export': Queue('export', connection=conn)
-}
+REDIS_HOST = 'redis'
+REDIS_PORT = '6379'
+QUEUE_NAMES = ['default', 'dataset', 'export']
+DEFAULT_CONCURRENCY = 1
+HEALTH_INTERVAL = 60  # (seconds) Time between health reports
+RESTART_DELAY = 10  # (seconds) Minimum time between restarts of one worker
+POLL_INTERVAL = 1  # (seconds) Time between checks for dead workers
+
+
+def getConcurrency(value=None):
+    """Parse a WORKER_CONCURRENCY string into the number of workers to run
+    for each queue.
+
+    Arguments:
+    ----------
+
+    value : str
+        Comma-separated queue:count pairs. Defaults to the value of the
+        WORKER_CONCURRENCY environment variable.
+
+    Returns:
+        A Dict of worker counts, indexed by queue name.
+    """
+
+    if value is None:
+        value = os.environ.get('WORKER_CONCURRENCY', '')
+
+    concurrency = dict([(name, DEFAULT_CONCURRENCY) for name in QUEUE_NAMES])
+    concurrency['dataset'] = multiprocessing.cpu_count()
+
+    for pair in value.split(','):
+        if len(pair.strip()) == 0:
+            continue
+
+        try:
+            name, count = pair.split(':')
+            concurrency[name.strip()] = int(count)
+        except ValueError:
+            raise Exception("Invalid WORKER_CONCURRENCY entry '%s'. Expected queue:count." % pair)
+
+    return concurrency
+
+
+def runWorker(queue_name):
+    """Run an RQ worker on a single queue until it's told to stop. Called in
+    a freshly forked process."""
+
+    # Leave the supervisor's process group so a Ctrl-C at the terminal only
+    # reaches the supervisor. Otherwise the worker would get SIGINT and then
+    # the supervisor's SIGTERM, which RQ takes as a cold shutdown.
+    os.setpgrp()
+
+    # Let the worker install its own handlers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    conn = StrictRedis(host=REDIS_HOST, port=REDIS_PORT)
+
+    # Build this worker's Graph and Interface up front. Jobs are run in this
+    # process (SimpleWorker doesn't fork a work horse per job) so they're
+    # reused by every job the worker takes.
+    jobs.getInterface()
+
+    with Connection(conn):
+        SimpleWorker([Queue(queue_name, connection=conn)], connection=conn).work()
+
+
+class Supervisor:
+    def __init__(self, concurrency):
+        """Initialize a supervisor for the workers in `concurrency`.
+
+        Arguments:
+        ----------
+
+        concurrency : Dict
+            Number of workers to run, indexed by queue name
+        """
+
+        self.concurrency = concurrency
+        self.conn = StrictRedis(host=REDIS_HOST, port=REDIS_PORT)
+
+        # One slot per worker, each a Dict with the slot's queue, the pid of
+        # its current process, when that was started, and its restart count
+        self.slots = []
+
+        for name in sorted(concurrency):
+            for i in range(concurrency[name]):
+                self.slots.append({'queue': name, 'pid': None, 'started': 0, 'restarts': 0})
+
+        self.stopping = False
+        self.last_report = 0
+
+
+    def run(self):
+        """Start the workers and look after them until told to stop.
+
+        Returns: None
+        """
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        logging.info("Starting workers: %s.", ", ".join(["%s=%d" % (name, self.concurrency[name]) for name in sorted(self.concurrency)]))
+
+        while not self.stopping:
+            self.reap()
+            self.startWorkers()
+
+            if time.time() - self.last_report >= HEALTH_INTERVAL:
+                self.reportHealth()
+
+            time.sleep(POLL_INTERVAL)
+
+        self.shutdown()
+
+
+    def stop(self, signum, frame):
+        """Signal handler. The first signal stops the supervisor after the
+        workers finish their current jobs. A second one is passed on to the
+        workers, which then abandon their jobs (RQ's cold shutdown)."""
+
+        if self.stopping:
+            logging.info("Received signal %d again. Stopping workers immediately.", signum)
+            self.signalWorkers(signal.SIGTERM)
+            return
+
+        logging.info("Received signal %d. Waiting for workers to finish their current jobs.", signum)
+        self.stopping = True
+
+
+    def signalWorkers(self, signum):
+        for slot in self.slots:
+            if slot['pid'] is None:
+                continue
+
+            try:
+                os.kill(slot['pid'], signum)
+            except OSError:
+                pass
+
+
+    def startWorkers(self):
+        """Fork a worker for every slot without one, waiting RESTART_DELAY
+        between restarts so a worker that keeps crashing doesn't spin.
+
+        Returns: None
+        """
+
+        for slot in self.slots:
+            if slot['pid'] is not None:
+                continue
+
+            if time.time() - slot['started'] < RESTART_DELAY:
+                continue
+
+            if slot['started'] > 0:
+                slot['restarts'] += 1
+
+            slot['started'] = time.time()
+            pid = os.fork()
+
+            if pid == 0:
+                try:
+                    runWorker(slot['queue'])
+                except Exception, e:
+                    logging.exception(e)
+                    os._exit(1)
+
+                os._exit(0)
+
+            slot['pid'] = pid
+            logging.info("Started worker %d on queue '%s'.", pid, slot['queue'])
+
+
+    def reap(self):
+        """Collect workers that have exited and free up their slots.
+
+        Returns:
+            The number of workers that exited.
+        """
+
+        num_exited = 0
+
+        for slot in self.slots:
+            if slot['pid'] is None:
+                continue
+
+            try:
+                pid, status = os.waitpid(slot['pid'], os.WNOHANG)
+            except OSError:
+                pid, status = slot['pid'], -1
+
+            if pid == 0:
+                continue
+
+            if not self.stopping:
+                if status >= 0 and os.WIFSIGNALED(status):
+                    logging.error("Worker %d on queue '%s' was killed by signal %d.", slot['pid'], slot['queue'], os.WTERMSIG(status))
+                else:
+                    logging.error("Worker %d on queue '%s' exited with status %d.", slot['pid'], slot['queue'], os.WEXITSTATUS(status) if status >= 0 else status)
+
+            slot['pid'] = None
+            num_exited += 1
+
+        return num_exited
+
+
+    def shutdown(self):
+        """Pass SIGTERM on to every worker and wait for them to exit.
+
+        Returns: None
+        """
+
+        self.signalWorkers(signal.SIGTERM)
+
+        while len([slot for slot in self.slots if slot['pid'] is not None]) > 0:
+            self.reap()
+            time.sleep(POLL_INTERVAL)
+
+        logging.info("All workers stopped.")
+
+
+    def reportHealth(self):
+        """Log the state of each worker and the length of each queue.
+
+        Returns: None
+        """
+
+        self.last_report = time.time()
+
+        try:
+            states = {}
+
+            for worker in Worker.all(connection=self.conn):
+                states[worker.name.split('.')[-1]] = worker.get_state()
+
+            for name in sorted(self.concurrency):
+                slots = [slot for slot in self.slots if slot['queue'] == name]
+                alive = [slot for slot in slots if slot['pid'] is not None]
+                worker_states = ["%d:%s" % (slot['pid'], states.get(str(slot['pid']), 'unregistered')) for slot in alive]
+
+                logging.info("Queue '%s': length=%d workers=%d/%d restarts=%d states=%s",
+                             name,
+                             len(Queue(name, connection=self.conn)),
+                             len(alive),
+                             len(slots),
+                             sum([slot['restarts'] for slot in slots]),
+                             ",".join(worker_states))
+        except Exception, e:
+            logging.error("Failed to report worker health: %s", e)
+
 
 if __name__ == '__main__':
     time.sleep(10)
 
-    with Connection(conn):
-        qs = [queues[q] for q in queues]
-        w = Worker(qs)
-        w.work()
+    Supervisor(getConcurrency()).run()